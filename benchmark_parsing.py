@@ -0,0 +1,81 @@
+"""
+Benchmark sentence parsing throughput of PrepareSentenceContext.
+
+Compares the original path (full en_core_web_sm pipeline, one document at a time through nlp(text))
+against the trimmed pipeline streamed through parse_many, and checks that sentence boundaries are
+unchanged.
+
+Example:
+    python benchmark_parsing.py -i wiki-long -n 500 -n-process 4
+"""
+
+import argparse
+import logging
+import time
+import pandas as pd
+from tabulate import tabulate
+from src.PrepareSentenceContext import PrepareSentenceContext
+from src.dataset_loaders import (get_text_from_wiki_long_dataset,
+                                 get_text_from_chatgpt_news_long_dataset,
+                                 get_text_from_chatgpt_abstracts_dataset)
+from many_atomic_detections import get_text_data_from_files
+
+logging.basicConfig(level=logging.INFO)
+
+
+def run_parser(parser, texts, bulk, batch_size=64, n_process=1):
+    start = time.perf_counter()
+    if bulk:
+        outputs = list(parser.parse_many(texts, batch_size=batch_size, n_process=n_process))
+    else:
+        outputs = [parser(text) for text in texts]
+    return outputs, time.perf_counter() - start
+
+
+def benchmark(texts, batch_size=64, n_process=1):
+    """
+    :return:  data frame with docs/sec of every configuration and the number of documents whose
+    sentences differ from the original path
+    """
+    configurations = [('full, one at a time', 'full', False, 1),
+                      ('parser only, one at a time', 'parser', False, 1),
+                      (f'parser only, parse_many (n_process={n_process})', 'parser', True, n_process),
+                      (f'senter only, parse_many (n_process={n_process})', 'senter', True, n_process)]
+    rows = []
+    reference = None
+    for name, segmenter, bulk, processes in configurations:
+        parser = PrepareSentenceContext(sentence_segmenter=segmenter)
+        outputs, elapsed = run_parser(parser, texts, bulk, batch_size=batch_size, n_process=processes)
+        sentences = [out['text'] for out in outputs]
+        if reference is None:
+            reference = sentences
+        rows.append(dict(configuration=name,
+                         docs_per_sec=len(texts) / elapsed,
+                         docs_with_changed_boundaries=sum(s != r for s, r in zip(sentences, reference))))
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sentence parsing throughput')
+    parser.add_argument('-i', type=str, help='database name or folder of text files', default="wiki-long")
+    parser.add_argument('-n', type=int, help='number of documents', default=500)
+    parser.add_argument('-batch-size', type=int, default=64)
+    parser.add_argument('-n-process', type=int, default=1)
+    parser.add_argument('--human', action='store_true')
+    args = parser.parse_args()
+
+    author = 'human' if args.human else 'machine'
+    lo_data_loaders = {'wiki-long': get_text_from_wiki_long_dataset,
+                       'news-long': get_text_from_chatgpt_news_long_dataset,
+                       'abstracts': get_text_from_chatgpt_abstracts_dataset}
+    if args.i in lo_data_loaders:
+        texts = lo_data_loaders[args.i](text_field=f'{author}_text').select(range(args.n))['text']
+    else:
+        texts = [d['text'] for d in get_text_data_from_files(args.i, extension='*.txt')][:args.n]
+
+    df = benchmark(texts, batch_size=args.batch_size, n_process=args.n_process)
+    print(tabulate(df, headers='keys', tablefmt='psql', showindex=False, floatfmt='.1f'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark runtime and peak memory of the empirical survival function fit.
+
+Compares the original estimate (an n x n comparison matrix) against the sort/searchsorted estimate
+used by fit_survival_func for growing numbers of null responses, and checks that both give identical
+values. The matrix estimate is only run up to -max-matrix-n samples.
+
+Example:
+    python benchmark_survival_fit.py -sizes 1000 10000 100000 1000000 10000000
+"""
+
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+from src.fit_survival_function import empirical_survival, fit_survival_func
+
+
+def matrix_survival(sxx):
+    return np.mean(np.expand_dims(sxx, 1) >= sxx, 0)
+
+
+def measure(func, *args):
+    """
+    :return:  (output, seconds, peak MB allocated by numpy during the call)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    out = func(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return out, elapsed, peak / 2 ** 20
+
+
+def benchmark(sizes, max_matrix_n=20000, seed=0):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for n in sizes:
+        # log-perplexities are rounded in the response files, so include ties
+        xx = np.round(rng.gamma(4, 1, size=n), 3)
+        sxx = np.sort(xx)
+        qq, sec, mb = measure(empirical_survival, sxx)
+        _, fit_sec, fit_mb = measure(fit_survival_func, xx)
+        row = dict(n=n, searchsorted_sec=sec, searchsorted_MB=mb, fit_sec=fit_sec, fit_MB=fit_mb,
+                   matrix_sec=np.nan, matrix_MB=np.nan, identical=None)
+        if n <= max_matrix_n:
+            qq_matrix, row['matrix_sec'], row['matrix_MB'] = measure(matrix_survival, sxx)
+            row['identical'] = bool(np.array_equal(qq, qq_matrix))
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the empirical survival function fit')
+    parser.add_argument('-sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000, 5000000])
+    parser.add_argument('-max-matrix-n', type=int, default=20000,
+                        help='largest size for the n x n matrix estimate (it needs n^2 bytes)')
+    args = parser.parse_args()
+
+    df = benchmark(args.sizes, max_matrix_n=args.max_matrix_n)
+    print(tabulate(df, headers='keys', tablefmt='psql', showindex=False, floatfmt='.4g'))
+
+
+if __name__ == '__main__':
+    main()
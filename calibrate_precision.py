@@ -0,0 +1,119 @@
+"""
+Calibration report for the execution precision of the sentence scorer.
+
+Scores a reference sample of sentences with the language model in fp32 and in every other
+precision option, and reports how far the responses (log-perplexities) and the resulting P-values
+move. P-values are computed under a null survival function fitted to the fp32 responses of the
+sample itself, so the report isolates the effect of precision.
+
+Example:
+    python calibrate_precision.py -i wiki-long -model-name gpt2-xl -n 200
+"""
+
+import argparse
+import copy
+import logging
+import time
+import numpy as np
+import pandas as pd
+from scipy.stats import ks_2samp
+from tabulate import tabulate
+from transformers import AutoTokenizer, AutoModelForCausalLM
+from src.PerplexityEvaluator import PerplexityEvaluator, PRECISIONS
+from src.PrepareSentenceContext import PrepareSentenceContext
+from src.fit_survival_function import fit_per_length_survival_function
+from src.PValueTable import PValueTable
+from src.dataset_loaders import (get_text_from_wiki_long_dataset,
+                                 get_text_from_chatgpt_news_long_dataset,
+                                 get_text_from_chatgpt_abstracts_dataset)
+from many_atomic_detections import get_text_data_from_files
+
+logging.basicConfig(level=logging.INFO)
+
+
+def score_sample(evaluator, lo_chunks):
+    """
+    Responses of all sentences of the parsed sample and the time it took
+    """
+    start = time.perf_counter()
+    responses = [evaluator.log_perplexity_batch(chunks['text'], chunks['context']) for chunks in lo_chunks]
+    return np.concatenate(responses), time.perf_counter() - start
+
+
+def calibration_report(model, tokenizer, lo_chunks, precisions=PRECISIONS, G=101):
+    """
+    Compare responses and P-values of every precision option to fp32
+
+    :param model:  language model (on CPU when 'int8' is in :precisions:)
+    :param lo_chunks:  list of parsed documents (outputs of PrepareSentenceContext)
+    :return:  data frame with one row per precision option
+    """
+    lengths = np.concatenate([chunks['length'] for chunks in lo_chunks])
+
+    ref_evaluator = PerplexityEvaluator(copy.deepcopy(model), tokenizer, precision='fp32')
+    ref_responses, ref_time = score_sample(ref_evaluator, lo_chunks)
+    valid = ~np.isnan(ref_responses)
+    pval_func = fit_per_length_survival_function(lengths[valid], ref_responses[valid], G=G, log_space=True)
+    pval_table = PValueTable.from_survival_function(pval_func)
+
+    def pvalues(responses):
+        return pval_table.pvalues(lengths, responses)
+
+    ref_pvals = pvalues(ref_responses)
+
+    rows = []
+    for precision in precisions:
+        if precision == 'fp32':
+            responses, elapsed = ref_responses, ref_time
+        else:
+            evaluator = PerplexityEvaluator(copy.deepcopy(model), tokenizer, precision=precision)
+            responses, elapsed = score_sample(evaluator, lo_chunks)
+        pvals = pvalues(responses)
+        rdiff = np.abs(responses - ref_responses)[valid]
+        pdiff = np.abs(pvals - ref_pvals)[valid]
+        rows.append(dict(precision=precision,
+                         seconds=elapsed,
+                         speedup=ref_time / elapsed,
+                         response_max_abs_diff=rdiff.max(),
+                         response_mean_abs_diff=rdiff.mean(),
+                         response_ks=ks_2samp(responses[valid], ref_responses[valid]).statistic,
+                         pvalue_max_abs_diff=pdiff.max(),
+                         pvalue_mean_abs_diff=pdiff.mean(),
+                         pvalue_ks=ks_2samp(pvals[valid], ref_pvals[valid]).statistic,
+                         ))
+    return pd.DataFrame(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare scorer precision options against fp32')
+    parser.add_argument('-i', type=str, help='database name or folder of text files', default="wiki-long")
+    parser.add_argument('-o', type=str, help='output csv file', default="precision_calibration.csv")
+    parser.add_argument('-model-name', type=str, default='gpt2')
+    parser.add_argument('-n', type=int, help='number of reference documents', default=100)
+    parser.add_argument('-context-policy', type=str, default=None)
+    parser.add_argument('--human', action='store_true')
+    args = parser.parse_args()
+
+    author = 'human' if args.human else 'machine'
+    lo_data_loaders = {'wiki-long': get_text_from_wiki_long_dataset,
+                       'news-long': get_text_from_chatgpt_news_long_dataset,
+                       'abstracts': get_text_from_chatgpt_abstracts_dataset}
+    if args.i in lo_data_loaders:
+        ds = lo_data_loaders[args.i](text_field=f'{author}_text').select(range(args.n))
+    else:
+        ds = list(get_text_data_from_files(args.i, extension='*.txt'))[:args.n]
+
+    sentence_parser = PrepareSentenceContext(context_policy=args.context_policy)
+    lo_chunks = [sentence_parser(d['text']) for d in ds]
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    model = AutoModelForCausalLM.from_pretrained(args.model_name)  # CPU, as int8 requires
+
+    df = calibration_report(model, tokenizer, lo_chunks)
+    print(tabulate(df, headers='keys', tablefmt='psql', showindex=False, floatfmt='.4g'))
+    df.to_csv(args.o, index=False)
+    logging.info(f"Saved calibration report to {args.o}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Run the detector as a long-running HTTP service (see src/DetectionService.py).
+
+The language model, the null model and the sentence parser are loaded once at startup from the
+configuration file. Documents are sent as JSON to POST /detect; GET /health and GET /metrics report
+status and latency histograms.
+
+Example:
+    python detection_service.py -conf conf.yml --context -port 8080
+    curl -s -X POST localhost:8080/detect -d '{"text": "Some text. And more text."}'
+"""
+
+import argparse
+import logging
+import yaml
+from src.DetectionService import DetectionService
+from text_detect import load_detector
+
+logging.basicConfig(level=logging.INFO)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the detector over HTTP')
+    parser.add_argument('-conf', type=str, help='configurations file', default="conf.yml")
+    parser.add_argument('--context', action='store_true')
+    parser.add_argument('-model-name', type=str, default=None,
+                        help='language model name or local path (overrides the configuration)')
+    parser.add_argument('-host', type=str, default='127.0.0.1')
+    parser.add_argument('-port', type=int, default=8080)
+    parser.add_argument('-socket', type=str, default=None, help='serve on this Unix socket instead of TCP')
+    parser.add_argument('-max-batch-size', type=int, default=64, help='sentences per micro-batch')
+    parser.add_argument('-max-wait-ms', type=float, default=10,
+                        help='maximal time a request waits for others to join its micro-batch')
+    parser.add_argument('-max-in-flight', type=int, default=256,
+                        help='documents processed concurrently; more requests are refused with 503')
+    args = parser.parse_args()
+
+    with open(args.conf, "r") as stream:
+        params = yaml.safe_load(stream)
+    if args.model_name:
+        params['language-model-name'] = args.model_name
+
+    detector, sentence_parser = load_detector(params, args.context)
+    service = DetectionService(detector, sentence_parser, max_batch_size=args.max_batch_size,
+                               max_wait_ms=args.max_wait_ms, max_in_flight=args.max_in_flight)
+    service.run(host=args.host, port=args.port, unix_socket=args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,9 +17,16 @@ from transformers import AutoTokenizer, AutoModelForCausalLM
 import logging
 import os
 import argparse
+import csv
+import multiprocessing
 import traceback
-from src.PerplexityEvaluator import PerplexityEvaluator
-from src.PrepareSentenceContext import PrepareSentenceContext
+from src.PerplexityEvaluator import PerplexityEvaluator, PRECISIONS
+from src.PrepareSentenceContext import PrepareSentenceContext, LENGTH_UNITS
+from src.ResponseCache import ResponseCache, CachedPerplexityEvaluator
+from src.ResponseWriter import ResponseWriter
+from src.SentencePipeline import SentencePipeline
+from src.SentenceScheduler import SentenceScheduler
+from src.model_registry import registry
 from src.dataset_loaders import (get_text_from_chatgpt_news_dataset,
                                  get_text_from_wiki_dataset,
                                  get_text_from_wiki_long_dataset,
@@ -30,17 +37,14 @@ from glob import glob
 
 logging.basicConfig(level=logging.INFO)
 
-def process_text(text, atomic_detector, parser):
-    chunks = parser(text)
-
+def _chunk_records(chunks, all_responses):
     ids = []
     lengths = []
     responses = []
     context_lengths = []
     chunk_num = 0
-    for chunk, context, length in zip(chunks['text'], chunks['context'], chunks['length']):
+    for res, context, length in zip(all_responses, chunks['context'], chunks['length']):
         chunk_num += 1
-        res = atomic_detector(chunk, context)
         ids.append(chunk_num)
         lengths.append(length)
         responses.append(res)
@@ -52,42 +56,224 @@ def process_text(text, atomic_detector, parser):
     return dict(chunk_ids=ids, responses=responses, lengths=lengths, context_lengths=context_lengths)
 
 
-def iterate_over_texts(dataset, atomic_detector, parser, output_file):
-    ids = []
-    lengths = []
-    responses = []
-    context_lengths = []
-    names = []
-    for d in tqdm(dataset):
-        name = d['id']
-        try:
-            r = process_text(d['text'], atomic_detector, parser)
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            print(f"Error processing {name}")
-            print(f"Error details: {e}")
-            traceback.print_exc()
-            continue
-
-        ids += r['chunk_ids']
-        responses += r['responses']
-        lengths += r['lengths']
-        context_lengths += r['context_lengths']
-        names += [name] * len(r['chunk_ids'])
-
-        df = pd.DataFrame({'num': ids, 'length': lengths, 
-                           'response': responses, 'context_length': context_lengths,
-                           'name': names})
-
-        save_path = "Responses/"+output_file
-        logging.info(f"Saving results to {save_path}")
-        df.to_csv(save_path)
+def process_text(text, atomic_detector, parser):
+    chunks = parser(text)
+
+    if 'spans' in chunks:  # 'document' context policy
+        all_responses = atomic_detector.log_perplexity_document(chunks['document'], chunks['spans'])
+    elif hasattr(atomic_detector, 'log_perplexity_batch'):
+        all_responses = atomic_detector.log_perplexity_batch(chunks['text'], chunks['context'],
+                                                             text_ids=chunks.get('token_ids'))
+    else:
+        all_responses = [atomic_detector(chunk, context) for chunk, context in zip(chunks['text'], chunks['context'])]
+    return _chunk_records(chunks, all_responses)
+
+
+def process_texts(texts, atomic_detector, parser):
+    """
+    Like process_text, but scores the sentences of all texts in a single call to
+    atomic_detector.log_perplexity_batch, so that a SentenceScheduler can batch
+    sentences of similar lengths from different texts. Returns one record per text.
+    """
+    lo_chunks = list(parser.parse_many(texts))
+    pooled = [chunks for chunks in lo_chunks if 'spans' not in chunks]
+    texts = [t for chunks in pooled for t in chunks['text']]
+    contexts = [c for chunks in pooled for c in chunks['context']]
+    text_ids = None
+    if all(chunks.get('token_ids') is not None for chunks in pooled):
+        text_ids = [ids for chunks in pooled for ids in chunks['token_ids']]
+    responses = iter(atomic_detector.log_perplexity_batch(texts, contexts, text_ids=text_ids))
+
+    records = []
+    for chunks in lo_chunks:
+        if 'spans' in chunks:  # 'document' context policy
+            all_responses = atomic_detector.log_perplexity_document(chunks['document'], chunks['spans'])
+        else:
+            all_responses = [next(responses) for _ in chunks['text']]
+        records.append(_chunk_records(chunks, all_responses))
+    return records
+
+
+def _iterate_pipelined(dataset, atomic_detector, parser, writer, pipeline_options):
+    pipeline = SentencePipeline(parser, atomic_detector, **pipeline_options)
+    todo = (d for d in dataset if str(d['id']) not in writer.committed)
+    try:
+        for d, chunks, responses in tqdm(pipeline(todo)):
+            if chunks is not None:
+                writer.write(_chunk_records(chunks, responses), d['id'])
+    except KeyboardInterrupt:
+        pass
+
+
+def _write_group(group, atomic_detector, parser, writer):
+    """
+    Score the documents of :group: together (see process_texts); if that fails, score them one by one
+    so that only the failing documents are skipped
+    """
+    try:
+        records = process_texts([d['text'] for d in group], atomic_detector, parser)
+    except Exception:
+        records = []
+        for d in group:
+            try:
+                records.append(process_text(d['text'], atomic_detector, parser))
+            except Exception as e:
+                print(f"Error processing {d['id']}")
+                print(f"Error details: {e}")
+                traceback.print_exc()
+                records.append(None)
+    for d, r in zip(group, records):
+        if r is not None:
+            writer.write(r, d['id'])
+
+
+def iterate_over_texts(dataset, atomic_detector, parser, output_file, output_format=None, resume=False,
+                       pipeline_options=None, docs_per_batch=1):
+    """
+    Evaluate responses of all texts in the dataset and append them to Responses/:output_file:
+
+    :param resume:  if the output file exists, keep the documents it has already committed and only
+    process the rest of the dataset (csv output only)
+    :param pipeline_options:  if given, parsing, context building and scoring run concurrently in a
+    SentencePipeline constructed with these keyword arguments
+    :param docs_per_batch:  number of documents whose sentences are scored together (see process_texts);
+    use with a SentenceScheduler as :atomic_detector:
+    """
+    save_path = "Responses/"+output_file
+    logging.info(f"Saving results to {save_path}")
+    with ResponseWriter(save_path, format=output_format, resume=resume) as writer:
+        if pipeline_options is not None:
+            _iterate_pipelined(dataset, atomic_detector, parser, writer, pipeline_options)
+            return
+
+        if docs_per_batch > 1:
+            group = []
+            try:
+                for d in tqdm(dataset):
+                    if str(d['id']) in writer.committed:
+                        continue
+                    group.append(d)
+                    if len(group) == docs_per_batch:
+                        _write_group(group, atomic_detector, parser, writer)
+                        group = []
+                _write_group(group, atomic_detector, parser, writer)
+            except KeyboardInterrupt:
+                pass
+            return
+
+        for d in tqdm(dataset):
+            name = d['id']
+            if str(name) in writer.committed:
+                continue
+            try:
+                r = process_text(d['text'], atomic_detector, parser)
+            except KeyboardInterrupt:
+                break
+            except Exception as e:
+                print(f"Error processing {name}")
+                print(f"Error details: {e}")
+                traceback.print_exc()
+                continue
+
+            writer.write(r, name)
 
         # logging.info(f"Saving results to {output_file}")
         # df.to_csv(output_file)
 
 
+def _shard(dataset, shard, num_shards):
+    """
+    Contiguous block :shard: out of :num_shards: blocks of the dataset
+    """
+    size = len(dataset)
+    start = shard * size // num_shards
+    end = (shard + 1) * size // num_shards
+    if hasattr(dataset, 'select'):
+        return dataset.select(range(start, end))
+    return dataset[start:end]
+
+
+def _run_shard(dataset, atomic_detector, parser, output_file, output_format, resume, threads_per_worker,
+               pipeline_options, docs_per_batch):
+    torch.set_num_threads(threads_per_worker)
+    iterate_over_texts(dataset, atomic_detector, parser, output_file, output_format=output_format,
+                       resume=resume, pipeline_options=pipeline_options, docs_per_batch=docs_per_batch)
+
+
+def _merge_csv_shards(shard_paths, save_path):
+    """
+    Concatenate shard outputs in shard order, renumbering the running index column
+    """
+    with open(save_path, 'w', newline='') as out:
+        writer = csv.writer(out)
+        index = 0
+        for i, shard_path in enumerate(shard_paths):
+            with open(shard_path, 'rt', newline='') as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                if i == 0:
+                    writer.writerow(header)
+                for row in reader:
+                    writer.writerow([index] + row[1:])
+                    index += 1
+
+
+def iterate_over_texts_parallel(dataset, atomic_detector, parser, output_file, num_workers=2,
+                                threads_per_worker=1, output_format=None, resume=False, pipeline_options=None,
+                                docs_per_batch=1):
+    """
+    Like iterate_over_texts, with the dataset split into :num_workers: contiguous shards that are
+    processed by forked worker processes. Workers share the already loaded model (copy-on-write) and use
+    :threads_per_worker: torch intra-op threads each, so num_workers * threads_per_worker should not
+    exceed the number of cores. Every shard is written to its own file (and can be resumed); shards are
+    then merged in order, so the output is the same as that of a sequential run, and removed.
+
+    Forking after CUDA or MPS has been initialized is unsafe, so the model must be on the CPU.
+    """
+    model = getattr(atomic_detector, 'model', None)
+    device = getattr(model, 'device', None)
+    if device is not None and torch.device(device).type != 'cpu':
+        raise ValueError(f"Parallel workers are forked and require a model on the CPU, not {device}")
+    if not hasattr(dataset, 'select'):
+        dataset = list(dataset)
+    if output_format is None:
+        output_format = 'parquet' if output_file.endswith('.parquet') else 'csv'
+    shard_files = [f"{output_file}.shard{k}-of-{num_workers}" for k in range(num_workers)]
+
+    # load auxiliary models the policy needs before forking, so that workers share them
+    policy = getattr(parser, 'context_policy', None)
+    if policy in ['summary', 'summary-and-previous-sentence']:
+        registry.get('summarizer')
+    elif policy == 'QA':
+        registry.get('question_generator')
+
+    ctx = multiprocessing.get_context('fork')  # share model weights with the workers
+    workers = []
+    for k in range(num_workers):
+        w = ctx.Process(target=_run_shard,
+                        args=(_shard(dataset, k, num_workers), atomic_detector, parser, shard_files[k],
+                              output_format, resume, threads_per_worker, pipeline_options, docs_per_batch))
+        w.start()
+        workers.append(w)
+    for w in workers:
+        w.join()
+    failed = [k for k, w in enumerate(workers) if w.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Workers of shards {failed} failed; rerun with resume=True to complete them")
+
+    save_path = "Responses/" + output_file
+    shard_paths = ["Responses/" + f for f in shard_files]
+    if output_format == 'csv':
+        _merge_csv_shards(shard_paths, save_path)
+    else:
+        pd.concat([pd.read_parquet(f) for f in shard_paths], ignore_index=True).to_parquet(save_path)
+    logging.info(f"Merged {num_workers} shards into {save_path}")
+    for shard_path in shard_paths:
+        for path in [shard_path, shard_path + '.ckpt']:
+            if os.path.exists(path):
+                os.remove(path)
+
+
 def get_text_data_from_files(path, extension='*.txt'):
     logging.info(f"Reading text data from {path}...")
     lo_fns = glob(path + extension)
@@ -177,9 +363,40 @@ def main():
     parser.add_argument('-o', type=str, help='output folder', default="./results")
     parser.add_argument('-model-name', type=str, default='gpt2')
     parser.add_argument('--context', action='store_true')
+    parser.add_argument('--document', action='store_true',
+                        help="use the 'document' context policy: score all sentences in one pass")
     parser.add_argument('--human', action='store_true')
     parser.add_argument('--shuffle', action='store_true')
     parser.add_argument('--describe-datasets', action='store_true')
+    parser.add_argument('--precision', type=str, choices=PRECISIONS, default='fp32',
+                        help='execution precision of the language model (int8 is CPU only)')
+    parser.add_argument('-output-format', type=str, choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--resume', action='store_true', help='continue an interrupted run (csv output)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='run parsing, context building and scoring as concurrent stages')
+    parser.add_argument('-parse-processes', type=int, default=1, help='spaCy processes of the parse stage')
+    parser.add_argument('-context-workers', type=int, default=1, help='threads of the context stage')
+    parser.add_argument('-scoring-workers', type=int, default=1, help='threads of the scoring stage')
+    parser.add_argument('-queue-size', type=int, default=8, help='size of the queues between stages')
+    parser.add_argument('-workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('-threads-per-worker', type=int, default=None,
+                        help='torch intra-op threads per worker (default: cores / workers)')
+    parser.add_argument('-cache', type=str, default=None,
+                        help='path of an SQLite response cache shared by runs and worker processes')
+    parser.add_argument('--reuse-prefix', action='store_true',
+                        help='reuse past_key_values of context prefixes shared by sentences')
+    parser.add_argument('-context-budget', type=int, default=None,
+                        help='maximal number of context tokens; longer contexts are truncated from the left')
+    parser.add_argument('--sliding-window', action='store_true',
+                        help="score sentences longer than the model's position limit in strided windows")
+    parser.add_argument('-window-stride', type=int, default=None, help='stride of the sliding windows')
+    parser.add_argument('-length-unit', type=str, choices=LENGTH_UNITS, default='spacy',
+                        help="unit of the 'length' column: spaCy tokens or tokens of the language model")
+    parser.add_argument('-max-batch-tokens', type=int, default=None,
+                        help='score sentences of many documents together in length-bucketed batches of at most '
+                             'this many tokens, padding included (SentenceScheduler)')
+    parser.add_argument('-docs-per-batch', type=int, default=64,
+                        help='documents whose sentences are scored together with -max-batch-tokens')
 
     args = parser.parse_args()
 
@@ -200,7 +417,9 @@ def main():
 
     lm_name = args.model_name
 
-    if args.context:
+    if args.document:
+        context_policy = 'document'
+    elif args.context:
         context_policy = 'previous_sentence'
     else:
         context_policy = 'no_context'
@@ -215,6 +434,8 @@ def main():
         device = 'cuda'
     else:
         device = 'cpu'
+    if args.workers > 1 and device != 'cpu':
+        parser.error(f"-workers > 1 forks the process, which is only supported on the CPU (found {device})")
     model.to(device)
 
     #To delete
@@ -248,13 +469,38 @@ def main():
         lm_name_str = lm_name.split("/")[-1]
     else:
         lm_name_str = lm_name
-    out_filename = f"{args.o}/{lm_name_str}_{context_policy}_{dataset_name}_{author}.csv"
+    out_filename = f"{args.o}/{lm_name_str}_{context_policy}_{dataset_name}_{author}.{args.output_format}"
     logging.info(f"Iterating over texts...")
-    sentence_detector = PerplexityEvaluator(model, tokenizer)
-    parser = PrepareSentenceContext(context_policy=context_policy)
+    sentence_detector = PerplexityEvaluator(model, tokenizer, reuse_prefix=args.reuse_prefix,
+                                            precision=args.precision, context_budget=args.context_budget,
+                                            sliding_window=args.sliding_window, window_stride=args.window_stride)
+    docs_per_batch = 1
+    if args.max_batch_tokens:
+        sentence_detector = SentenceScheduler(sentence_detector, max_tokens=args.max_batch_tokens)
+        docs_per_batch = args.docs_per_batch
+    if args.cache:
+        sentence_detector = CachedPerplexityEvaluator(sentence_detector, ResponseCache(args.cache))
+    parser = PrepareSentenceContext(context_policy=context_policy, length_unit=args.length_unit, tokenizer=tokenizer)
 
     print(f"Saving results to {out_filename}")
-    iterate_over_texts(ds, sentence_detector, parser, output_file=out_filename)
+    pipeline_options = None
+    if args.pipeline:
+        pipeline_options = dict(parse_processes=args.parse_processes, context_workers=args.context_workers,
+                                scoring_workers=args.scoring_workers, queue_size=args.queue_size)
+
+    if args.workers > 1:
+        threads_per_worker = args.threads_per_worker or max(os.cpu_count() // args.workers, 1)
+        iterate_over_texts_parallel(ds, sentence_detector, parser, output_file=out_filename,
+                                    num_workers=args.workers, threads_per_worker=threads_per_worker,
+                                    output_format=args.output_format, resume=args.resume,
+                                    pipeline_options=pipeline_options, docs_per_batch=docs_per_batch)
+    else:
+        iterate_over_texts(ds, sentence_detector, parser, output_file=out_filename, resume=args.resume,
+                           pipeline_options=pipeline_options, docs_per_batch=docs_per_batch)
+    if args.cache:
+        logging.info(f"Response cache statistics: {sentence_detector.cache.stats}")
+    if args.max_batch_tokens:
+        logging.info(f"Padding ratio of the scheduled batches: {sentence_detector.padding_ratio:.3f}")
 
 
 if __name__ == '__main__':
@@ -3,6 +3,7 @@ import pandas as pd
 from multitest import MultiTest
 from tqdm import tqdm
 import logging
+from src.hc_stats import hc_fisher, hc_fisher_many
 
 
 def truncate_to_max_no_tokens(text, max_no_tokens):
@@ -12,7 +13,7 @@ def truncate_to_max_no_tokens(text, max_no_tokens):
 class DetectLM(object):
     def __init__(self, sentence_detection_function, survival_function_per_length,
                  min_len=1, max_len=100, HC_type="stbl",
-                 length_limit_policy='truncate', ignore_first_sentence=False):
+                 length_limit_policy='truncate', ignore_first_sentence=False, parser=None):
         """
         Test for the presence of sentences of irregular origin as reflected by the
         sentence_detection_function. This function can be assisted by a context, which we
@@ -23,12 +24,17 @@ class DetectLM(object):
         :param survival_function_per_length:  survival_function_per_length(l, x) is the probability of the language
         model to produce a sentence of log-perplexity as extreme as x or more, for an input sentence s
         of length l or a for an input pair (s, c) with sentence s of length l under context c.
+        If it has a method pvalues(lengths, responses) (e.g., a PValueTable), P-values of all sentences of a
+        document are computed by a single call to it.
         :param length_limit_policy: what should we do if a sentence is too long. Options are:
             'truncate':  truncate sentence to the maximal length :max_len
              'ignore':  do not evaluate the response and P-value for this sentence
              'max_available':  use the log-perplexity function of the maximal available length
         :param ignore_first_sentence:  whether to ignore the first sentence in the document or not. Useful when assuming
         context of the form previous sentence.
+        :param parser:  PrepareSentenceContext whose length unit measures sentences passed without lengths;
+        whitespace-separated words if None. Use the parser whose output is tested, so that lengths
+        are in the unit of the null survival function.
         """
 
         self.survival_function_per_length = survival_function_per_length
@@ -38,81 +44,174 @@ class DetectLM(object):
         self.length_limit_policy = length_limit_policy
         self.ignore_first_sentence = ignore_first_sentence
         self.HC_stbl = True if HC_type == 'stbl' else False
+        self.parser = parser
 
     def _logperp(self, sent: str, context=None) -> float:
         return float(self.sentence_detector(sent, context))
 
+    def logperp_batch(self, sents: list, contexts: list, text_ids=None) -> tuple:
+        """
+        Log-perplexity of all (sentence, context) pairs of a document. Uses the batched
+        path of the sentence detection function when it has one.
+
+        :param text_ids:  input ids of the sentences, if already tokenized (see prepare_sentences); only
+            used by the batched path
+        :return:  (list of log-perplexities, list of comments of the sentence detection function on
+            truncated contexts or sentences, None where there is nothing to record)
+        """
+        if hasattr(self.sentence_detector, 'budget_comments'):  # PerplexityEvaluator
+            responses, notes = self.sentence_detector.log_perplexity_batch(sents, contexts, return_comments=True,
+                                                                           text_ids=text_ids)
+            return [float(r) for r in responses], notes
+        if hasattr(self.sentence_detector, 'log_perplexity_batch'):
+            responses = self.sentence_detector.log_perplexity_batch(sents, contexts, text_ids=text_ids)
+            return [float(r) for r in responses], [None] * len(sents)
+        return [self._logperp(sent, ctx) for sent, ctx in tqdm(zip(sents, contexts))], [None] * len(sents)
+
     def _test_sentence(self, sentence: str, context=None):
         return self._logperp(sentence, context)
     
     def _get_length(self, sentence: str):
+        if self.parser is not None:
+            return len(self.parser.token_ends([sentence])[0])
         return len(sentence.split())
 
-    def _test_response(self, response: float, length: int):
-        """
-        Returns:
-          response:  sentence log-perplexity
-          pval:      P-value of atomic log-perplexity test
-        """
-        if self.min_len <= length:
-            comment = "OK"
-            if length > self.max_len:  # in case length exceeds specifications...
-                if self.length_limit_policy == 'truncate':
-                    length = self.max_len
-                    comment = f"truncated to {self.max_len} tokens"
-                elif self.length_limit_policy == 'ignore':
-                    comment = "ignored (above maximum limit)"
-                    return np.nan, np.nan, comment
-                elif self.length_limit_policy == 'max_available':
-                    comment = "exceeding length limit; resorted to max-available length"
-                    length = self.max_len
-            pval = self.survival_function_per_length(length, response)
-            assert pval >= 0, "Negative P-value. Something is wrong."
-            return dict(response=response, 
-                        pvalue=pval, 
-                        length=length,
-                        comment=comment)
-        else:
-            comment = "ignored (below minimal length)"
-            return dict(response=response, 
-                        pvalue=np.nan, 
-                        length=length,
-                        comment=comment)
-
-    def _get_pvals(self, responses: list, lengths: list) -> tuple:
-        pvals = []
-        comments = []
-        for response, length in zip(responses, lengths):
-            r = self._test_response(response, length)
-            pvals.append(float(r['pvalue']))
-            comments.append(r['comment'])
-        return pvals, comments
+    def _apply_length_policy(self, lengths):
+        """
+        Min/max length handling of all sentences of a document. Sentences shorter than min_len are not
+        tested; sentences longer than max_len are tested with length max_len ('truncate', 'max_available')
+        or not tested ('ignore').
+
+        :return:  (lengths to test with, mask of tested sentences, comments)
+        """
+        lengths = np.asarray(lengths)
+        comments = np.full(len(lengths), "OK", dtype=object)
+        test_lengths = lengths.copy()
+        tested = self.min_len <= lengths
+
+        too_long = tested & (lengths > self.max_len)
+        if self.length_limit_policy == 'truncate':
+            test_lengths[too_long] = self.max_len
+            comments[too_long] = f"truncated to {self.max_len} tokens"
+        elif self.length_limit_policy == 'ignore':
+            comments[too_long] = "ignored (above maximum limit)"
+            tested &= ~too_long
+        elif self.length_limit_policy == 'max_available':
+            test_lengths[too_long] = self.max_len
+            comments[too_long] = "exceeding length limit; resorted to max-available length"
+        comments[lengths < self.min_len] = "ignored (below minimal length)"
+        return test_lengths, tested, comments
 
+    @staticmethod
+    def _add_notes(comments, notes):
+        if notes is None:
+            return
+        for i, note in enumerate(notes):
+            if note:
+                comments[i] = f"{comments[i]}; {note}"
+
+    def _survival(self, lengths, responses):
+        """
+        P-values of arrays of (length, response) pairs
+        """
+        func = self.survival_function_per_length
+        if hasattr(func, 'pvalues'):  # PValueTable, NullModel
+            return func.pvalues(lengths, responses)
+        if hasattr(func, 'spline'):  # output of fit_per_length_survival_function
+            return np.exp(-func.spline(lengths, responses, grid=False))
+        return np.array([np.asarray(func(l, x)).item() for l, x in zip(lengths, responses)], dtype=np.float64)
+
+    def _get_pvals(self, responses, lengths, notes=None) -> tuple:
+        """
+        P-values and comments of all sentences of a document
 
-    def _get_responses(self, sentences: list, contexts: list) -> list:
+        :param notes:  comments of the scoring (see logperp_batch), appended to the comments
+        :return:  (array of P-values, array of comments)
+        """
+        responses = np.asarray(responses, dtype=np.float64)
+        test_lengths, tested, comments = self._apply_length_policy(lengths)
+        self._add_notes(comments, notes)
+        pvals = np.full(len(responses), np.nan)
+        if tested.any():
+            pvals[tested] = self._survival(test_lengths[tested], responses[tested])
+        assert not (pvals < 0).any(), "Negative P-value. Something is wrong."
+        return pvals, comments
+
+    def _get_responses(self, sentences: list, contexts: list, document=None, spans=None,
+                       lengths=None, token_ends=None, token_ids=None) -> list:
         """
         Compute response and length of a text sentence 
+
+        :return:  (array of responses, array of lengths, comments of the scoring or None)
+
+        If :document: and :spans: are given (see the 'document' context policy), all responses
+        are obtained from a single pass over the document and sentences are not truncated.
         """
         assert len(sentences) == len(contexts)
 
-        responses = []
-        lengths = []
-        for sent, ctx in tqdm(zip(sentences, contexts)):
-            length = self._get_length(sent)
-            if self.length_limit_policy == 'truncate':
-                sent = truncate_to_max_no_tokens(sent, self.max_len)
-            responses.append(self._test_sentence(sent, ctx))
-            lengths.append(length)
-        return responses, lengths
+        if document is not None:
+            assert len(spans) == len(sentences)
+            responses = np.asarray(self.sentence_detector.log_perplexity_document(document, spans), dtype=np.float64)
+            if lengths is None:
+                lengths = [self._get_length(sent) for sent in sentences]
+            return responses, np.asarray(lengths, dtype=np.int64), None
 
-    def get_pvals(self, sentences: list, contexts: list) -> tuple:
+        truncated, lengths, text_ids = self.prepare_sentences(sentences, lengths=lengths, token_ends=token_ends,
+                                                              token_ids=token_ids)
+        responses, notes = self.logperp_batch(truncated, contexts, text_ids=text_ids)
+        return np.asarray(responses, dtype=np.float64), lengths, notes
+
+    def prepare_sentences(self, sentences: list, lengths=None, token_ends=None, token_ids=None) -> tuple:
+        """
+        :param lengths:  lengths of the sentences in the unit of the null survival function ('length' of
+            the output of PrepareSentenceContext). If not given, they are measured by self.parser
+            (whitespace-separated words without a parser).
+        :param token_ends:  character offsets at which the length units of every sentence end
+            ('token_ends' of the output of PrepareSentenceContext). Sentences are then truncated to
+            :max_len: units of the same unit; otherwise to :max_len: words.
+        :param token_ids:  input ids of the sentences ('token_ids' of the output of PrepareSentenceContext
+            with the 'bpe' length unit). They are truncated with the sentences and passed to the scorer,
+            which then does not tokenize the sentences again.
+        :return:  (sentences as they are scored, array of their lengths before truncation, input ids of
+            the scored sentences or None)
+        """
+        if lengths is None:
+            if self.parser is not None:
+                token_ends, token_ids = self.parser.token_ends(list(sentences), return_ids=True)
+                lengths = [len(ends) for ends in token_ends]
+            else:
+                lengths = [self._get_length(sent) for sent in sentences]
+        lengths = np.asarray(lengths, dtype=np.int64)
+        # ids are truncated at the unit boundaries, so they are only used together with them
+        text_ids = None if token_ids is None or token_ends is None else [list(ids) for ids in token_ids]
+        if self.length_limit_policy != 'truncate':
+            return list(sentences), lengths, text_ids
+        truncated = []
+        for i, sent in enumerate(sentences):
+            if lengths[i] > self.max_len:
+                if token_ends is not None:
+                    sent = sent[:token_ends[i][self.max_len - 1]]
+                else:
+                    sent = truncate_to_max_no_tokens(sent, self.max_len)
+                if text_ids is not None:
+                    # special tokens (e.g. BOS) are not length units; those of causal LMs lead the ids
+                    num_special = len(text_ids[i]) - len(token_ends[i])
+                    text_ids[i] = text_ids[i][:num_special + self.max_len]
+            truncated.append(sent)
+        return truncated, lengths, text_ids
+
+    def get_pvals(self, sentences: list, contexts: list, document=None, spans=None,
+                  lengths=None, token_ends=None, token_ids=None) -> tuple:
         """
         Log-perplexity test of every (sentence, context) pair
+
+        :return:  arrays of P-values, responses and comments
         """
         assert len(sentences) == len(contexts)
 
-        responses, lengths = self._get_responses(sentences, contexts)
-        pvals, comments = self._get_pvals(responses, lengths)
+        responses, lengths, notes = self._get_responses(sentences, contexts, document=document, spans=spans,
+                                                        lengths=lengths, token_ends=token_ends, token_ids=token_ids)
+        pvals, comments = self._get_pvals(responses, lengths, notes)
         
         return pvals, responses, comments
 
@@ -181,35 +280,160 @@ class DetectLM(object):
         mt = MultiTest(pvals, stbl=self.HC_stbl)
         return dict(zip(['Fn', 'pvalue'], mt.fisher()))
 
-    def _test_chunked_doc(self, lo_chunks: list, lo_contexts: list) -> tuple:
-        pvals, responses, comments = self.get_pvals(lo_chunks, lo_contexts)
-        if self.ignore_first_sentence:
+    def _test_arrays(self, pvals, comments):
+        """
+        HC and Fisher's tests of the P-values of a document
+
+        :return:  dictionary with HC, HC threshold and Fisher's statistic and P-value (nan when no
+            sentence was tested)
+        """
+        if self.ignore_first_sentence and len(pvals) > 0:
             pvals[0] = np.nan
             logging.info('Ignoring the first sentence.')
             comments[0] = "ignored (first sentence)"
-        
-        df = pd.DataFrame({'sentence': lo_chunks, 'response': responses, 'pvalue': pvals,
-                           'context': lo_contexts, 'comment': comments},
-                          index=range(len(lo_chunks)))
-        df_test = df[~df.pvalue.isna()]
-        if df_test.empty:
+        valid = pvals[~np.isnan(pvals)]
+        if len(valid) == 0:
             logging.warning('No valid chunks to test.')
-            return None, df
-        return MultiTest(df_test.pvalue, stbl=self.HC_stbl), df
-
-    def test_chunked_doc(self, lo_chunks: list, lo_contexts: list, dashboard=False) -> dict:
-        mt, df = self._test_chunked_doc(lo_chunks, lo_contexts)
-        if mt is None:
-            hc = np.nan
-            fisher = (np.nan, np.nan)
-            df['mask'] = pd.NA
-        else:
-            hc, hct = mt.hc(gamma=0.4)
-            fisher = mt.fisher()
-            df['mask'] = df['pvalue'] <= hct
+            return dict(HC=np.nan, HC_threshold=np.nan, fisher=np.nan, fisher_pvalue=np.nan)
+        hc, hct, fisher, fisher_pvalue = hc_fisher(valid, gamma=0.4, stbl=self.HC_stbl)
+        return dict(HC=hc, HC_threshold=hct, fisher=fisher, fisher_pvalue=fisher_pvalue)
+
+    def test_chunked_doc(self, lo_chunks: list, lo_contexts: list, dashboard=False,
+                         document=None, spans=None, return_df=True, lengths=None, token_ends=None,
+                         token_ids=None) -> dict:
+        """
+        :param return_df:  return the per-sentence results as a DataFrame under 'sentences'. Otherwise,
+            they are returned as arrays under 'response', 'pvalue', 'length', 'comment' and 'mask'.
+        :param lengths:, :token_ends:, :token_ids:  sentence lengths, unit boundaries and input ids from
+            PrepareSentenceContext (see prepare_sentences)
+        """
+        assert len(lo_chunks) == len(lo_contexts)
+        responses, lengths, notes = self._get_responses(lo_chunks, lo_contexts, document=document, spans=spans,
+                                                        lengths=lengths, token_ends=token_ends, token_ids=token_ids)
+        res = self.test_responses(responses, lengths, notes)
+        pvals = res['pvalue']
         if dashboard:
-            mt.hc_dashboard(gamma=0.4)
-        return dict(sentences=df, HC=hc, fisher=fisher[0], fisher_pvalue=fisher[1])
+            MultiTest(pvals[~np.isnan(pvals)], stbl=self.HC_stbl).hc_dashboard(gamma=0.4)
+
+        if return_df:
+            df = pd.DataFrame({'sentence': lo_chunks, 'response': responses, 'pvalue': pvals,
+                               'length': lengths, 'context': lo_contexts, 'comment': res['comment']},
+                              index=range(len(lo_chunks)))
+            df['mask'] = res['mask'] if res['mask'] is not None else pd.NA
+            return dict(sentences=df, HC=res['HC'], fisher=res['fisher'], fisher_pvalue=res['fisher_pvalue'])
+        return res
+
+    def test_responses(self, responses, lengths, notes=None) -> dict:
+        """
+        Test a document whose sentence responses were already evaluated (e.g., in a batch shared with
+        other documents)
+
+        :param responses:  log-perplexities of the sentences of the document
+        :param lengths:  lengths of the sentences
+        :param notes:  comments of the scoring (see logperp_batch)
+        :return:  dictionary with HC, HC_threshold, fisher, fisher_pvalue and the arrays response, pvalue,
+            length, comment and mask (mask is None when no sentence was tested)
+        """
+        responses = np.asarray(responses, dtype=np.float64)
+        lengths = np.asarray(lengths)
+        pvals, comments = self._get_pvals(responses, lengths, notes)
+        res = self._test_arrays(pvals, comments)
+        tested = not np.isnan(res['HC_threshold'])
+        mask = pvals <= res['HC_threshold'] if tested else None
+        return dict(res, response=responses, pvalue=pvals, length=lengths, comment=comments, mask=mask)
+
+    def __call__(self, lo_chunks: list, lo_contexts: list, dashboard=False, document=None, spans=None,
+                 return_df=True, lengths=None, token_ends=None, token_ids=None) -> dict:
+        return self.test_chunked_doc(lo_chunks, lo_contexts, dashboard=dashboard, document=document, spans=spans,
+                                     return_df=return_df, lengths=lengths, token_ends=token_ends,
+                                     token_ids=token_ids)
+
+    def detect_many(self, documents, return_sentences=False, docs_per_batch=64) -> dict:
+        """
+        Test many documents at once
+
+        The sentences of :docs_per_batch: documents are scored together through the batched path of
+        the sentence detection function (in length-bucketed batches if it is a SentenceScheduler); P-values, HC, HC thresholds and Fisher's statistics of all
+        documents are then computed on flat arrays.
+
+        :param documents:  iterable of parsed documents, i.e., dictionaries with lists 'text' and 'context'
+            (and 'document' and 'spans' under the 'document' context policy) as returned by
+            PrepareSentenceContext. Their 'length', 'token_ends' and 'token_ids' are used when present
+            (see prepare_sentences).
+        :param return_sentences:  also return the per-sentence results
+        :return:  dictionary with
+            'documents':  DataFrame with one row per document and columns HC, HC_threshold, fisher,
+                fisher_pvalue, num_sentences and num_tested (statistics are nan for documents without
+                tested sentences)
+            'sentences':  DataFrame with one row per sentence and columns doc, response, pvalue, length,
+                comment and mask (None unless :return_sentences:)
+            'offsets':  array of length (number of documents + 1); the sentences of document k are rows
+                offsets[k]:offsets[k+1] of 'sentences'
+        """
+        responses = []
+        lengths = []
+        notes = []
+        num_sentences = []
+        batch = []
+
+        def score(batch):
+            sents, contexts, ids, pending = [], [], [], []
+            for doc in batch:
+                assert len(doc['text']) == len(doc['context'])
+                num_sentences.append(len(doc['text']))
+                if doc.get('document') is not None:
+                    r, l, _ = self._get_responses(doc['text'], doc['context'], document=doc['document'],
+                                                  spans=doc['spans'], lengths=doc.get('length'))
+                    responses.append(r)
+                    notes.append([None] * len(r))
+                else:
+                    truncated, l, text_ids = self.prepare_sentences(doc['text'], lengths=doc.get('length'),
+                                                                     token_ends=doc.get('token_ends'),
+                                                                     token_ids=doc.get('token_ids'))
+                    pending.append((len(responses), len(truncated)))
+                    responses.append(None)
+                    notes.append(None)
+                    sents += truncated
+                    contexts += list(doc['context'])
+                    ids = None if ids is None or text_ids is None else ids + text_ids
+                lengths.append(l)
+            scored, scored_notes = self.logperp_batch(sents, contexts, text_ids=ids) if sents else ([], [])
+            scored = np.asarray(scored, dtype=np.float64)
+            offset = 0
+            for i, n in pending:
+                responses[i] = scored[offset:offset + n]
+                notes[i] = scored_notes[offset:offset + n]
+                offset += n
+
+        for doc in documents:
+            batch.append(doc)
+            if len(batch) == docs_per_batch:
+                score(batch)
+                batch = []
+        if batch:
+            score(batch)
+
+        offsets = np.zeros(len(num_sentences) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(num_sentences)
+        responses = np.concatenate(responses) if responses else np.zeros(0)
+        lengths = np.concatenate(lengths) if lengths else np.zeros(0, dtype=np.int64)
+
+        pvals, comments = self._get_pvals(responses, lengths, [note for n in notes for note in n])
+        if self.ignore_first_sentence:
+            firsts = offsets[:-1][np.diff(offsets) > 0]
+            pvals[firsts] = np.nan
+            comments[firsts] = "ignored (first sentence)"
+
+        hc, hct, fisher, fisher_pvalue = hc_fisher_many(pvals, offsets, gamma=0.4, stbl=self.HC_stbl)
+        doc_index = np.repeat(np.arange(len(num_sentences)), num_sentences)
+        num_tested = np.bincount(doc_index[~np.isnan(pvals)], minlength=len(num_sentences))
+        if (num_tested == 0).any():
+            logging.warning(f'No valid chunks to test in {(num_tested == 0).sum()} documents.')
+        res = pd.DataFrame(dict(HC=hc, HC_threshold=hct, fisher=fisher, fisher_pvalue=fisher_pvalue,
+                                num_sentences=np.asarray(num_sentences, dtype=np.int64), num_tested=num_tested))
 
-    def __call__(self, lo_chunks: list, lo_contexts: list, dashboard=False) -> dict:
-        return self.test_chunked_doc(lo_chunks, lo_contexts, dashboard=dashboard)
\ No newline at end of file
+        sentences = None
+        if return_sentences:
+            sentences = pd.DataFrame(dict(doc=doc_index, response=responses, pvalue=pvals, length=lengths,
+                                          comment=comments, mask=pvals <= hct[doc_index]))
+        return dict(documents=res, sentences=sentences, offsets=offsets)
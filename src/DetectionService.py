@@ -0,0 +1,313 @@
+import asyncio
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def _json_float(x):
+    x = float(x)
+    return None if np.isnan(x) else x
+
+
+class Histogram(object):
+    """
+    Histogram of observations (e.g. latencies in milliseconds) over fixed bucket upper bounds
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = np.zeros(len(self.buckets) + 1, dtype=np.int64)  # the last bucket has no upper bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[np.searchsorted(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket containing the q-quantile (the maximum for the last bucket)
+        """
+        if self.count == 0:
+            return None
+        k = int(np.searchsorted(np.cumsum(self.counts), q * self.count))
+        return self.buckets[k] if k < len(self.buckets) else self.max
+
+    def summary(self):
+        cumulative = np.cumsum(self.counts)
+        return dict(count=self.count,
+                    mean=self.total / self.count if self.count else None,
+                    max=self.max,
+                    p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99),
+                    buckets={**{f"le_{b}": int(c) for b, c in zip(self.buckets, cumulative)},
+                             'le_inf': int(cumulative[-1])})
+
+
+class MicroBatcher(object):
+    """
+    Coalesce the sentences of concurrent requests into batches evaluated by a single scoring thread
+
+    A batch is closed when it holds :max_batch_size: sentences or :max_wait_ms: after its first request
+    arrived, whichever comes first. The sentences of a request are never split between batches. While
+    a batch is evaluated, new requests wait in the queue and form the next batch.
+    """
+
+    def __init__(self, score, max_batch_size=64, max_wait_ms=10):
+        """
+        :param score:  function (sentences, contexts, text_ids=None) -> (responses, comments), e.g.
+            DetectLM.logperp_batch
+        """
+        self.score = score
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scoring')
+        self.queue = None
+        self.queued_sentences = 0
+        self.batch_sizes = Histogram(BATCH_SIZE_BUCKETS)
+        self.batch_latency = Histogram()
+
+    async def submit(self, sentences, contexts, text_ids=None):
+        """
+        :param text_ids:  input ids of the sentences, if already tokenized
+        :return:  (responses, comments) of the sentences
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.queued_sentences += len(sentences)
+        await self.queue.put((sentences, contexts, text_ids, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        while True:
+            items = [await self.queue.get()]
+            num_sentences = len(items[0][0])
+            deadline = loop.time() + self.max_wait
+            while num_sentences < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+                num_sentences += len(items[-1][0])
+            self.queued_sentences -= num_sentences
+
+            sentences = [s for item in items for s in item[0]]
+            contexts = [c for item in items for c in item[1]]
+            # ids are passed only if every request of the batch has them
+            text_ids = None if any(item[2] is None for item in items) else [i for item in items for i in item[2]]
+            start = time.perf_counter()
+            try:
+                responses, comments = await loop.run_in_executor(self.executor, self.score, sentences, contexts,
+                                                                 text_ids)
+            except Exception as e:
+                for _, _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.batch_sizes.record(num_sentences)
+            self.batch_latency.record(1000 * (time.perf_counter() - start))
+
+            offset = 0
+            for item_sentences, _, _, future in items:
+                n = len(item_sentences)
+                if not future.done():  # the request may have been cancelled
+                    future.set_result((responses[offset:offset + n], comments[offset:offset + n]))
+                offset += n
+
+    def metrics(self):
+        return dict(queued_sentences=self.queued_sentences, batch_size=self.batch_sizes.summary(),
+                    batch_latency_ms=self.batch_latency.summary())
+
+
+class DetectionService(object):
+    """
+    Long-running detection service over HTTP (TCP or a Unix socket)
+
+    The language model, the null model and the parser are loaded once (see text_detect.load_detector).
+    Documents of concurrent requests are parsed in a parsing thread and their sentences are scored in
+    micro-batches (see MicroBatcher) by a scoring thread, while the asyncio event loop serves requests.
+
+    Endpoints:
+        POST /detect  body {"text": ..., "id": optional, "sentences": optional bool (default true)}
+            returns HC, HC_threshold, fisher, fisher_pvalue and, per sentence, sentence, response, pvalue,
+            length, comment and mask (null values for untested sentences)
+        GET /health  status, model, context policy, uptime and load
+        GET /metrics  request latency histograms (ms), micro-batch size and latency histograms
+    Requests beyond :max_in_flight: concurrent documents are refused with 503.
+    """
+
+    def __init__(self, detector, parser, max_batch_size=64, max_wait_ms=10, max_in_flight=256):
+        """
+        :param detector:  DetectLM
+        :param parser:  PrepareSentenceContext
+        :param max_batch_size:  number of sentences that closes a micro-batch
+        :param max_wait_ms:  maximal time a request waits for other requests to join its micro-batch
+        :param max_in_flight:  maximal number of documents being processed
+        """
+        self.detector = detector
+        self.parser = parser
+        self.batcher = MicroBatcher(detector.logperp_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        self.parse_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='parsing')
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.started = time.time()
+        self.latency = {'detect': Histogram(), 'health': Histogram(), 'metrics': Histogram()}
+        self.status_counts = {}
+
+    async def detect(self, text, return_sentences=True):
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(self.parse_executor, self.parser, text)
+        if chunks.get('document') is not None:  # the 'document' policy scores whole documents
+            responses = await loop.run_in_executor(self.batcher.executor,
+                                                   self.detector.sentence_detector.log_perplexity_document,
+                                                   chunks['document'], chunks['spans'])
+            lengths, notes = chunks['length'], None
+        else:
+            truncated, lengths, text_ids = self.detector.prepare_sentences(chunks['text'],
+                                                                           lengths=chunks.get('length'),
+                                                                           token_ends=chunks.get('token_ends'),
+                                                                           token_ids=chunks.get('token_ids'))
+            responses, notes = await self.batcher.submit(truncated, chunks['context'], text_ids)
+        res = self.detector.test_responses(responses, lengths, notes)
+
+        out = dict(HC=_json_float(res['HC']), HC_threshold=_json_float(res['HC_threshold']),
+                   fisher=_json_float(res['fisher']), fisher_pvalue=_json_float(res['fisher_pvalue']),
+                   num_sentences=len(chunks['text']))
+        if return_sentences:
+            mask = res['mask'] if res['mask'] is not None else [None] * len(chunks['text'])
+            out['sentences'] = [dict(sentence=s, response=_json_float(r), pvalue=_json_float(p), length=int(l),
+                                     comment=c, mask=None if m is None or np.isnan(p) else bool(m))
+                                for s, r, p, l, c, m in zip(chunks['text'], res['response'], res['pvalue'],
+                                                            res['length'], res['comment'], mask)]
+        return out
+
+    def health(self):
+        model = self.detector.sentence_detector.model
+        return dict(status='ok',
+                    model=getattr(getattr(model, 'config', None), '_name_or_path', None),
+                    context_policy=self.parser.context_policy,
+                    length_unit=self.parser.length_unit,
+                    uptime_sec=time.time() - self.started,
+                    in_flight=self.in_flight,
+                    queued_sentences=self.batcher.queued_sentences)
+
+    def metrics(self):
+        return dict(requests={str(k): v for k, v in self.status_counts.items()},
+                    latency_ms={k: h.summary() for k, h in self.latency.items()},
+                    **self.batcher.metrics())
+
+    async def dispatch(self, method, path, body):
+        """
+        :return:  (HTTP status, JSON-serializable payload)
+        """
+        path = path.split('?')[0]
+        if path == '/health':
+            return (200, self.health()) if method == 'GET' else (405, dict(error='use GET'))
+        if path == '/metrics':
+            return (200, self.metrics()) if method == 'GET' else (405, dict(error='use GET'))
+        if path != '/detect':
+            return 404, dict(error=f"unknown path {path}")
+        if method != 'POST':
+            return 405, dict(error='use POST')
+        try:
+            request = json.loads(body or b'{}')
+            text = request['text']
+            if not isinstance(text, str):
+                raise TypeError("'text' must be a string")
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, dict(error=f"expected a JSON object with a 'text' string ({e})")
+        if self.in_flight >= self.max_in_flight:
+            return 503, dict(error='too many documents in flight')
+
+        self.in_flight += 1
+        try:
+            res = await self.detect(text, return_sentences=request.get('sentences', True))
+        except Exception as e:
+            logging.exception("Detection failed")
+            return 500, dict(error=str(e))
+        finally:
+            self.in_flight -= 1
+        if 'id' in request:
+            res['id'] = request['id']
+        return 200, res
+
+    async def handle(self, reader, writer):
+        """
+        Serve the HTTP/1.1 requests of a connection (kept alive unless the client closes it)
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                start = time.perf_counter()
+                status, payload = await self.dispatch(method, path, body)
+                endpoint = path.split('?')[0].strip('/')
+                if endpoint in self.latency:
+                    self.latency[endpoint].record(1000 * (time.perf_counter() - start))
+                self.status_counts[status] = self.status_counts.get(status, 0) + 1
+
+                data = json.dumps(payload).encode('utf-8')
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                writer.write((f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                              f"Content-Type: application/json\r\n"
+                              f"Content-Length: {len(data)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1') + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """
+        Start serving (port 0 picks a free port)
+
+        :return:  asyncio server
+        """
+        self._batcher_task = asyncio.create_task(self.batcher.run())
+        while self.batcher.queue is None:
+            await asyncio.sleep(0)
+        if unix_socket:
+            server = await asyncio.start_unix_server(self.handle, path=unix_socket)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        for sock in server.sockets:
+            logging.info(f"Detection service listening on {sock.getsockname()}")
+        return server
+
+    async def serve(self, host='127.0.0.1', port=8080, unix_socket=None):
+        server = await self.start(host=host, port=port, unix_socket=unix_socket)
+        async with server:
+            await server.serve_forever()
+
+    def run(self, host='127.0.0.1', port=8080, unix_socket=None):
+        try:
+            asyncio.run(self.serve(host=host, port=port, unix_socket=unix_socket))
+        except KeyboardInterrupt:
+            pass
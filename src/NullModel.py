@@ -0,0 +1,136 @@
+import json
+import logging
+import struct
+import time
+import numpy as np
+from src.fit_survival_function import fit_per_length_survival_function
+from src.PValueTable import PValueTable
+
+MAGIC = b'DLMNULL\x00'
+FORMAT_VERSION = 1
+_ALIGNMENT = 64
+_UNCHECKED = object()  # context_policy=None is a policy of its own
+
+
+class NullModelMismatch(ValueError):
+    pass
+
+
+class NullModel(object):
+    """
+    Fitted null distribution of sentence responses, saved once and loaded by detection runs
+
+    The artifact holds the survival surface compiled into a PValueTable and the settings it was fitted
+    with (language model, context policy, length unit, min/max length, number of interpolation points G,
+    ignore-first-sentence, ...). It is stored in a single binary file:
+        magic (8 bytes) | format version (uint32) | metadata length (uint64) | metadata (utf-8 JSON) |
+        padding to 64 bytes | table (float64, C order)
+    and the table is memory-mapped at load time, so loading does not depend on the size of the null data.
+
+    load() refuses an artifact fitted with a different language model, context policy or length unit than
+    the run.
+    """
+
+    def __init__(self, table, metadata):
+        """
+        :param table:  PValueTable
+        :param metadata:  dictionary of JSON-serializable settings
+        """
+        self.table = table
+        self.metadata = metadata
+
+    @classmethod
+    def fit(cls, lengths, responses, model_name, context_policy, min_length, max_length, G=101,
+            ignore_first_sentence=False, table_points=2001, length_unit='spacy', **metadata):
+        """
+        Fit the per-length survival function and compile it into a PValueTable
+
+        :param lengths:, :responses:  1-D arrays of the null data (already filtered)
+        :param G:  number of interpolation points of fit_per_length_survival_function
+        :param table_points:  number of response grid points of the PValueTable
+        :param length_unit:  unit of :lengths: (see PrepareSentenceContext)
+        :param metadata:  additional settings to record (e.g. the null data files)
+        """
+        lengths = np.asarray(lengths)
+        responses = np.asarray(responses)
+        valid = ~np.isnan(responses)
+        func = fit_per_length_survival_function(lengths[valid], responses[valid], log_space=True, G=G)
+        table = PValueTable.from_survival_function(func, G=table_points)
+        metadata = dict(model_name=model_name, context_policy=context_policy,
+                        min_length=int(min_length), max_length=int(max_length), G=int(G),
+                        ignore_first_sentence=bool(ignore_first_sentence), table_points=int(table_points),
+                        length_unit=length_unit,
+                        num_null_samples=int(valid.sum()), table_accuracy=table.error_report(),
+                        created=time.strftime('%Y-%m-%d %H:%M:%S'), **metadata)
+        return cls(table, metadata)
+
+    def save(self, path):
+        t = self.table
+        header = dict(self.metadata, format_version=FORMAT_VERSION, table_shape=list(t.table.shape),
+                      table_min_length=int(t.min_length), table_x_min=t.x_min, table_x_max=t.x_max)
+        header = json.dumps(header).encode('utf-8')
+        offset = len(MAGIC) + 12 + len(header)
+        padding = -offset % _ALIGNMENT
+        with open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(struct.pack('<IQ', FORMAT_VERSION, len(header) + padding))
+            f.write(header + b' ' * padding)
+            f.write(np.ascontiguousarray(t.table, dtype='<f8').tobytes())
+        logging.info(f"Saved null model to {path}")
+
+    @staticmethod
+    def read_metadata(path):
+        """
+        :return:  (metadata, offset of the table in the file)
+        """
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a null model file")
+            version, header_length = struct.unpack('<IQ', f.read(12))
+            if version != FORMAT_VERSION:
+                raise ValueError(f"Null model {path} has format version {version}, expected {FORMAT_VERSION}")
+            metadata = json.loads(f.read(header_length).decode('utf-8'))
+        return metadata, len(MAGIC) + 12 + header_length
+
+    @classmethod
+    def load(cls, path, model_name=None, context_policy=_UNCHECKED, length_unit=None):
+        """
+        Memory-map a saved null model
+
+        :param model_name:, :context_policy:, :length_unit:  settings of the run; an artifact fitted with
+            other settings raises NullModelMismatch. Settings that are not given are not checked.
+        """
+        metadata, offset = cls.read_metadata(path)
+        null_model = cls(None, metadata)
+        null_model.check(model_name=model_name, context_policy=context_policy, length_unit=length_unit)
+
+        table = np.memmap(path, dtype='<f8', mode='r', offset=offset, shape=tuple(metadata['table_shape']))
+        null_model.table = PValueTable(table, metadata['table_min_length'],
+                                       metadata['table_x_min'], metadata['table_x_max'])
+        logging.info(f"Loaded null model {path} (model={metadata['model_name']}, "
+                     f"policy={metadata['context_policy']}, {metadata['num_null_samples']} null samples)")
+        return null_model
+
+    def check(self, model_name=None, context_policy=_UNCHECKED, length_unit=None, **settings):
+        """
+        Refuse a null model fitted with another language model, context policy or length unit. Differences
+        in other settings (e.g. min_length, max_length, ignore_first_sentence) are logged.
+        """
+        if model_name is not None and model_name != self.metadata['model_name']:
+            raise NullModelMismatch(f"Null model was fitted with language model {self.metadata['model_name']}, "
+                                    f"not {model_name}")
+        if context_policy is not _UNCHECKED and context_policy != self.metadata['context_policy']:
+            raise NullModelMismatch(f"Null model was fitted with context policy {self.metadata['context_policy']}, "
+                                    f"not {context_policy}")
+        fitted_unit = self.metadata.get('length_unit', 'spacy')  # artifacts saved before length units
+        if length_unit is not None and length_unit != fitted_unit:
+            raise NullModelMismatch(f"Null model was fitted with lengths in {fitted_unit} units, not {length_unit}")
+        for k, v in settings.items():
+            if k in self.metadata and self.metadata[k] != v:
+                logging.warning(f"Null model was fitted with {k}={self.metadata[k]}, the run uses {k}={v}")
+
+    def pvalues(self, lengths, responses):
+        return self.table.pvalues(lengths, responses)
+
+    def __call__(self, length, x):
+        return self.table(length, x)
@@ -0,0 +1,117 @@
+import logging
+import numpy as np
+from scipy.interpolate import RectBivariateSpline
+
+
+class PValueTable(object):
+    """
+    Dense lookup table of a per-length survival function (length, response) -> P-value
+
+    The survival function is evaluated once on a grid of integer lengths x :G: equally spaced
+    responses. P-values of whole arrays of (length, response) pairs are then obtained by bilinear
+    interpolation of -log(P-value) on this grid, without calling the spline. Lengths and responses
+    outside the grid are clamped to its boundary, as the spline itself does outside its knots.
+
+    The interpolation error with respect to the spline decreases with :G:; see error_report.
+    """
+
+    def __init__(self, table, min_length, x_min, x_max, survival_function=None):
+        """
+        :param table:  array of shape (number of lengths, G); entry (i, k) is -log of the P-value of
+            length min_length + i and response x_min + k * (x_max - x_min) / (G - 1)
+        :param survival_function:  the function the table was compiled from (used by error_report)
+        """
+        self.table = np.asarray(table, dtype=np.float64)
+        self.min_length = min_length
+        self.max_length = min_length + self.table.shape[0] - 1
+        self.x_min = float(x_min)
+        self.x_max = float(x_max)
+        self.survival_function = survival_function
+
+    @property
+    def G(self):
+        return self.table.shape[1]
+
+    @classmethod
+    def from_survival_function(cls, func, G=2001, length_range=None, x_range=None):
+        """
+        Compile a survival function returned by fit_per_length_survival_function
+
+        :param func:  bivariate function (length, x) -> P-value, evaluated on grids as func(lengths, xs)
+        :param G:  number of grid points in the response dimension
+        :param length_range:  (min, max) lengths of the table; defaults to the range of the spline
+        :param x_range:  (min, max) responses of the table; defaults to the range of the spline
+        """
+        spline = getattr(func, 'spline', func)
+        if isinstance(spline, RectBivariateSpline):
+            tx, ty = spline.get_knots()
+            length_range = length_range or (tx[0], tx[-1])
+            x_range = x_range or (ty[0], ty[-1])
+        if length_range is None or x_range is None:
+            raise ValueError("length_range and x_range are needed for survival functions that are not splines")
+
+        lengths = np.arange(int(np.ceil(length_range[0])), int(np.floor(length_range[1])) + 1)
+        xs = np.linspace(x_range[0], x_range[1], G)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            table = -np.log(np.asarray(func(lengths, xs), dtype=np.float64))
+        return cls(table, lengths[0], x_range[0], x_range[1], survival_function=func)
+
+    def __call__(self, length, x):
+        pvals = self.pvalues(np.atleast_1d(length), np.atleast_1d(x))
+        if np.ndim(length) == 0 and np.ndim(x) == 0:
+            return float(pvals[0])
+        return pvals
+
+    def pvalues(self, lengths, responses):
+        """
+        P-values of many (length, response) pairs
+
+        :param lengths:  1-D array of sentence lengths
+        :param responses:  1-D array of responses (log-perplexities); nan responses get nan P-values
+        :return:  1-D array of P-values
+        """
+        lengths = np.asarray(lengths, dtype=np.float64)
+        responses = np.asarray(responses, dtype=np.float64)
+        assert lengths.shape == responses.shape
+
+        L, G = self.table.shape
+        li = np.clip(lengths, self.min_length, self.max_length) - self.min_length
+        xi = (np.clip(responses, self.x_min, self.x_max) - self.x_min) * ((G - 1) / (self.x_max - self.x_min))
+        nan = np.isnan(xi)
+        xi[nan] = 0
+
+        l0 = np.minimum(li.astype(np.int64), L - 2) if L > 1 else np.zeros(len(li), dtype=np.int64)
+        x0 = np.minimum(xi.astype(np.int64), G - 2)
+        wl = li - l0
+        wx = xi - x0
+        t = self.table
+        z = (1 - wx) * t[l0, x0] + wx * t[l0, x0 + 1]
+        if L > 1:
+            z = (1 - wl) * z + wl * ((1 - wx) * t[l0 + 1, x0] + wx * t[l0 + 1, x0 + 1])
+        pvals = np.exp(-z)
+        pvals[nan] = np.nan
+        return pvals
+
+    def error_report(self, n=100000, seed=0):
+        """
+        Absolute P-value differences between the table and the survival function it was compiled from,
+        at :n: random (integer length, response) pairs within the range of the table
+
+        :return:  dictionary with the maximal and mean absolute error
+        """
+        if self.survival_function is None:
+            raise ValueError("The survival function of the table is not available")
+        rng = np.random.default_rng(seed)
+        lengths = rng.integers(self.min_length, self.max_length + 1, size=n)
+        responses = rng.uniform(self.x_min, self.x_max, size=n)
+        func = self.survival_function
+        if hasattr(func, 'spline'):  # exp(-spline), evaluated point-wise
+            expected = np.exp(-func.spline(lengths, responses, grid=False))
+        elif isinstance(func, RectBivariateSpline):
+            expected = func(lengths, responses, grid=False)
+        else:
+            expected = np.array([np.asarray(self.survival_function(l, x)).item() for l, x in zip(lengths, responses)])
+        err = np.abs(self.pvalues(lengths, responses) - expected)
+        report = dict(G=self.G, max_abs_error=float(err.max()), mean_abs_error=float(err.mean()))
+        logging.info(f"P-value table accuracy: {report}")
+        return report
@@ -0,0 +1,272 @@
+import logging
+import traceback
+import numpy as np
+from tqdm import tqdm
+from src.PrepareSentenceContext import PrepareSentenceContext
+from src.summarizer import summarize_many
+from src.QuestionGenerator import gen_questions
+
+FORMAT_VERSION = 1
+
+
+def _pack_strings(strings):
+    """
+    :return:  (uint8 array of the concatenated utf-8 encodings, int64 array of byte offsets)
+    """
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_string(blob, offsets, k):
+    return blob[offsets[k]:offsets[k + 1]].tobytes().decode('utf-8')
+
+
+def _pack_ids(lo_ids):
+    """
+    :return:  (int32 array of the concatenated token ids, int64 array of offsets)
+    """
+    offsets = np.zeros(len(lo_ids) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(ids) for ids in lo_ids])
+    flat = np.fromiter((t for ids in lo_ids for t in ids), dtype=np.int32, count=int(offsets[-1]))
+    return flat, offsets
+
+
+class ParsedCorpus(object):
+    """
+    Sentences of a dataset, parsed and tokenized once and shared by all context policies
+
+    Every document is parsed by spaCy once. Every sentence is tokenized twice: on its own (as it is scored)
+    and preceded by a space (as it appears after other text inside a context). The contexts of any policy
+    are then assembled from these token-id slices (see PrepareSentenceContext.context_pieces); only
+    pieces that are not sentences (fixed context, summaries, questions) are tokenized, once per run.
+
+    All data is kept in flat NumPy arrays indexed by offsets:
+        doc_offsets[k]:doc_offsets[k+1]   sentences of document k
+        token_offsets[j]:token_offsets[j+1]   tokens of sentence j in token_ids (ws_token_ids with
+            ws_token_offsets for the space-prefixed variant)
+        spans[j]   character span of sentence j in its document ((-1, -1) with the regex engine)
+    Strings (document ids and texts, sentences, tags) are stored as utf-8 bytes with byte offsets.
+
+    Context token ids equal the tokenization of the context string as long as the tokenizer's
+    pre-tokenization splits at the boundaries of the pieces, which byte-level BPE tokenizers (GPT-2) do
+    before a space. Pieces joined without a space (the fixed-context variant of 'previous-3-sentences')
+    fall back to tokenizing the context string when neither side of the boundary is a space.
+    """
+
+    def __init__(self, arrays, tokenizer_name=''):
+        self.arrays = arrays
+        self.tokenizer_name = tokenizer_name
+        for k, v in arrays.items():
+            setattr(self, k, v)
+        self.length_unit = str(arrays.get('length_unit', 'spacy'))  # older corpora have spaCy lengths
+
+    def __len__(self):
+        return len(self.doc_offsets) - 1
+
+    @property
+    def num_sentences(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, dataset, tokenizer, parser=None, batch_size=64, n_process=1):
+        """
+        Parse and tokenize all documents of a dataset
+
+        :param dataset:  iterable of dictionaries with keys 'id' and 'text'
+        :param tokenizer:  tokenizer of the language model
+        :param parser:  PrepareSentenceContext used for parsing and length units (its context policy is
+            ignored); a default spaCy parser if not given
+        :param batch_size:  number of documents per spaCy batch
+        :param n_process:  number of spaCy processes
+        """
+        parser = parser or PrepareSentenceContext()
+        names, documents, sentences = [], [], []
+
+        def texts():
+            for d in dataset:
+                yield parser.preprocess(d['text']), d['id']
+
+        parsed_docs = parser.parse_texts(texts(), as_tuples=True, batch_size=batch_size, n_process=n_process)
+        for (parsed, text), name in tqdm(parsed_docs):
+            try:
+                # BPE lengths are taken from the tokenization below
+                sentences.append(parser.extract_sentences(parsed, measure=parser.length_unit != 'bpe'))
+            except Exception as e:
+                print(f"Error processing {name}")
+                print(f"Error details: {e}")
+                traceback.print_exc()
+                continue
+            names.append(str(name))
+            documents.append(text)
+
+        sent_texts = [t for s in sentences for t in s['text']]
+        logging.info(f"Tokenizing {len(sent_texts)} sentences of {len(documents)} documents...")
+        token_ids, token_offsets = _pack_ids(tokenizer(sent_texts)['input_ids'] if sent_texts else [])
+        ws_token_ids, ws_token_offsets = _pack_ids(tokenizer([' ' + t for t in sent_texts])['input_ids']
+                                                   if sent_texts else [])
+
+        if parser.length_unit == 'bpe':
+            lengths = np.diff(token_offsets) - tokenizer.num_special_tokens_to_add()
+        else:
+            lengths = [n for s in sentences for n in s['length']]
+
+        doc_offsets = np.zeros(len(sentences) + 1, dtype=np.int64)
+        doc_offsets[1:] = np.cumsum([len(s['text']) for s in sentences])
+        tags = [t for s in sentences for t in s['tag']]
+        arrays = dict(doc_offsets=doc_offsets,
+                      token_ids=token_ids, token_offsets=token_offsets,
+                      ws_token_ids=ws_token_ids, ws_token_offsets=ws_token_offsets,
+                      lengths=np.asarray(lengths, dtype=np.int32),
+                      length_unit=np.array(parser.length_unit),
+                      number_in_par=np.array([n for s in sentences for n in s['number_in_par']], dtype=np.int32),
+                      sent_index=np.array([n for s in sentences for n in s['index']], dtype=np.int32),
+                      spans=np.array([sp for s in sentences
+                                      for sp in (s['spans'] if s['spans'] is not None else [(-1, -1)] * len(s['text']))],
+                                     dtype=np.int64).reshape(-1, 2),
+                      has_tag=np.array([t is not None for t in tags], dtype=bool))
+        for key, strings in [('names', names), ('documents', documents), ('sentences', sent_texts),
+                             ('tags', [t or '' for t in tags])]:
+            arrays[key], arrays[key + '_offsets'] = _pack_strings(strings)
+        return cls(arrays, tokenizer_name=getattr(tokenizer, 'name_or_path', ''))
+
+    def save(self, path):
+        np.savez(path, format_version=np.array(FORMAT_VERSION), tokenizer_name=np.array(self.tokenizer_name),
+                 **self.arrays)
+
+    @classmethod
+    def load(cls, path, tokenizer=None):
+        """
+        :param tokenizer:  if given, refuse a corpus tokenized by a different tokenizer
+        """
+        with np.load(path, allow_pickle=False) as f:
+            arrays = {k: f[k] for k in f.files}
+        version = int(arrays.pop('format_version'))
+        if version != FORMAT_VERSION:
+            raise ValueError(f"Parsed corpus {path} has format version {version}, expected {FORMAT_VERSION}")
+        tokenizer_name = str(arrays.pop('tokenizer_name'))
+        if tokenizer is not None and tokenizer_name != getattr(tokenizer, 'name_or_path', ''):
+            raise ValueError(f"Parsed corpus {path} was tokenized by {tokenizer_name}")
+        return cls(arrays, tokenizer_name=tokenizer_name)
+
+    def name(self, k):
+        return _unpack_string(self.names, self.names_offsets, k)
+
+    def document_text(self, k):
+        return _unpack_string(self.documents, self.documents_offsets, k)
+
+    def sentences_of(self, k):
+        """
+        Sentences of document k in the format of PrepareSentenceContext.extract_sentences
+        """
+        first, last = self.doc_offsets[k], self.doc_offsets[k + 1]
+        return {'text': [_unpack_string(self.sentences, self.sentences_offsets, j) for j in range(first, last)],
+                'length': self.lengths[first:last].tolist(),
+                'tag': [_unpack_string(self.tags, self.tags_offsets, j) if self.has_tag[j] else None
+                        for j in range(first, last)],
+                'number_in_par': self.number_in_par[first:last].tolist(),
+                'index': self.sent_index[first:last].tolist(),
+                'spans': [tuple(sp) for sp in self.spans[first:last].tolist()]}
+
+    def sentence_ids(self, j, with_space=False):
+        if with_space:
+            return self.ws_token_ids[self.ws_token_offsets[j]:self.ws_token_offsets[j + 1]]
+        return self.token_ids[self.token_offsets[j]:self.token_offsets[j + 1]]
+
+    def _context_ids(self, pieces, texts, first, tokenize):
+        """
+        Token ids of a context given as context pieces of the document whose first sentence is :first:
+        """
+        ids = []
+        previous = None
+        for sep, piece in pieces:
+            text = texts[piece] if isinstance(piece, int) else piece
+            if sep == '' and previous and text and not previous[-1].isspace() and not text[0].isspace():
+                # the tokenizer could merge tokens across this boundary
+                return tokenize(PrepareSentenceContext.join_pieces(pieces, texts))
+            if isinstance(piece, int):
+                ids.append(self.sentence_ids(first + piece, with_space=(sep == ' ')))
+            else:
+                ids.append(tokenize(sep + text))
+            previous = text
+        return np.concatenate(ids)
+
+    def responses(self, evaluator, parser, batch_size=16, docs_per_batch=64):
+        """
+        Evaluate the responses of all sentences under the context policy of :parser:
+
+        :param evaluator:  PerplexityEvaluator (responses are computed by log_perplexity_pairs), or a
+            SentenceScheduler to batch the pairs of :docs_per_batch: documents by length
+        :param parser:  PrepareSentenceContext with the context policy and fixed context
+        :param batch_size:  number of pairs per forward pass (ignored by a SentenceScheduler)
+        :param docs_per_batch:  number of documents whose summaries, questions and responses are
+            computed together
+        :return:  generator of (document id, record) in the order of the corpus, with records as
+            returned by many_atomic_detections.process_text
+        """
+        if parser.length_unit != self.length_unit:
+            raise ValueError(f"Parsed corpus lengths are in {self.length_unit} units, not {parser.length_unit}")
+        if parser.context_policy == 'document':
+            raise ValueError("The 'document' context policy scores whole documents; "
+                             "use PerplexityEvaluator.log_perplexity_document")
+        ignore_index = evaluator.ignore_index
+        memo = {}
+
+        def tokenize(text):
+            if text not in memo:
+                memo[text] = np.array(evaluator.tokenizer(text)['input_ids'], dtype=np.int32)
+            return memo[text]
+
+        for start in range(0, len(self), docs_per_batch):
+            docs = range(start, min(start + docs_per_batch, len(self)))
+            sentences = [self.sentences_of(k) for k in docs]
+            summaries = [None] * len(docs)
+            questions = [None] * len(docs)
+            if parser.context_policy in ['summary', 'summary-and-previous-sentence']:
+                summaries = summarize_many([self.document_text(k) for k in docs],
+                                           batch_size=parser.summary_batch_size, cache=parser.summary_cache)
+            elif parser.context_policy == 'QA':
+                generated = iter(gen_questions([t for s in sentences for t in s['text']], **parser.question_options))
+                questions = [[next(generated) for _ in s['text']] for s in sentences]
+
+            pairs = []
+            records = []
+            for k, sents, summary, qs in zip(docs, sentences, summaries, questions):
+                try:
+                    doc_pairs, context_lengths = self._document_pairs(k, sents, parser, summary, qs,
+                                                                      tokenize, ignore_index)
+                except Exception as e:
+                    print(f"Error processing {self.name(k)}")
+                    print(f"Error details: {e}")
+                    traceback.print_exc()
+                    continue
+                pairs += doc_pairs
+                records.append((k, dict(chunk_ids=list(range(1, len(doc_pairs) + 1)), lengths=sents['length'],
+                                        context_lengths=context_lengths)))
+
+            all_responses = evaluator.log_perplexity_pairs(pairs, batch_size=batch_size)
+            offset = 0
+            for k, r in records:
+                r['responses'] = list(all_responses[offset:offset + len(r['chunk_ids'])])
+                offset += len(r['chunk_ids'])
+                yield self.name(k), r
+
+    def _document_pairs(self, k, sents, parser, summary, questions, tokenize, ignore_index):
+        """
+        (input_ids, labels) pairs and context lengths (in words) of the sentences of document k
+        """
+        first = self.doc_offsets[k]
+        pairs = []
+        context_lengths = []
+        for j, pieces in enumerate(parser.context_pieces(sents, summary=summary, questions=questions)):
+            ids = self.sentence_ids(first + j).tolist()
+            context = PrepareSentenceContext.join_pieces(pieces, sents['text'])
+            if context:
+                cids = self._context_ids(pieces, sents['text'], first, tokenize).tolist()
+                pairs.append((cids + ids, [ignore_index] * len(cids) + ids))
+                context_lengths.append(len(context.split()))
+            else:
+                pairs.append((ids, ids))
+                context_lengths.append(0)
+        return pairs, context_lengths
@@ -1,10 +1,94 @@
+import copy
+import threading
+import numpy as np
 import torch
+import torch.nn.functional as F
+
+
+PRECISIONS = ['fp32', 'bf16', 'int8']
+
+
+def _conv1d_to_linear(module):
+    """
+    Replace transformers' Conv1D layers (used by GPT-2) by equivalent nn.Linear layers,
+    so that dynamic quantization applies to them
+    """
+    for name, child in module.named_children():
+        if type(child).__name__ == 'Conv1D':
+            n_in, n_out = child.weight.shape
+            linear = torch.nn.Linear(n_in, n_out)
+            linear.weight.data = child.weight.data.t().contiguous()
+            linear.bias.data = child.bias.data
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
+    return module
+
+
+def set_model_precision(model, precision='fp32'):
+    """
+    Prepare a language model for evaluation in the given precision
+
+    :param precision:  one of
+        'fp32':  float32 weights and activations
+        'bf16':  bfloat16 weights and activations
+        'int8':  dynamic int8 quantization of the linear layers (CPU only)
+    :return:  the model in evaluation mode (a new module object for 'int8')
+    """
+    model.eval()
+    if precision == 'fp32':
+        return model.float()
+    if precision == 'bf16':
+        return model.to(torch.bfloat16)
+    if precision == 'int8':
+        if model.device.type != 'cpu':
+            raise ValueError("int8 dynamic quantization is only supported on CPU")
+        model = _conv1d_to_linear(model.float())
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    raise ValueError(f"Unknown precision {precision}. Options are {PRECISIONS}")
+
 
 class PerplexityEvaluator(object):
-    def __init__(self, model, tokenizer, ignore_index= -100):
+    def __init__(self, model, tokenizer, ignore_index= -100, batch_size=16, reuse_prefix=False,
+                 precision=None, context_budget=None, sliding_window=False, window_stride=None):
+        """
+        :param precision:  if given, the model is first converted using set_model_precision
+        :param reuse_prefix:  keep the past_key_values of the token prefix shared by all pairs of a batch
+        (e.g. a fixed context, or a fixed context plus a summary) and reuse it instead of re-encoding it
+        for every sentence. Only exact token-id prefixes are reused, so the responses are unchanged.
+        :param context_budget:  maximal number of context tokens of a pair. Longer contexts are truncated
+        from the left (their last tokens are kept). Independently of the budget, contexts are truncated so
+        that context and sentence fit the model's position limit.
+        :param sliding_window:  how to score a sentence that alone exceeds the position limit. If True, the
+        (budgeted) context and sentence are evaluated in overlapping windows of the position limit with a
+        stride of :window_stride: tokens (default: half the limit); otherwise, the sentence is truncated to
+        its first tokens that fit and scored without context.
+        See budget_comments for the comments recording these truncations.
+        """
+        if precision is not None:
+            model = set_model_precision(model, precision)
         self.model = model
+        self.precision = precision
         self.tokenizer = tokenizer
         self.ignore_index = ignore_index
+        self.batch_size = batch_size
+        self.reuse_prefix = reuse_prefix
+        self.context_budget = context_budget
+        self.sliding_window = sliding_window
+        self.window_stride = window_stride
+        self.max_positions = self._max_positions(None)
+        self._prefix_ids = ()
+        self._prefix_past = None
+        self._prefix_lock = threading.Lock()  # scoring threads share the prefix cache
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_prefix_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prefix_lock = threading.Lock()
 
     def __call__(self, text, context=None):
         return self.log_perplexity(text, context)
@@ -31,10 +115,321 @@ class PerplexityEvaluator(object):
         else:
             input_ids = text_ids['input_ids']
             labels = input_ids
-        loss = self.model(input_ids=input_ids.to(device), labels=labels.to(device)).loss
+        if self._fit_pair(input_ids[0].tolist(), labels[0].tolist())[2] is not None:
+            return self.log_perplexity_padded([(input_ids[0].tolist(), labels[0].tolist())])[0]
+        with torch.inference_mode():
+            loss = self.model(input_ids=input_ids.to(device), labels=labels.to(device)).loss
 
         # print(f"model float size: {next(self.model.parameters()).dtype}")
         # print(f"input float size: {input_ids.dtype}")
         # print(f"labels float size: {labels.dtype}")
 
-        return loss.cpu().detach().numpy()
\ No newline at end of file
+        return loss.float().cpu().numpy()
+
+    def _pad_token_id(self):
+        if self.tokenizer.pad_token_id is not None:
+            return self.tokenizer.pad_token_id
+        if self.tokenizer.eos_token_id is not None:
+            return self.tokenizer.eos_token_id
+        return 0
+
+    def encode_pairs(self, texts, contexts, text_ids=None):
+        """
+        Tokenize every (context, text) pair the same way log_perplexity does: context and
+        text are tokenized separately and concatenated; context positions are labeled
+        with ignore_index.
+
+        :param text_ids:  input ids of the texts if they are already tokenized (e.g. 'token_ids' of
+            PrepareSentenceContext with the 'bpe' length unit)
+        :return: list of (input_ids, labels) pairs of python lists
+        """
+        if text_ids is None:
+            text_ids = self.tokenizer(list(texts))['input_ids']
+        ctx_idx = [i for i, ctx in enumerate(contexts) if ctx]
+        context_ids = {}
+        if ctx_idx:
+            encoded = self.tokenizer([contexts[i] for i in ctx_idx])['input_ids']
+            context_ids = dict(zip(ctx_idx, encoded))
+
+        pairs = []
+        for i, ids in enumerate(text_ids):
+            ids = list(ids)
+            if i in context_ids:
+                cids = list(context_ids[i])
+                pairs.append((cids + ids, [self.ignore_index] * len(cids) + ids))
+            else:
+                pairs.append((ids, ids))
+        return pairs
+
+    def _context_length(self, lbl):
+        n = 0
+        while n < len(lbl) and lbl[n] == self.ignore_index:
+            n += 1
+        return n
+
+    @property
+    def settings_tag(self):
+        """
+        Settings that change responses besides the model, tokenizer and precision ('' by default)
+        """
+        if self.context_budget is None and not self.sliding_window:
+            return ''
+        tag = f"context_budget={self.context_budget}"
+        if self.sliding_window:
+            tag += f",window_stride={self._stride()}"
+        return tag
+
+    def _stride(self):
+        if self.max_positions is None:
+            return self.window_stride
+        return min(self.window_stride or self.max_positions // 2, self.max_positions - 1)
+
+    def _fit_pair(self, ids, lbl):
+        """
+        Apply the context budget and the position limit to an (input_ids, labels) pair
+
+        :return:  (input_ids, labels, comment, windowed); comment is None if the pair is unchanged and
+            windowed tells whether the pair must be evaluated in sliding windows
+        """
+        context_len = self._context_length(lbl)
+        text_len = len(ids) - context_len
+        keep = context_len if self.context_budget is None else min(context_len, self.context_budget)
+        limit = self.max_positions
+        notes = []
+        windowed = False
+        if limit is not None and text_len > limit:
+            if self.sliding_window:
+                windowed = True
+                notes.append(f"scored in sliding windows of {limit} tokens with stride {self._stride()}")
+            else:
+                notes.append(f"sentence truncated to {limit} tokens")
+                keep = 0
+                ids, lbl = ids[:context_len + limit], lbl[:context_len + limit]
+        elif limit is not None:
+            keep = min(keep, limit - text_len)
+        if keep < context_len:
+            notes.insert(0, f"context truncated to {keep} tokens" if keep > 0 else "context dropped")
+            ids, lbl = ids[context_len - keep:], lbl[context_len - keep:]
+        return ids, lbl, "; ".join(notes) or None, windowed
+
+    def budget_comments(self, pairs):
+        """
+        :return:  list with a comment for every (input_ids, labels) pair that is truncated or evaluated in
+            sliding windows under the context budget, and None for the others
+        """
+        return [self._fit_pair(ids, lbl)[2] for ids, lbl in pairs]
+
+    def _shared_prefix_length(self, pairs):
+        """
+        Number of leading tokens shared by all pairs that can be served from a cache. The last
+        context token of every pair is left out, since its logits predict the first sentence token.
+        """
+        prefix = pairs[0][0]
+        n = len(prefix)
+        for ids, lbl in pairs:
+            context_len = 0
+            while context_len < len(lbl) and lbl[context_len] == self.ignore_index:
+                context_len += 1
+            n = min(n, context_len - 1)
+            k = 0
+            while k < n and ids[k] == prefix[k]:
+                k += 1
+            n = k
+            if n <= 0:
+                return 0
+        return n
+
+    def _get_prefix_past(self, prefix_ids):
+        """
+        past_key_values of prefix_ids. Extends or crops the cache of the previous prefix when the two
+        share leading tokens. Returns a copy that the caller may modify.
+        """
+        device = self.model.device
+        prefix_ids = tuple(prefix_ids)
+        with self._prefix_lock:
+            q = 0
+            while (q < min(len(prefix_ids), len(self._prefix_ids))
+                   and prefix_ids[q] == self._prefix_ids[q]):
+                q += 1
+
+            with torch.inference_mode():
+                if q == 0 or self._prefix_past is None:
+                    past = self.model(input_ids=torch.tensor([prefix_ids], device=device),
+                                      use_cache=True).past_key_values
+                else:
+                    past = self._prefix_past
+                    if q < len(self._prefix_ids):
+                        past.crop(q - past.get_seq_length())  # a negative length removes that many tokens
+                    if q < len(prefix_ids):
+                        past = self.model(input_ids=torch.tensor([prefix_ids[q:]], device=device),
+                                          past_key_values=past, use_cache=True).past_key_values
+                self._prefix_ids = prefix_ids
+                self._prefix_past = past
+                return copy.deepcopy(past)
+
+    def log_perplexity_padded(self, pairs):
+        """
+        Run a single right-padded, attention-masked forward pass over a list of
+        (input_ids, labels) pairs.
+
+        Pairs are first fitted to the context budget and position limit (see _fit_pair). Pairs that need
+        sliding windows are evaluated separately.
+
+        :return: 1-D array with the mean token loss of every pair
+        """
+        fitted = [self._fit_pair(ids, lbl) for ids, lbl in pairs]
+        windowed = [i for i, f in enumerate(fitted) if f[3]]
+        if windowed:
+            losses = np.zeros(len(pairs), dtype=np.float32)
+            for i in windowed:
+                ids, lbl = fitted[i][:2]
+                token_loss = self.token_losses(ids, stride=self._stride())
+                losses[i] = token_loss[1:][np.asarray(lbl[1:]) != self.ignore_index].mean()
+            rest = [i for i, f in enumerate(fitted) if not f[3]]
+            if rest:
+                losses[rest] = self.log_perplexity_padded([fitted[i][:2] for i in rest])
+            return losses
+        pairs = [f[:2] for f in fitted]
+
+        device = self.model.device
+        past = None
+        prefix_len = self._shared_prefix_length(pairs) if self.reuse_prefix else 0
+        if prefix_len > 0:
+            past = self._get_prefix_past(pairs[0][0][:prefix_len])
+            if len(pairs) > 1:
+                past.batch_repeat_interleave(len(pairs))
+            # labels of the prefix are all ignore_index, so only the remainder needs to be evaluated
+            pairs = [(ids[prefix_len:], lbl[prefix_len:]) for ids, lbl in pairs]
+
+        max_len = max(len(ids) for ids, _ in pairs)
+        pad_id = self._pad_token_id()
+
+        input_ids = torch.full((len(pairs), max_len), pad_id, dtype=torch.long)
+        labels = torch.full((len(pairs), max_len), self.ignore_index, dtype=torch.long)
+        attention_mask = torch.zeros((len(pairs), max_len), dtype=torch.long)
+        for i, (ids, lbl) in enumerate(pairs):
+            input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            labels[i, :len(lbl)] = torch.tensor(lbl, dtype=torch.long)
+            attention_mask[i, :len(ids)] = 1
+
+        if past is not None:
+            attention_mask = torch.cat([torch.ones((len(pairs), prefix_len), dtype=torch.long),
+                                        attention_mask], dim=1)
+
+        with torch.inference_mode():
+            logits = self.model(input_ids=input_ids.to(device),
+                                attention_mask=attention_mask.to(device),
+                                past_key_values=past).logits
+
+        # same shift as the model's internal loss: token t is predicted from tokens < t
+        shift_logits = logits[:, :-1, :].float()
+        shift_labels = labels[:, 1:].to(device)
+        token_loss = F.cross_entropy(shift_logits.transpose(1, 2), shift_labels,
+                                     ignore_index=self.ignore_index, reduction='none')
+        counts = (shift_labels != self.ignore_index).sum(dim=1)
+        losses = token_loss.sum(dim=1) / counts
+        return losses.cpu().numpy()
+
+    def log_perplexity_batch(self, texts, contexts=None, batch_size=None, return_comments=False, text_ids=None):
+        """
+        Evaluate log perplexity of many texts, each with respect to its own context,
+        using padded batches. Gives the same values as calling log_perplexity on
+        every (text, context) pair.
+
+        :param texts:  list of sentences
+        :param contexts:  list of contexts (None or empty string means no context)
+        :param batch_size:  number of pairs per forward pass; defaults to self.batch_size
+        :param return_comments:  also return the comments of budget_comments
+        :param text_ids:  input ids of the texts, if already tokenized (see encode_pairs)
+        :return:  1-D array of log perplexities, one per text
+        """
+        if contexts is None:
+            contexts = [None] * len(texts)
+        assert len(texts) == len(contexts)
+        if len(texts) == 0:
+            responses = np.zeros(0, dtype=np.float32)
+            return (responses, []) if return_comments else responses
+
+        return self.log_perplexity_pairs(self.encode_pairs(texts, contexts, text_ids=text_ids),
+                                         batch_size=batch_size, return_comments=return_comments)
+
+    def log_perplexity_pairs(self, pairs, batch_size=None, return_comments=False):
+        """
+        Evaluate log perplexity of already tokenized pairs in padded batches
+
+        :param pairs:  list of (input_ids, labels) as returned by encode_pairs
+        :param batch_size:  number of pairs per forward pass; defaults to self.batch_size
+        :param return_comments:  also return the comments of budget_comments
+        :return:  1-D array of log perplexities, one per pair
+        """
+        if len(pairs) == 0:
+            responses = np.zeros(0, dtype=np.float32)
+            return (responses, []) if return_comments else responses
+        batch_size = batch_size or self.batch_size
+        responses = []
+        for start in range(0, len(pairs), batch_size):
+            responses.append(self.log_perplexity_padded(pairs[start:start + batch_size]))
+        if return_comments:
+            return np.concatenate(responses), self.budget_comments(pairs)
+        return np.concatenate(responses)
+
+    def _max_positions(self, default):
+        config = getattr(self.model, 'config', None)
+        for name in ['n_positions', 'max_position_embeddings']:
+            if getattr(config, name, None):
+                return getattr(config, name)
+        return default
+
+    def token_losses(self, input_ids, stride=None):
+        """
+        Per-token loss of a token sequence under a single causal pass. Sequences longer than the model's
+        position limit are evaluated in overlapping windows with a stride of :stride: tokens (default:
+        half the limit).
+
+        :param input_ids:  list of token ids
+        :return:  1-D array; entry t is the loss of token t given tokens < t (nan for t=0)
+        """
+        device = self.model.device
+        n = len(input_ids)
+        losses = np.full(n, np.nan, dtype=np.float32)
+        max_len = self._max_positions(n)
+        stride = min(stride or max_len // 2, max_len - 1) if max_len > 1 else 1
+        done = 1  # first position not yet evaluated
+        begin = 0
+        while done < n:
+            end = min(begin + max_len, n)
+            ids = torch.tensor([input_ids[begin:end]], device=device)
+            with torch.inference_mode():
+                logits = self.model(input_ids=ids).logits
+            window_loss = F.cross_entropy(logits[0, :-1, :].float(), ids[0, 1:], reduction='none')
+            # only keep positions that were not covered by the previous window
+            losses[done:end] = window_loss[done - begin - 1:].cpu().numpy()
+            done = end
+            begin += stride
+        return losses
+
+    def log_perplexity_document(self, document, spans):
+        """
+        Evaluate log perplexity of every sentence of a document from one causal pass over the
+        whole document. The context of every sentence is the entire text preceding it.
+
+        :param document:  full text of the document
+        :param spans:  list of (start_char, end_char) of the sentences in :document:
+        :return:  1-D array with the mean token loss of every sentence
+        """
+        enc = self.tokenizer(document, return_offsets_mapping=True)
+        token_loss = self.token_losses(list(enc['input_ids']))
+        # a token belongs to the sentence containing its last character
+        last_char = np.array([end - 1 for _, end in enc['offset_mapping']])
+        starts = np.array([start for start, _ in spans])
+        ends = np.array([end for _, end in spans])
+
+        sent_idx = np.searchsorted(starts, last_char, side='right') - 1
+        valid = (sent_idx >= 0) & ~np.isnan(token_loss)
+        valid[valid] = last_char[valid] < ends[sent_idx[valid]]
+
+        sums = np.bincount(sent_idx[valid], weights=token_loss[valid], minlength=len(spans))
+        counts = np.bincount(sent_idx[valid], minlength=len(spans))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums / counts).astype(np.float32)
+
@@ -2,8 +2,11 @@ import logging
 import spacy
 import re
 from src.SentenceParser import SentenceParser
-from src.summarizer import summarize
-from src.QuestionGenerator import gen_question
+from src.summarizer import summarize, summarize_many
+from src.QuestionGenerator import gen_questions
+
+
+LENGTH_UNITS = ('spacy', 'bpe')
 
 
 class PrepareSentenceContext(object):
@@ -12,38 +15,174 @@ class PrepareSentenceContext(object):
 
     This information is needed for evaluating log-perplexity of the text with respect to a language model
     and later on to test the likelihood that the sentence was sampled from the model with the relevant context.
+
+    Context policies:
+        None / 'no-context':  only the fixed context (if any)
+        'previous-sentence':  the previous sentence
+        'previous-3-sentences':  the three previous sentences
+        'summary':  a summary of the entire text
+        'summary-and-previous-sentence':  a summary of the entire text and the previous sentence
+        'QA':  a question generated from the sentence
+        'document':  all the text preceding the sentence. The output then also contains the parsed
+            'document' and the character 'spans' of the sentences, so that all sentences can be scored
+            in a single pass over the document (see PerplexityEvaluator.log_perplexity_document)
+
+    Length units (the unit of the 'length' of sentences, which indexes the null survival function):
+        'spacy':  spaCy tokens (whitespace-separated words with the regex engine)
+        'bpe':  tokens of the language model's tokenizer
+    The output also contains 'token_ends', the character offsets within every sentence at which its
+    length units end, so that a sentence is truncated to n units by sentence[:token_ends[n - 1]], and
+    'token_ids', the input ids of every sentence from the same tokenizer pass ('bpe' unit; None otherwise),
+    which the scorer uses instead of tokenizing the sentences again.
     """
 
-    def __init__(self, engine='spacy', context_policy=None, context=None):
+    def __init__(self, engine='spacy', context_policy=None, context=None, sentence_segmenter='parser',
+                 question_options=None, summary_cache=None, summary_batch_size=8, length_unit='spacy',
+                 tokenizer=None):
+        """
+        :param summary_cache:  a summarizer.SummaryCache used by the summary policies, so that every
+            document is summarized once across policies and runs. parse_many summarizes documents in
+            batches of :summary_batch_size:.
+        :param question_options:  keyword arguments of QuestionGenerator.gen_questions (batch_size,
+            max_length, generation settings) used by the 'QA' policy. Questions for all sentences of a document,
+            or of a batch of documents in parse_many, are generated together.
+        :param sentence_segmenter:  spaCy component that determines sentence boundaries.
+            'parser':  the dependency parser (as in the full pipeline; same boundaries)
+            'senter':  the faster statistical sentence recognizer (boundaries may differ slightly)
+            'full':  load the entire en_core_web_sm pipeline
+        Only sentence boundaries and tokens are used, so other components (NER, tagger, lemmatizer, ...)
+        are not loaded.
+        :param length_unit:  'spacy' or 'bpe' (see above)
+        :param tokenizer:  (fast) tokenizer of the language model; required by the 'bpe' length unit
+        """
+        if context_policy == 'document' and engine != 'spacy':
+            raise ValueError("The 'document' context policy requires the spacy engine")
+        if length_unit not in LENGTH_UNITS:
+            raise ValueError(f"Unknown length unit {length_unit}; expected one of {LENGTH_UNITS}")
+        if length_unit == 'bpe' and tokenizer is None:
+            raise ValueError("The 'bpe' length unit requires the tokenizer of the language model")
         if engine == 'spacy':
-            self.nlp = spacy.load("en_core_web_sm")
+            self.nlp = self.load_spacy(sentence_segmenter)
         if engine == 'regex':
             logging.warning("Regex-based parser is not good at breaking sentences like 'Dr. Stone', etc.")
             self.nlp = SentenceParser()
 
+        self.engine = engine
+        self.question_options = question_options or {}
+        self.summary_cache = summary_cache
+        self.summary_batch_size = summary_batch_size
         self.context_policy = context_policy
         self.context = context
+        self.length_unit = length_unit
+        self.tokenizer = tokenizer
+
+    @staticmethod
+    def load_spacy(sentence_segmenter='parser'):
+        if sentence_segmenter == 'full':
+            return spacy.load("en_core_web_sm")
+        if sentence_segmenter == 'parser':
+            return spacy.load("en_core_web_sm", exclude=["tagger", "attribute_ruler", "lemmatizer", "ner"])
+        if sentence_segmenter == 'senter':
+            return spacy.load("en_core_web_sm", exclude=["parser", "tagger", "attribute_ruler", "lemmatizer", "ner"],
+                              enable=["senter"])
+        raise ValueError(f"Unknown sentence segmenter {sentence_segmenter}")
 
     def __call__(self, text):
         return self.parse_sentences(text)
 
+    def parse_many(self, texts, batch_size=64, n_process=1):
+        """
+        Parse many texts through spaCy's nlp.pipe
+
+        :param texts:  iterable of texts
+        :param batch_size:  number of texts per spaCy batch
+        :param n_process:  number of spaCy processes
+        :return:  generator of parse_sentences outputs, in the order of :texts:
+        """
+        parsed_docs = self.parse_texts((self.preprocess(text) for text in texts), batch_size=batch_size,
+                                       n_process=n_process)
+        if self.context_policy in ['summary', 'summary-and-previous-sentence']:
+            # summarize :batch_size: documents together; build_contexts then finds them memoized
+            group = []
+            for parsed, text in parsed_docs:
+                group.append((parsed, text))
+                if len(group) == batch_size:
+                    summarize_many([t for _, t in group], batch_size=self.summary_batch_size,
+                                   cache=self.summary_cache)
+                    yield from (self.build_contexts(p, text=t) for p, t in group)
+                    group = []
+            summarize_many([t for _, t in group], batch_size=self.summary_batch_size, cache=self.summary_cache)
+            yield from (self.build_contexts(p, text=t) for p, t in group)
+            return
+
+        if self.context_policy != 'QA':
+            for parsed, text in parsed_docs:
+                yield self.build_contexts(parsed, text=text)
+            return
+
+        # generate the questions of :batch_size: documents together
+        group = []
+        for parsed, text in parsed_docs:
+            group.append(self.build_contexts(parsed, add_questions=False, text=text))
+            if len(group) == batch_size:
+                yield from self._add_questions(group)
+                group = []
+        yield from self._add_questions(group)
+
+    def parse_texts(self, texts, batch_size=64, n_process=1, as_tuples=False):
+        """
+        Parse preprocessed texts with self.nlp (through nlp.pipe for the spacy engine)
+
+        :param texts:  iterable of preprocessed texts, or of (text, key) pairs if :as_tuples:
+        :return:  generator of (parsed, text), or of ((parsed, text), key) if :as_tuples:
+        """
+        if self.engine == 'spacy':
+            parsed_docs = self.nlp.pipe(texts, as_tuples=as_tuples, batch_size=batch_size, n_process=n_process)
+            if as_tuples:
+                return (((doc, doc.text), key) for doc, key in parsed_docs)
+            return ((doc, doc.text) for doc in parsed_docs)
+        if as_tuples:
+            return (((self.nlp(text), text), key) for text, key in texts)
+        return ((self.nlp(text), text) for text in texts)
+
+    def _add_questions(self, records):
+        """
+        Set the contexts of the 'QA' policy for the sentences of all :records:
+        """
+        sentences = [sent for r in records for sent in r['text']]
+        questions = iter(gen_questions(sentences, **self.question_options))
+        for r in records:
+            for i in range(len(r['text'])):
+                question = next(questions)
+                r['context'][i] = (self.context + ' ' + question) if self.context else question
+        return records
+
     def parse_sentences(self, text):
+        text = self.preprocess(text)
+        return self.build_contexts(self.nlp(text), text=text)
+
+    @staticmethod
+    def preprocess(text):
+        return re.sub("(</?[a-zA-Z0-9 ]+>)\s+", r"\1. ", text)  # to make sure that tags are in separate sentences
+
+    def extract_sentences(self, parsed, measure=True):
+        """
+        Extract the sentences of a parsed document, skipping sentences that are HTML-like tags
+
+        :param parsed:  output of self.nlp on a preprocessed text
+        :param measure:  compute 'length', 'token_ends' and 'token_ids' in the length unit. Otherwise, the
+            lengths are left to the caller (e.g., from its own tokenization of the sentences) and 'token_ends'
+            and 'token_ids' are None.
+        :return:  dictionary with lists 'text', 'length', 'token_ends', 'token_ids', 'tag', 'number_in_par', 'index'
+            (position of the sentence in parsed.sents) and 'spans' (character spans in the parsed text;
+            None with the regex engine, whose sentences are plain strings)
+        """
         texts = []
-        contexts = []
-        lengths = []
+        sents = []
         tags = []
         num_in_par = []
-        previous = None
-        summary_context = None
-        previous_3 = []
-
-        text = re.sub("(</?[a-zA-Z0-9 ]+>)\s+", r"\1. ", text)  # to make sure that tags are in separate sentences
-        parsed = self.nlp(text)
-
-        # Creating context for entire text sample
-        if self.context_policy == 'summary' or self.context_policy == 'summary-and-previous-sentence':
-            summary = summarize(parsed.text)
-            summary_context = summary
+        indices = []
+        spans = [] if self.engine == 'spacy' else None
 
         running_sent_num = 0
         tag = None
@@ -66,71 +205,150 @@ class PrepareSentenceContext(object):
                 running_sent_num += 1
                 num_in_par.append(running_sent_num)
                 tags.append(tag)
-                lengths.append(len(sent))
-                sent_text = str(sent)
-                texts.append(sent_text)
-
-                if self.context_policy == 'previous-sentence':
-                    if self.context:
-                        if previous is not None:
-                            context = self.context + ' ' + previous
-                        else:
-                            context = self.context
-                    else:
-                        context = previous
-                    previous = sent_text
-                elif self.context_policy == 'summary':
-                    if self.context:
-                        context = self.context + ' ' + summary_context
-                    else:
-                        context = summary_context
-
-                elif self.context_policy == 'summary-and-previous-sentence':
-                    if previous is not None:
-                        if self.context:
-                            context = self.context + ' ' + summary_context + ' ' + previous
-                        else:
-                            context = summary_context + ' ' + previous
-                    else:
-                        context = summary_context
-                    previous = sent_text
-                elif self.context_policy == 'previous-3-sentences':
-                    if i==0:
-                        context = self.context
-                        previous = sent_text
+                sents.append(sent)
+                texts.append(str(sent))
+                indices.append(i)
+                if spans is not None:
+                    spans.append((sent.start_char, sent.end_char))
+
+        token_ends, token_ids = self.token_ends(texts, sents, return_ids=True) if measure else (None, None)
+        lengths = [len(ends) for ends in token_ends] if measure else None
+        return {'text': texts, 'length': lengths, 'token_ends': token_ends, 'token_ids': token_ids, 'tag': tags,
+                'number_in_par': num_in_par, 'index': indices, 'spans': spans}
+
+    def token_ends(self, texts, sents=None, return_ids=False):
+        """
+        Character offsets at which the length units of every sentence end
+
+        :param texts:  sentence texts
+        :param sents:  the corresponding spaCy spans ('spacy' length unit with the spacy engine); the texts
+            are tokenized by self.nlp if not given
+        :param return_ids:  also return the input ids of the sentences ('bpe' unit; None otherwise)
+        :return:  list of lists of offsets into the sentence texts; the length of a sentence is the
+            number of its offsets
+        """
+        if self.length_unit == 'bpe':
+            if len(texts) == 0:
+                return ([], []) if return_ids else []
+            # input ids as the scorer encodes the sentences; special tokens are not length units
+            encoded = self.tokenizer(texts, return_offsets_mapping=True, return_special_tokens_mask=True)
+            ends = [[end for (_, end), special in zip(offsets, mask) if not special]
+                    for offsets, mask in zip(encoded['offset_mapping'], encoded['special_tokens_mask'])]
+            return (ends, [list(ids) for ids in encoded['input_ids']]) if return_ids else ends
+        if self.engine == 'spacy':
+            if sents is None:
+                sents = [doc[:] for doc in self.nlp.pipe(texts)]
+            ends = [[t.idx + len(t) - sent.start_char for t in sent] for sent in sents]
+        else:
+            ends = [[m.end() for m in re.finditer(r"\S+", text)] for text in texts]
+        return (ends, None) if return_ids else ends
+
+    def context_pieces(self, sentences, document_text=None, summary=None, questions=None):
+        """
+        Contexts of the sentences under the context policy, as lists of (separator, piece) pairs. A piece
+        is either a string (fixed context, summary, question, preceding text) or the position of an earlier
+        sentence in sentences['text']. The context string is the concatenation of separator + piece over
+        the list (see join_pieces); None stands for no context.
+
+        Keeping the sentences as positions lets callers assemble the tokens of a context from tokens of
+        the sentences computed once (see ParsedCorpus).
+
+        :param sentences:  output of extract_sentences
+        :param document_text:  text of the parsed document ('summary' and 'document' policies)
+        :param summary:  summary of the document; computed from :document_text: if not given
+        :param questions:  one question per sentence ('QA' policy); generated if not given
+        """
+        policy = self.context_policy
+        fixed = [('', self.context)] if self.context else []
+        if policy in ['summary', 'summary-and-previous-sentence'] and summary is None:
+            summary = summarize(document_text, cache=self.summary_cache)
+        if policy == 'QA' and questions is None:
+            questions = gen_questions(sentences['text'], **self.question_options)
+
+        contexts = []
+        previous = None
+        previous_3 = []
+        for j, i in enumerate(sentences['index']):
+            if policy == 'previous-sentence':
+                if self.context:
+                    context = fixed + [(' ', previous)] if previous is not None else fixed
+                else:
+                    context = [('', previous)] if previous is not None else None
+                previous = j
+            elif policy == 'summary':
+                context = fixed + [(' ', summary)] if self.context else [('', summary)]
+            elif policy == 'summary-and-previous-sentence':
+                if previous is not None:
+                    context = (fixed + [(' ', summary)] if self.context else [('', summary)]) + [(' ', previous)]
+                else:
+                    context = [('', summary)]
+                previous = j
+            elif policy == 'previous-3-sentences':
+                if previous is None:  # the first sentence, which is not necessarily sentence 0 after tags
+                    context = fixed or None
+                else:
+                    if i < 4:
+                        previous_3.append(previous)
                     else:
-                        if i<4:
-                            previous_3.append(previous)
-                            if self.context:
-                                context = self.context + ' ' + "".join(previous_3)
-                            else:
-                                context = " ".join(previous_3)
-                            previous = sent_text
-                        else:
-                            previous_3.pop(0)
-                            previous_3.append(previous)
-                            if self.context:
-                                context = self.context + ' ' + "".join(previous_3)
-                            else:
-                                context = " ".join(previous_3)
-                            previous = sent_text
-                elif self.context_policy == "QA":
-                    question = gen_question(sent_text)
-                    if self.context:
-                        context = self.context + ' ' + question
+                        previous_3.pop(0)
+                        previous_3.append(previous)
+                    if self.context:  # sentences are concatenated without a separator after the fixed context
+                        context = fixed + [(' ' if k == 0 else '', s) for k, s in enumerate(previous_3)]
                     else:
-                        context = question
+                        context = [('' if k == 0 else ' ', s) for k, s in enumerate(previous_3)]
+                previous = j
+            elif policy == 'document':
+                preceding = document_text[:sentences['spans'][j][0]].strip()
+                if self.context:
+                    context = fixed + [(' ', preceding)] if preceding else fixed
                 else:
-                    context = self.context
+                    context = [('', preceding)] if preceding else None
+            elif policy == 'QA':
+                context = fixed + [(' ', questions[j])] if self.context else [('', questions[j])]
+            else:
+                context = fixed or None
+            contexts.append(context)
+        return contexts
+
+    @staticmethod
+    def join_pieces(pieces, texts):
+        """
+        Context string of an output of context_pieces
 
-                contexts.append(context)
+        :param texts:  sentences['text']
+        """
+        if pieces is None:
+            return None
+        return "".join(sep + (texts[p] if isinstance(p, int) else p) for sep, p in pieces)
 
+    def build_contexts(self, parsed, add_questions=True, text=None):
+        """
+        Extract sentences, lengths and contexts from a parsed document
 
-        # #### to delete
-        # log = {'text': texts, 'length': lengths, 'context': contexts, 'tag': tags,
-        #          'number_in_par': num_in_par}
-        # print(f"parse sentence returns: {log}")
-        # #### to delete
+        :param parsed:  output of self.nlp on a preprocessed text
+        :param add_questions:  under the 'QA' policy, whether to generate the questions now. If False,
+            contexts are left as None for a later call to _add_questions.
+        :param text:  the preprocessed text; required with the regex engine, whose output has no text
+        """
+        if text is None:
+            text = parsed.text
+        sentences = self.extract_sentences(parsed)
+        texts = sentences['text']
+        if self.context_policy == 'QA' and not add_questions:
+            contexts = [None] * len(texts)
+        else:
+            contexts = [self.join_pieces(pieces, texts)
+                        for pieces in self.context_pieces(sentences, document_text=text)]
 
-        return {'text': texts, 'length': lengths, 'context': contexts, 'tag': tags,
-                'number_in_par': num_in_par}
\ No newline at end of file
+        res = {'text': texts, 'length': sentences['length'], 'token_ends': sentences['token_ends'],
+               'token_ids': sentences['token_ids'], 'context': contexts, 'tag': sentences['tag'], 'number_in_par': sentences['number_in_par']}
+        if self.context_policy == 'document':
+            spans = sentences['spans']
+            if self.context:  # the fixed context is a prefix of the scored document
+                offset = len(self.context) + 1
+                res['document'] = self.context + ' ' + text
+                res['spans'] = [(start + offset, end + offset) for start, end in spans]
+            else:
+                res['document'] = text
+                res['spans'] = spans
+        return res
@@ -1,13 +1,31 @@
+import os
 from many_atomic_detections import process_text, iterate_over_texts
+from src.ParsedCorpus import ParsedCorpus
+from src.ResponseWriter import ResponseWriter
 from src.PerplexityEvaluator import PerplexityEvaluator
+from src.SentenceScheduler import SentenceScheduler
 from src.PrepareSentenceContext import PrepareSentenceContext
+from src.ResponseCache import ResponseCache, CachedPerplexityEvaluator
+from src.summarizer import SummaryCache
 from src.dataset_loaders import (get_text_from_wiki_long_dataset,
                                  get_text_from_chatgpt_news_long_dataset,
                                  get_text_from_chatgpt_abstracts_dataset)
 import pandas as pd
 
 class ResponseClass():
-    def __init__(self, dataset_name, model, model_name, tokenizer, context_policies, fixed_context, policy_names, from_sample = 0, to_sample =10):
+    def __init__(self, dataset_name, model, model_name, tokenizer, context_policies, fixed_context, policy_names, from_sample = 0, to_sample =10,
+                 reuse_prefix=True, cache_path=None, resume=False, question_options=None,
+                 summary_cache_path=None, tokenize_once=True, corpus_dir=None, length_unit='spacy',
+                 max_batch_tokens=None):
+        """
+        :param tokenize_once:  parse and tokenize every dataset once into a ParsedCorpus shared by all
+            context policies. Runs with resume, a response cache or the 'document' policy take the
+            per-policy path of iterate_over_texts instead.
+        :param corpus_dir:  folder where parsed corpora are saved and reloaded from in later runs
+        :param length_unit:  unit of the 'length' column of the responses ('spacy' or 'bpe')
+        :param max_batch_tokens:  if given, sentences are scored in length-bucketed batches of at most this
+            many tokens (see SentenceScheduler) instead of fixed batch sizes
+        """
         self.model = model
         self.model_name = model_name
         self.range = "[{}, {}]".format(from_sample, to_sample)
@@ -17,7 +35,20 @@ class ResponseClass():
         self.policy_names = policy_names
         self.from_sample = from_sample
         self.to_sample = to_sample
-        self.sentence_detector = PerplexityEvaluator(model, tokenizer)
+        self.resume = resume
+        self.question_options = question_options
+        self.summary_cache = SummaryCache(summary_cache_path) if summary_cache_path else None
+        self.tokenizer = tokenizer
+        self.corpus_dir = corpus_dir
+        self.length_unit = length_unit
+        self.tokenize_once = tokenize_once and not resume and not cache_path and 'document' not in context_policies
+        self.sentence_detector = PerplexityEvaluator(model, tokenizer, reuse_prefix=reuse_prefix)
+        self.docs_per_batch = 1
+        if max_batch_tokens:
+            self.sentence_detector = SentenceScheduler(self.sentence_detector, max_tokens=max_batch_tokens)
+            self.docs_per_batch = 64
+        if cache_path:
+            self.sentence_detector = CachedPerplexityEvaluator(self.sentence_detector, ResponseCache(cache_path))
         self.human_dataset, self.machine_dataset = self.SplitDataset()
         self.parsers_list = self.CreateParsers()
         self.datasets_dict = {'human': self.human_dataset, 'machine': self.machine_dataset}
@@ -44,20 +75,52 @@ class ResponseClass():
     def CreateParsers(self):
         parsers = []
         for policy, context in zip(self.context_policies, self.context):
-            parser = PrepareSentenceContext(context_policy = policy, context = context)
+            # with tokenize_once, parsing is done by the ParsedCorpus and parsers only build contexts
+            parser = PrepareSentenceContext(engine='spacy' if not self.tokenize_once else None,
+                                            context_policy = policy, context = context,
+                                            question_options=self.question_options,
+                                            summary_cache=self.summary_cache,
+                                            length_unit=self.length_unit, tokenizer=self.tokenizer)
             parsers.append(parser)
 
         return parsers
 
+    def GetCorpus(self, author):
+        """
+        Parsed corpus of the human or machine dataset, loaded from corpus_dir when it was saved before
+        """
+        path = None
+        if self.corpus_dir:
+            path = os.path.join(self.corpus_dir, f"{self.dataset_name}_{author}_{self.range}.npz")
+            if os.path.exists(path):
+                corpus = ParsedCorpus.load(path, tokenizer=self.tokenizer)
+                if corpus.length_unit == self.length_unit:
+                    return corpus
+        parser = PrepareSentenceContext(length_unit=self.length_unit, tokenizer=self.tokenizer)
+        corpus = ParsedCorpus.build(self.datasets_dict[author], self.tokenizer, parser=parser)
+        if path:
+            os.makedirs(self.corpus_dir, exist_ok=True)
+            corpus.save(path)
+        return corpus
+
     def CalculatePerplexity(self):
         # Perform log ppx calculation
         human_responses = []
         machine_responses = []
+        corpora = {}
+        if self.tokenize_once:
+            corpora = {author: self.GetCorpus(author) for author in self.datasets_dict}
         i = 0
         for parser in self.parsers_list:
             for author in self.datasets_dict:  # human or machine
                 csv_name = str(self.dataset_name)+"_"+str(author)+"_"+str(self.model_name)+"_"+self.policy_names[i]+"_"+self.range+'.csv'
-                iterate_over_texts(self.datasets_dict[author], self.sentence_detector, parser, csv_name)
+                if author in corpora:
+                    with ResponseWriter("Responses/"+csv_name) as writer:
+                        for name, r in corpora[author].responses(self.sentence_detector, parser):
+                            writer.write(r, name)
+                else:
+                    iterate_over_texts(self.datasets_dict[author], self.sentence_detector, parser, csv_name,
+                                       resume=self.resume, docs_per_batch=self.docs_per_batch)
                 if author == 'human':
                     df = pd.read_csv("Responses/"+csv_name)
                     human_responses.append(df)
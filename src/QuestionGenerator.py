@@ -1,15 +1,45 @@
-from transformers import pipeline
 import torch
+from src.model_registry import registry
+
+
+def load_question_generator(model="iarfmoose/t5-base-question-generator", device=None):
+    from transformers import pipeline  # imported here to keep importing this module cheap
+
+    if device is None:
+        device = 0 if torch.cuda.is_available() else -1  # use GPU if available, otherwise CPU
+    return pipeline("text2text-generation", model=model, device=device)
+
+
+registry.register('question_generator', load_question_generator, model="iarfmoose/t5-base-question-generator")
 
-device = 0 if torch.cuda.is_available() else -1  # use GPU if available, otherwise CPU
-question_generator = pipeline("text2text-generation", model="iarfmoose/t5-base-question-generator", device=device)
 
 def gen_question(text):
+    question_generator = registry.get('question_generator')  # loaded on first use
     # print(f"question_generator is on device = {next(question_generator.model.parameters()).device}")
     question = question_generator(text, max_length=100, min_length=0, do_sample=False)
     question_text = question[0]["generated_text"]
     return question_text
 
+
+def gen_questions(texts, batch_size=16, max_length=100, **generate_kwargs):
+    """
+    Generate one question for every text, passing the texts to the model in batches. With the
+    default settings every question is the one gen_question generates for the same text.
+
+    :param texts:  list of texts
+    :param batch_size:  number of texts per generation batch
+    :param max_length:  maximal length of a question in tokens
+    :param generate_kwargs:  other generation settings (e.g. num_beams); the model's defaults otherwise
+    :return:  list of questions
+    """
+    if len(texts) == 0:
+        return []
+    question_generator = registry.get('question_generator')
+    questions = question_generator(list(texts), batch_size=batch_size, max_length=max_length,
+                                   min_length=0, do_sample=False, **generate_kwargs)
+    # the pipeline returns a list of dicts, or a list of lists of dicts in some versions
+    return [(q[0] if isinstance(q, list) else q)["generated_text"] for q in questions]
+
 # text = "Albert Einstein was a German-born theoretical physicist. He developed the theory of relativity."
 # text = "Moluccans are the Austronesian-speaking and Papuan-speaking ethnic groups inhabiting the Maluku Islands."
 # text = "The term 'Moluccan' is an umbrella term that covers the various Austronesian and Papuan languages spoken on the islands."
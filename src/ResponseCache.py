@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+class ResponseCache(object):
+    """
+    Persistent content-addressed cache of sentence responses (log-perplexities)
+
+    Responses are stored in an SQLite database keyed by a hash of the model name, the tokenizer name,
+    the model precision, the context and the sentence. The database runs in WAL mode, so several worker
+    processes can read and write the same file concurrently. When the number of entries exceeds
+    :max_entries:, the least recently used entries are evicted down to :max_entries: less a tenth, so
+    that the table is not recounted on every insert. Each process keeps a running count of the
+    entries (counted once per connection, then increased by its own inserts); entries written by other
+    processes are noticed at the next recount. Every thread and process opens its own connection, so
+    a cache can be shared by the threads of a SentencePipeline.
+    """
+
+    def __init__(self, path, max_entries=10_000_000, timeout=60):
+        self.path = path
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()  # guards the counters
+        self._count = None  # running estimate of the number of entries, an upper bound
+        self._connect()
+
+    def _connect(self):
+        # sqlite connections must not be shared across threads or forked processes
+        conn, pid = getattr(self._local, 'conn', None), getattr(self._local, 'pid', None)
+        if conn is None or pid != os.getpid():
+            if pid != os.getpid():
+                with self._lock:
+                    self._count = None
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS responses "
+                         "(key TEXT PRIMARY KEY, response REAL, last_used REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            conn.commit()
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local'], state['_lock']
+        state['_count'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._connect().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def make_key(model_name, tokenizer_name, precision, context, sentence):
+        h = hashlib.sha256()
+        for field in [model_name, tokenizer_name, precision, context, sentence]:
+            h.update(repr(field).encode('utf-8'))
+            h.update(b'\x00')
+        return h.hexdigest()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    @property
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, hit_rate=self.hit_rate)
+
+    def get_many(self, keys):
+        """
+        :return:  dictionary key -> response of the keys found in the cache
+        """
+        conn = self._connect()
+        found = {}
+        unique_keys = list(set(keys))
+        for start in range(0, len(unique_keys), 500):  # stay below sqlite's limit on query variables
+            chunk = unique_keys[start:start + 500]
+            rows = conn.execute(f"SELECT key, response FROM responses WHERE key IN ({','.join('?' * len(chunk))})",
+                                chunk).fetchall()
+            found.update({k: (np.nan if r is None else r) for k, r in rows})
+        if found:
+            now = time.time()
+            with conn:
+                conn.executemany("UPDATE responses SET last_used = ? WHERE key = ?",
+                                 [(now, k) for k in found])
+        with self._lock:
+            self.hits += sum(k in found for k in keys)
+            self.misses += sum(k not in found for k in keys)
+        return found
+
+    def put_many(self, items):
+        """
+        :param items:  dictionary key -> response
+        """
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO responses (key, response, last_used) VALUES (?, ?, ?)",
+                             [(k, None if np.isnan(r) else float(r), now) for k, r in items.items()])
+        with self._lock:
+            if self._count is not None:  # replaced keys are counted too, so the count may only overestimate
+                self._count += len(items)
+            recount = self._count is None or self._count > self.max_entries
+        if recount:
+            self.evict()
+
+    def evict(self):
+        """
+        Recount the entries and, if there are more than :max_entries:, remove the least recently used
+        ones down to :max_entries: less a tenth
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")  # count and delete atomically, apart from concurrent writers
+            count = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            excess = count - (self.max_entries - self.max_entries // 10) if count > self.max_entries else 0
+            if excess > 0:
+                conn.execute("DELETE FROM responses WHERE key IN "
+                             "(SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,))
+        with self._lock:
+            self._count = count - excess
+        if excess > 0:
+            logging.info(f"Evicted {excess} entries from response cache {self.path}")
+
+
+class CachedPerplexityEvaluator(object):
+    """
+    A PerplexityEvaluator that looks up responses in a ResponseCache before evaluating them
+    """
+
+    def __init__(self, evaluator, cache):
+        self.evaluator = evaluator
+        self.cache = cache
+        self.model_name = getattr(evaluator.model, 'name_or_path', None) or \
+                          getattr(evaluator.model.config, '_name_or_path', '')
+        self.tokenizer_name = getattr(evaluator.tokenizer, 'name_or_path', '')
+
+    def __getattr__(self, name):
+        if name == 'evaluator':  # not yet set, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.evaluator, name)
+
+    def __call__(self, text, context=None):
+        return self.log_perplexity(text, context)
+
+    def _key(self, text, context):
+        precision = getattr(self.evaluator, 'precision', None)
+        tag = getattr(self.evaluator, 'settings_tag', '')
+        if tag:  # responses under a context budget are cached apart; the default keys are unchanged
+            precision = f"{precision}|{tag}"
+        return self.cache.make_key(self.model_name, self.tokenizer_name, precision, context or None, text)
+
+    def log_perplexity(self, text, context=None):
+        return self.log_perplexity_batch([text], [context])[0]
+
+    def log_perplexity_batch(self, texts, contexts=None, batch_size=None, return_comments=False, text_ids=None):
+        """
+        :param return_comments:  also return the comments of PerplexityEvaluator.budget_comments (all pairs are
+            tokenized to obtain them, including cached ones)
+        :param text_ids:  input ids of the texts, if already tokenized (see PerplexityEvaluator.encode_pairs)
+        """
+        if contexts is None:
+            contexts = [None] * len(texts)
+        assert len(texts) == len(contexts)
+
+        keys = [self._key(text, context) for text, context in zip(texts, contexts)]
+        found = self.cache.get_many(keys)
+        missing = [i for i, k in enumerate(keys) if k not in found]
+        if missing:
+            missing_ids = None if text_ids is None else [text_ids[i] for i in missing]
+            computed = self.evaluator.log_perplexity_batch([texts[i] for i in missing],
+                                                           [contexts[i] for i in missing],
+                                                           batch_size=batch_size, text_ids=missing_ids)
+            new_items = {keys[i]: r for i, r in zip(missing, computed)}
+            self.cache.put_many(new_items)
+            found.update(new_items)
+        responses = np.array([found[k] for k in keys], dtype=np.float32)
+        if return_comments:
+            pairs = self.evaluator.encode_pairs(texts, contexts, text_ids=text_ids)
+            return responses, self.evaluator.budget_comments(pairs)
+        return responses
@@ -0,0 +1,163 @@
+import csv
+import logging
+import os
+
+COLUMNS = ['num', 'length', 'response', 'context_length', 'name']
+
+
+class ResponseWriter(object):
+    """
+    Append-only writer of per-sentence responses
+
+    Rows of every processed document are appended to the output file as soon as they are written,
+    so memory is bounded and the cost of a run is linear in its output. Supported formats are 'csv'
+    (same layout as DataFrame.to_csv, including the running index column) and 'parquet' (requires pyarrow;
+    rows are buffered and written in row groups).
+
+    For csv output, every committed document is also recorded in a checkpoint file next to the output
+    (path + '.ckpt') with the number of rows and bytes written so far. With resume=True, a writer reopens
+    an interrupted output: rows after the last checkpoint are cut off, writing continues from there, and
+    the ids of committed documents are available in :committed: so that callers can skip them.
+    """
+
+    def __init__(self, path, format=None, fsync_every=50, row_group_size=100_000, resume=False):
+        """
+        :param path:  output file
+        :param format:  'csv' or 'parquet'; inferred from the file extension if not given
+        :param fsync_every:  number of documents between calls to os.fsync (csv)
+        :param row_group_size:  number of buffered rows per parquet row group
+        :param resume:  continue an interrupted csv output instead of overwriting it
+        """
+        if format is None:
+            format = 'parquet' if path.endswith('.parquet') else 'csv'
+        if format not in ['csv', 'parquet']:
+            raise ValueError(f"Unknown output format {format}")
+        if resume and format != 'csv':
+            raise ValueError("Resuming is only supported for csv output")
+        self.path = path
+        self.checkpoint_path = path + '.ckpt'
+        self.format = format
+        self.fsync_every = fsync_every
+        self.row_group_size = row_group_size
+        self.rows_written = 0
+        self.docs_written = 0
+        self.committed = set()
+        self._buffer = {c: [] for c in COLUMNS}
+        self._parquet_writer = None
+
+        if self.format == 'csv':
+            if resume and os.path.exists(path) and os.path.exists(self.checkpoint_path):
+                self._resume()
+            else:
+                self._file = open(path, 'w', newline='')
+                self._csv = csv.writer(self._file)
+                self._csv.writerow([''] + COLUMNS)
+                self._file.flush()
+                self._checkpoint = open(self.checkpoint_path, 'w')
+        else:
+            self._file = None
+            self._checkpoint = None
+
+    def _resume(self):
+        """
+        Reopen the output at its last checkpoint that is fully on disk
+        """
+        file_size = os.path.getsize(self.path)
+        entries = []
+        with open(self.checkpoint_path, 'rt') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 3:  # partially written line
+                    break
+                name, rows_written, offset = fields[0], int(fields[1]), int(fields[2])
+                if offset > file_size:
+                    break
+                entries.append((name, rows_written, offset))
+
+        if entries:
+            self.rows_written, offset = entries[-1][1], entries[-1][2]
+        else:
+            with open(self.path, 'rt', newline='') as f:
+                offset = len(f.readline().encode('utf-8'))  # keep the header only
+        self.committed = set(name for name, _, _ in entries)
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(offset)
+        with open(self.checkpoint_path, 'w') as f:
+            f.writelines(f"{name}\t{rows}\t{off}\n" for name, rows, off in entries)
+        logging.info(f"Resuming {self.path} after {len(self.committed)} documents ({self.rows_written} rows)")
+
+        self._file = open(self.path, 'a', newline='')
+        self._csv = csv.writer(self._file)
+        self._checkpoint = open(self.checkpoint_path, 'a')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, record, name):
+        """
+        Append the rows of one document
+
+        :param record:  dictionary with keys chunk_ids, lengths, responses, context_lengths
+            (as returned by many_atomic_detections.process_text)
+        :param name:  document id
+        """
+        rows = zip(record['chunk_ids'], record['lengths'], record['responses'], record['context_lengths'])
+        if self.format == 'csv':
+            for i, (num, length, response, context_length) in enumerate(rows):
+                self._csv.writerow([self.rows_written + i, num, length, response, context_length, name])
+            self._file.flush()
+            if (self.docs_written + 1) % self.fsync_every == 0:
+                os.fsync(self._file.fileno())
+            rows_written = self.rows_written + len(record['chunk_ids'])
+            self._checkpoint.write(f"{name}\t{rows_written}\t{self._file.tell()}\n")
+            self._checkpoint.flush()
+            self.committed.add(str(name))
+        else:
+            for num, length, response, context_length in rows:
+                self._buffer['num'].append(num)
+                self._buffer['length'].append(length)
+                self._buffer['response'].append(float(response))
+                self._buffer['context_length'].append(context_length)
+                self._buffer['name'].append(name)
+            if len(self._buffer['num']) >= self.row_group_size:
+                self._write_row_group()
+
+        self.rows_written += len(record['chunk_ids'])
+        self.docs_written += 1
+
+    def _write_row_group(self):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing parquet output requires pyarrow (pip install pyarrow)")
+
+        if len(self._buffer['num']) == 0 and self._parquet_writer is not None:
+            return
+        table = pa.table({'num': pa.array(self._buffer['num'], type=pa.int32()),
+                          'length': pa.array(self._buffer['length'], type=pa.int32()),
+                          'response': pa.array(self._buffer['response'], type=pa.float32()),
+                          'context_length': pa.array(self._buffer['context_length'], type=pa.int32()),
+                          'name': pa.array([str(n) for n in self._buffer['name']], type=pa.string())})
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, table.schema)
+        self._parquet_writer.write_table(table)
+        self._buffer = {c: [] for c in COLUMNS}
+
+    def close(self):
+        if self.format == 'csv':
+            if not self._file.closed:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                self._checkpoint.close()
+        else:
+            self._write_row_group()
+            if self._parquet_writer is not None:
+                self._parquet_writer.close()
+                self._parquet_writer = None
+        logging.info(f"Wrote {self.rows_written} rows of {self.docs_written} documents to {self.path}")
@@ -0,0 +1,188 @@
+import logging
+import queue
+import threading
+import time
+import traceback
+import numpy as np
+
+_DONE = object()
+
+
+class _Stage(object):
+    """
+    Bookkeeping of one pipeline stage: processed items, busy time and depth of its output queue
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.running = workers
+        self.items = 0
+        self.busy_seconds = 0.0
+        self.queue_depths = []
+        self._lock = threading.Lock()
+
+    def record(self, seconds, queue_depth):
+        with self._lock:
+            self.items += 1
+            self.busy_seconds += seconds
+            self.queue_depths.append(queue_depth)
+
+    def finish_worker(self):
+        """
+        :return:  True for the last worker of the stage to finish
+        """
+        with self._lock:
+            self.running -= 1
+            return self.running == 0
+
+    def summary(self):
+        depths = np.array(self.queue_depths) if self.queue_depths else np.zeros(1)
+        return dict(workers=self.workers, items=self.items, busy_seconds=self.busy_seconds,
+                    mean_output_queue_depth=float(depths.mean()), max_output_queue_depth=int(depths.max()))
+
+
+class SentencePipeline(object):
+    """
+    Staged producer/consumer pipeline from raw texts to sentence responses
+
+    Stages:
+        parse:  spaCy parsing through nlp.pipe (with :parse_processes: processes)
+        context:  building sentence contexts (PrepareSentenceContext.build_contexts), :context_workers: threads
+        score:  evaluating log-perplexities (PerplexityEvaluator.log_perplexity_batch), :scoring_workers: threads
+
+    Stages are connected by bounded queues of size :queue_size:, so all stages work at the same time and
+    throughput is set by the slowest one. Results are yielded in the order of the input. The depth of
+    the output queue of every stage is sampled whenever the stage puts an item; see :metrics:.
+    """
+
+    def __init__(self, parser, evaluator, parse_batch_size=16, parse_processes=1,
+                 context_workers=1, scoring_workers=1, queue_size=8):
+        self.parser = parser
+        self.evaluator = evaluator
+        self.parse_batch_size = parse_batch_size
+        self.parse_processes = parse_processes
+        self.context_workers = context_workers
+        self.scoring_workers = scoring_workers
+        self.queue_size = queue_size
+        self.stages = {}
+
+    @property
+    def metrics(self):
+        return {name: stage.summary() for name, stage in self.stages.items()}
+
+    def _preprocess(self, items, out_queue):
+        for seq, d in items:
+            try:
+                text = self.parser.preprocess(d['text'])
+            except Exception as e:
+                print(f"Error processing {d['id']} in stage parse")
+                print(f"Error details: {e}")
+                out_queue.put((seq, d, None))
+                continue
+            yield text, (seq, d)
+
+    def _parse(self, items, out_queue, stage, n_downstream):
+        try:
+            parsed_docs = self.parser.parse_texts(self._preprocess(items, out_queue), as_tuples=True,
+                                                  batch_size=self.parse_batch_size, n_process=self.parse_processes)
+            start = time.perf_counter()
+            for parsed, (seq, d) in parsed_docs:
+                stage.record(time.perf_counter() - start, out_queue.qsize())
+                out_queue.put((seq, d, parsed))
+                start = time.perf_counter()
+        except Exception as e:
+            logging.error(f"Parsing stage failed: {e}")
+            traceback.print_exc()
+        finally:
+            for _ in range(n_downstream):
+                out_queue.put(_DONE)
+
+    def _work(self, func, in_queue, out_queue, stage, n_downstream):
+        """
+        Apply :func: to the items of :in_queue: until receiving _DONE. The last worker of the
+        stage to finish sends one _DONE to every downstream worker.
+        """
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                if stage.finish_worker():
+                    for _ in range(n_downstream):
+                        out_queue.put(_DONE)
+                return
+            seq, d, payload = item
+            start = time.perf_counter()
+            try:
+                result = func(payload) if payload is not None else None
+            except Exception as e:
+                print(f"Error processing {d['id']} in stage {stage.name}")
+                print(f"Error details: {e}")
+                traceback.print_exc()
+                result = None
+            stage.record(time.perf_counter() - start, out_queue.qsize())
+            out_queue.put((seq, d, result))
+
+    def _build_contexts(self, payload):
+        parsed, text = payload
+        return self.parser.build_contexts(parsed, text=text)
+
+    def _score(self, chunks):
+        if 'spans' in chunks:
+            responses = self.evaluator.log_perplexity_document(chunks['document'], chunks['spans'])
+        else:
+            responses = self.evaluator.log_perplexity_batch(chunks['text'], chunks['context'],
+                                                            text_ids=chunks.get('token_ids'))
+        return chunks, responses
+
+    def __call__(self, dataset):
+        return self.run(dataset)
+
+    def run(self, dataset):
+        """
+        Process all documents of the dataset
+
+        :param dataset:  iterable of dictionaries with keys 'id' and 'text'
+        :return:  generator of (document, chunks, responses) in the order of the dataset;
+            chunks and responses are None for a document that failed
+        """
+        self.stages = {'parse': _Stage('parse', self.parse_processes),
+                       'context': _Stage('context', self.context_workers),
+                       'score': _Stage('score', self.scoring_workers)}
+        parsed_queue = queue.Queue(self.queue_size)
+        context_queue = queue.Queue(self.queue_size)
+        scored_queue = queue.Queue(self.queue_size)
+
+        threads = [threading.Thread(target=self._parse, daemon=True,
+                                    args=(enumerate(dataset), parsed_queue, self.stages['parse'],
+                                          self.context_workers))]
+        threads += [threading.Thread(target=self._work, daemon=True,
+                                     args=(self._build_contexts, parsed_queue, context_queue,
+                                           self.stages['context'], self.scoring_workers))
+                    for _ in range(self.context_workers)]
+        threads += [threading.Thread(target=self._work, daemon=True,
+                                     args=(self._score, context_queue, scored_queue, self.stages['score'], 1))
+                    for _ in range(self.scoring_workers)]
+        for t in threads:
+            t.start()
+
+        pending = {}
+        next_seq = 0
+        while True:
+            item = scored_queue.get()
+            if item is _DONE:
+                break
+            seq, d, result = item
+            pending[seq] = (d, result)
+            while next_seq in pending:
+                d, result = pending.pop(next_seq)
+                chunks, responses = result if result is not None else (None, None)
+                yield d, chunks, responses
+                next_seq += 1
+
+        for t in threads:
+            t.join()
+        for seq in sorted(pending):
+            d, result = pending[seq]
+            chunks, responses = result if result is not None else (None, None)
+            yield d, chunks, responses
+        logging.info(f"Pipeline metrics: {self.metrics}")
@@ -0,0 +1,134 @@
+import logging
+import numpy as np
+
+
+class SentenceScheduler(object):
+    """
+    Length-bucketed dynamic batching of (sentence, context) pairs in front of a PerplexityEvaluator
+
+    Sentences of many documents are pooled, sorted by their total number of tokens (context plus sentence)
+    and packed into batches whose padded size (batch size x longest pair) stays under a token budget.
+    Responses are returned in the original order of every document.
+
+    A scheduler can be used wherever its evaluator is (DetectLM, ParsedCorpus.responses,
+    CachedPerplexityEvaluator, many_atomic_detections.process_texts): log_perplexity_batch and
+    log_perplexity_pairs batch under the token budget instead of in fixed batch sizes, and other
+    attributes are those of the evaluator.
+    """
+
+    def __init__(self, evaluator, max_tokens=8192, max_batch_size=64):
+        """
+        :param evaluator:  a PerplexityEvaluator
+        :param max_tokens:  token budget of a single batch, counted including padding
+        :param max_batch_size:  maximal number of pairs in a batch
+        """
+        self.evaluator = evaluator
+        self.max_tokens = max_tokens
+        self.max_batch_size = max_batch_size
+        self.stats = dict(batches=0, pairs=0, tokens=0, padded_tokens=0)
+
+    def __getattr__(self, name):
+        if name == 'evaluator':  # not yet set, e.g. while unpickling
+            raise AttributeError(name)
+        return getattr(self.evaluator, name)
+
+    def __call__(self, documents):
+        return self.score_documents(documents)
+
+    @property
+    def padding_ratio(self):
+        """
+        Fraction of the computed token positions that were padding
+        """
+        if self.stats['padded_tokens'] == 0:
+            return 0.0
+        return 1 - self.stats['tokens'] / self.stats['padded_tokens']
+
+    def reset_stats(self):
+        self.stats = dict(batches=0, pairs=0, tokens=0, padded_tokens=0)
+
+    def make_batches(self, lengths):
+        """
+        Group pair indices into buckets of similar length under the token budget
+
+        :param lengths:  number of tokens of every pair
+        :return:  list of lists of indices
+        """
+        order = np.argsort(lengths, kind='stable')
+        batches = []
+        batch = []
+        for i in order:
+            # pairs are sorted by length, so the current pair is the longest in the batch
+            if batch and ((len(batch) + 1) * lengths[i] > self.max_tokens
+                          or len(batch) >= self.max_batch_size):
+                batches.append(batch)
+                batch = []
+            batch.append(i)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def log_perplexity_pairs(self, pairs, batch_size=None, return_comments=False):
+        """
+        Evaluate log perplexity of already tokenized pairs (see PerplexityEvaluator.log_perplexity_pairs)
+
+        Pairs are fitted to the context budget and position limit of the evaluator first, so that the
+        token budget counts the tokens that are actually evaluated.
+
+        :param batch_size:  ignored; batches are formed under the token budget
+        """
+        responses = np.zeros(len(pairs), dtype=np.float32)
+        fitted = [self.evaluator._fit_pair(ids, lbl) for ids, lbl in pairs]
+        limit = self.evaluator.max_positions
+        # sliding windows are evaluated at most :limit: tokens at a time
+        lengths = np.array([min(len(ids), limit) if windowed else len(ids) for ids, _, _, windowed in fitted],
+                           dtype=np.int64)
+        for batch in self.make_batches(lengths):
+            responses[batch] = self.evaluator.log_perplexity_padded([fitted[i][:2] for i in batch])
+            self.stats['batches'] += 1
+            self.stats['pairs'] += len(batch)
+            self.stats['tokens'] += int(lengths[batch].sum())
+            self.stats['padded_tokens'] += int(lengths[batch].max()) * len(batch)
+        if len(pairs) > 0:
+            logging.info(f"Scored {len(pairs)} sentences; padding ratio so far = {self.padding_ratio:.3f}")
+        if return_comments:
+            return responses, [comment for _, _, comment, _ in fitted]
+        return responses
+
+    def log_perplexity_batch(self, texts, contexts=None, batch_size=None, return_comments=False, text_ids=None):
+        """
+        Evaluate log perplexity of many texts, each with respect to its own context (see
+        PerplexityEvaluator.log_perplexity_batch), in batches under the token budget
+        """
+        if contexts is None:
+            contexts = [None] * len(texts)
+        assert len(texts) == len(contexts)
+        pairs = self.evaluator.encode_pairs(texts, contexts, text_ids=text_ids) if len(texts) > 0 else []
+        return self.log_perplexity_pairs(pairs, return_comments=return_comments)
+
+    def score_documents(self, documents):
+        """
+        Evaluate log-perplexity of all sentences of many documents
+
+        :param documents:  list of dictionaries with keys 'text' and 'context' (lists of equal length),
+            as returned by PrepareSentenceContext. If every document has 'token_ids', the texts are not
+            tokenized again.
+        :return:  list with one array of responses per document
+        """
+        texts = []
+        contexts = []
+        text_ids = []
+        doc_sizes = []
+        for doc in documents:
+            assert len(doc['text']) == len(doc['context'])
+            texts += list(doc['text'])
+            contexts += list(doc['context'])
+            if text_ids is not None and doc.get('token_ids') is not None:
+                text_ids += list(doc['token_ids'])
+            elif len(doc['text']) > 0:
+                text_ids = None  # tokenize all texts unless every document carries its token ids
+            doc_sizes.append(len(doc['text']))
+
+        responses = self.log_perplexity_batch(texts, contexts, text_ids=text_ids)
+        offsets = np.cumsum([0] + doc_sizes)
+        return [responses[offsets[i]:offsets[i + 1]] for i in range(len(doc_sizes))]
@@ -9,6 +9,22 @@ import logging
 import numpy as np
 
 
+def empirical_survival(sxx):
+    """
+    Fraction of the samples that are greater than or equal to each sample, i.e.
+    np.mean(np.expand_dims(sxx,1) >= sxx, 0) without the n x n matrix: O(n log n) time and O(n) memory.
+    Tied samples get the same value.
+
+    Args:
+        :sxx:  sorted data
+
+    Returns:
+        1-D array of the same length as :sxx:
+    """
+    n = len(sxx)
+    return (n - np.searchsorted(sxx, sxx, side='left')) / n
+
+
 def fit_survival_func(xx, log_space=True):
     """
     Returns an estimated survival function to the data in :xx: using
@@ -27,7 +43,7 @@ def fit_survival_func(xx, log_space=True):
     inf = 1 / eps
 
     sxx = np.sort(xx)
-    qq = np.mean(np.expand_dims(sxx,1) >= sxx, 0)
+    qq = empirical_survival(sxx)
 
     if log_space:
         qq = -np.log(qq)
@@ -39,6 +55,81 @@ def fit_survival_func(xx, log_space=True):
         return interp1d(sxx, qq, fill_value=(1 , 0), bounds_error=False)
 
 
+def grouped_survival_on_grid(lengths, xx, ll, xx0, log_space=True):
+    """
+    Evaluate the empirical survival function of every length group on a grid, in one vectorized pass.
+
+    Gives the same values as evaluating fit_survival_func(xx[lengths == l], log_space)(xx0) for every
+    length l in :ll: that has samples, i.e. linear interpolation between the sorted samples of a group
+    (as numpy.interp does) and the fill values of fit_survival_func outside their range.
+    The data is sorted by (length, value) once, instead of scanning all of it for every length.
+
+    Args:
+        :lengths:, :xx:  1-D arrays
+        :ll:  lengths to evaluate
+        :xx0:  sorted grid of values
+
+    Returns:
+        (lengths of :ll: that have samples, array of shape (number of these lengths, len(xx0)))
+    """
+    xx = np.asarray(xx, dtype=np.float64)
+    lengths = np.asarray(lengths)
+    keep = np.isin(lengths, ll)
+    xx = xx[keep]
+    code = np.searchsorted(ll, lengths[keep]).astype(np.int16 if len(ll) < 2 ** 15 else np.int64)
+
+    # sort by (length, value): by value first, then a stable (radix) sort by length. The order of
+    # tied values does not matter.
+    order = np.argsort(xx)
+    order = order[np.argsort(code[order], kind='stable')]
+    sxx = xx[order]
+    scode = code[order]
+
+    counts = np.bincount(scode, minlength=len(ll))
+    ll_valid = ll[counts > 0]
+    counts = counts[counts > 0]
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    n = len(sxx)
+    L = len(ll_valid)
+    G = len(xx0)
+
+    # survival value of every sample within its group: fraction of the group >= the sample
+    group = np.repeat(np.arange(L), counts)
+    new_value = np.ones(n, dtype=bool)
+    new_value[1:] = (sxx[1:] != sxx[:-1]) | (group[1:] != group[:-1])
+    first_of_value = np.maximum.accumulate(np.where(new_value, np.arange(n), 0))
+    qq = (ends[group] - first_of_value) / counts[group]
+    if log_space:
+        qq = -np.log(qq)
+
+    # number of samples of every group that are <= every grid point: sample x counts for the grid points
+    # from searchsorted(xx0, x) on, so it is a cumulative sum of a (group, grid interval) histogram
+    first_grid_point = np.searchsorted(xx0, sxx, side='left')
+    hist = np.bincount(group * (G + 1) + first_grid_point, minlength=L * (G + 1)).reshape(L, G + 1)
+    num_le = np.cumsum(hist, axis=1)[:, :G]
+
+    # linear interpolation between samples j and j+1 of a group, where x_j <= x < x_{j+1}
+    j = starts[:, None] + np.clip(num_le - 1, 0, counts[:, None] - 1)
+    j_next = np.minimum(j + 1, ends[:, None] - 1)
+    x = np.broadcast_to(xx0, (L, G))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (qq[j_next] - qq[j]) / (sxx[j_next] - sxx[j])
+        zz = np.where(sxx[j] == x, qq[j], slope * (x - sxx[j]) + qq[j])
+
+    below = num_le == 0
+    above = x > sxx[ends - 1][:, None]
+    if log_space:
+        fill_below = np.zeros((L, 1))
+        fill_above = np.log(1 / (1 / counts))[:, None]
+    else:
+        fill_below = np.ones((L, 1))
+        fill_above = np.zeros((L, 1))
+    zz = np.where(below, fill_below, zz)
+    zz = np.where(above, fill_above, zz)
+    return ll_valid, zz
+
+
 def fit_per_length_survival_function(lengths, xx, G=501, log_space=True):
     """
     Use 2D interpolation over the empirical survival function of the pairs (length, x)
@@ -49,7 +140,8 @@ def fit_per_length_survival_function(lengths, xx, G=501, log_space=True):
         :log_space:  indicates whether result is in log space or not.
 
     Returns:
-        bivariate function (length, x) -> [0,1]
+        bivariate function (length, x) -> [0,1]. For repeated evaluation, compile it into a
+        PValueTable.
     """
 
     assert len(lengths) == len(xx)
@@ -65,21 +157,12 @@ def fit_per_length_survival_function(lengths, xx, G=501, log_space=True):
     ppx_max_val = xx.max()
     xx0 = np.linspace(ppx_min_val, ppx_max_val, G)
 
-    ll_valid = []
-    zz = []
-    for i, l in enumerate(ll):
-        xx1 = xx[lengths == l]
-        if len(xx1) > 0:
-            univariate_survival_func = fit_survival_func(xx1, log_space=log_space)
-            assert not np.isnan(univariate_survival_func(xx0)).any()  # To delete!!!!!!!!!!!!!
-            ll_valid.append(l)
-            zz.append(univariate_survival_func(xx0))
+    ll_valid, zz = grouped_survival_on_grid(lengths, xx, ll, xx0, log_space=log_space)
 
-    test_zz = np.vstack(zz)
-    assert not np.isnan(test_zz).any()
-    assert not np.isinf(test_zz).any()
+    assert not np.isnan(zz).any()
+    assert not np.isinf(zz).any()
 
-    func = RectBivariateSpline(np.array(ll_valid), xx0, np.vstack(zz))
+    func = RectBivariateSpline(ll_valid, xx0, zz)
 
     test_val = func(ll_valid[0], xx0[0])
     print(test_val)
@@ -87,6 +170,7 @@ def fit_per_length_survival_function(lengths, xx, G=501, log_space=True):
     if log_space:
         def func2d(x, y):
             return np.exp(-func(x,y))
+        func2d.spline = func  # lets PValueTable compile the function
         return func2d
     else:
         return func
\ No newline at end of file
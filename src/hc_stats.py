@@ -0,0 +1,107 @@
+"""
+Higher Criticism and Fisher's combination test computed directly on arrays of P-values.
+
+Same statistics as multitest.MultiTest(pvals, stbl).hc(gamma) and .fisher(), without constructing
+a MultiTest object per document.
+"""
+
+import numpy as np
+from scipy.stats import chi2
+
+
+def hc_fisher(pvals, gamma=0.4, stbl=True):
+    """
+    Args:
+        :pvals:  1-D array of P-values (no nans)
+        :gamma:  lower fraction of P-values to consider for HC
+        :stbl:  stable version of HC (normalize by the expected rather than the observed P-values)
+
+    Returns:
+        HC score, HC threshold (the P-value attaining HC), Fisher statistic, chi-squared P-value of
+        the Fisher statistic
+    """
+    N = len(pvals)
+    assert N > 0
+    sorted_pvals = np.sort(np.asarray(pvals, dtype=np.float64))
+    uu = np.linspace(1 / N, 1, N)
+    uu[-1] -= 1 / (1e4 + N ** 2)  # the largest P-value does not affect the result
+    if stbl:
+        denom = np.sqrt(uu * (1 - uu))
+    else:
+        denom = np.sqrt(sorted_pvals * (1 - sorted_pvals))
+    zz = np.sqrt(N) * (uu - sorted_pvals) / denom
+
+    imax = max(0, int(gamma * N + 0.5))
+    istar = np.argmax(zz[:imax]) if imax > 0 else 0
+
+    fisher = np.sum(-2 * np.log(sorted_pvals))
+    return zz[istar], sorted_pvals[istar], fisher, chi2.sf(fisher, df=2 * N)
+
+
+def hc_fisher_many(pvals, offsets, gamma=0.4, stbl=True, docs_per_chunk=4096):
+    """
+    hc_fisher of many documents at once
+
+    Args:
+        :pvals:  1-D array with the P-values of all documents; nans are not tested
+        :offsets:  1-D array of length (number of documents + 1); the P-values of document k are
+            pvals[offsets[k]:offsets[k+1]]
+        :docs_per_chunk:  documents are processed in chunks, each as a padded matrix of shape
+            (documents, largest number of P-values of a document)
+
+    Returns:
+        arrays of HC scores, HC thresholds, Fisher statistics and chi-squared P-values, one entry per
+        document (nan for documents without P-values). HC scores and thresholds equal those of hc_fisher;
+        Fisher statistics may differ in the last bits due to the summation order.
+    """
+    pvals = np.asarray(pvals, dtype=np.float64)
+    offsets = np.asarray(offsets)
+    num_docs = len(offsets) - 1
+    hc = np.full(num_docs, np.nan)
+    hct = np.full(num_docs, np.nan)
+    fisher = np.full(num_docs, np.nan)
+    fisher_pvalue = np.full(num_docs, np.nan)
+
+    doc = np.repeat(np.arange(num_docs), np.diff(offsets))
+    valid = ~np.isnan(pvals)
+    counts = np.bincount(doc[valid], minlength=num_docs)
+    for first in range(0, num_docs, docs_per_chunk):
+        docs = np.arange(first, min(first + docs_per_chunk, num_docs))
+        docs = docs[counts[docs] > 0]
+        if len(docs) == 0:
+            continue
+        N = counts[docs]
+        D, M = len(docs), N.max()
+
+        # sorted P-values of every document, padded with inf
+        sel = valid & (doc >= docs[0]) & (doc <= docs[-1]) & (counts[doc] > 0)
+        rows = np.searchsorted(docs, doc[sel])
+        order = np.lexsort((pvals[sel], rows))
+        rank = np.arange(len(order)) - np.repeat(np.cumsum(N) - N, N)
+        sorted_pvals = np.full((D, M), np.inf)
+        sorted_pvals[rows[order], rank] = pvals[sel][order]
+
+        # np.linspace(1 / N, 1, N) of every row
+        r = np.arange(M)[None, :]
+        n = N[:, None].astype(np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            uu = np.where(n > 1, r * ((1 - 1 / n) / (n - 1)) + 1 / n, 1.0)
+        uu[np.arange(D), N - 1] = 1.0
+        uu[np.arange(D), N - 1] -= 1 / (1e4 + N ** 2)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if stbl:
+                denom = np.sqrt(uu * (1 - uu))
+            else:
+                denom = np.sqrt(sorted_pvals * (1 - sorted_pvals))
+            zz = np.sqrt(n) * (uu - sorted_pvals) / denom
+
+        imax = np.maximum(0, (gamma * N + 0.5).astype(int))
+        istar = np.argmax(np.where(r < imax[:, None], zz, -np.inf), axis=1)  # 0 if imax == 0
+        hc[docs] = zz[np.arange(D), istar]
+        hct[docs] = sorted_pvals[np.arange(D), istar]
+
+        # padding slots contribute log(1) = 0; P-values above 1 are kept, as in hc_fisher
+        fisher[docs] = (-2 * np.log(np.where(r < N[:, None], sorted_pvals, 1.0))).sum(axis=1)
+        fisher_pvalue[docs] = chi2.sf(fisher[docs], df=2 * N)
+    return hc, hct, fisher, fisher_pvalue
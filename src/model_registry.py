@@ -0,0 +1,65 @@
+"""
+Registry of auxiliary models (summarizer, question generator, ...) that are created lazily on first use.
+
+A model is registered with a factory function and default keyword arguments. Nothing is loaded
+until the first call to registry.get(name), so processes that never use a model never pay for it.
+Settings can be changed with registry.configure(name, ...) before (or after) first use.
+
+Example:
+    from src.model_registry import registry
+    registry.configure('summarizer', model='sshleifer/distilbart-cnn-12-6', device=-1)
+    summarizer = registry.get('summarizer')
+"""
+
+import logging
+import threading
+
+
+class ModelRegistry(object):
+    def __init__(self):
+        self._factories = {}
+        self._configs = {}
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, factory, **config):
+        """
+        :param name:  name of the model
+        :param factory:  function creating the model from the keyword arguments in :config:
+        """
+        with self._lock:
+            self._factories[name] = factory
+            self._configs.setdefault(name, {})
+            for k, v in config.items():
+                self._configs[name].setdefault(k, v)
+
+    def configure(self, name, **config):
+        """
+        Update the settings of a model. A model that was already created is dropped and
+        created again with the new settings on its next use.
+        """
+        with self._lock:
+            self._configs.setdefault(name, {}).update(config)
+            self._instances.pop(name, None)
+
+    def get_config(self, name):
+        return dict(self._configs.get(name, {}))
+
+    def get(self, name):
+        with self._lock:
+            if name not in self._instances:
+                if name not in self._factories:
+                    raise KeyError(f"No model registered under the name {name}")
+                logging.info(f"Loading {name} with settings {self._configs[name]}...")
+                self._instances[name] = self._factories[name](**self._configs[name])
+            return self._instances[name]
+
+    def is_loaded(self, name):
+        return name in self._instances
+
+    def unload(self, name):
+        with self._lock:
+            self._instances.pop(name, None)
+
+
+registry = ModelRegistry()
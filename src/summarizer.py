@@ -1,21 +1,131 @@
-from transformers import pipeline
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
 import torch
+from src.model_registry import registry
 
-device = 0 if torch.cuda.is_available() else -1  # use GPU if available, otherwise CPU
-summarizer = pipeline("summarization", model="facebook/bart-large-cnn", device=device)
+SUMMARY_MAX_LENGTH = 130
+SUMMARY_MIN_LENGTH = 30
+MEMO_SIZE = 10000
 
+_memo = OrderedDict()  # in-process memo of recent summaries: key -> summary
+_memo_lock = threading.Lock()  # context threads of a SentencePipeline share the memo
 
-def summarize(text):
+
+def load_summarizer(model="facebook/bart-large-cnn", device=None):
+    from transformers import pipeline  # imported here to keep importing this module cheap
+
+    if device is None:
+        device = 0 if torch.cuda.is_available() else -1  # use GPU if available, otherwise CPU
+    return pipeline("summarization", model=model, device=device)
+
+
+registry.register('summarizer', load_summarizer, model="facebook/bart-large-cnn")
+
+
+class SummaryCache(object):
+    """
+    Persistent cache of summaries in an SQLite database, keyed by summary_key. Safe to share
+    between threads and processes: each of them opens its own connection.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT)")
+            conn.commit()
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def get_many(self, keys):
+        conn = self._connect()
+        found = {}
+        keys = list(set(keys))
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            found.update(conn.execute(f"SELECT key, summary FROM summaries WHERE key IN "
+                                      f"({','.join('?' * len(chunk))})", chunk).fetchall())
+        return found
+
+    def put_many(self, items):
+        conn = self._connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO summaries (key, summary) VALUES (?, ?)", list(items.items()))
+
+
+def summary_key(text):
+    """
+    Hash of the text and of the summarizer settings
+    """
+    h = hashlib.sha256()
+    for field in [registry.get_config('summarizer').get('model'), SUMMARY_MAX_LENGTH, SUMMARY_MIN_LENGTH, text]:
+        h.update(repr(field).encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+def summarize_many(texts, batch_size=8, cache=None):
+    """
+    Summarize many texts. Summaries are looked up in an in-process memo and in :cache: (a SummaryCache)
+    first; the remaining unique texts are summarized in batches of :batch_size:.
+
+    :return:  list of summaries
+    """
+    keys = [summary_key(text) for text in texts]
+    with _memo_lock:
+        found = {k: _memo[k] for k in keys if k in _memo}
+    if cache is not None and len(found) < len(set(keys)):
+        found.update(cache.get_many([k for k in keys if k not in found]))
+
+    missing = OrderedDict((k, text) for k, text in zip(keys, texts) if k not in found)
+    if missing:
+        summarizer = registry.get('summarizer')
+        # print(f"device summarizer is on = {next(summarizer.model.parameters()).device}")
+        summarized = summarizer(list(missing.values()), batch_size=batch_size, max_length=SUMMARY_MAX_LENGTH,
+                                min_length=SUMMARY_MIN_LENGTH, do_sample=False, truncation=True)
+        new_items = {k: (s[0] if isinstance(s, list) else s)['summary_text']
+                     for k, s in zip(missing, summarized)}
+        if cache is not None:
+            cache.put_many(new_items)
+        found.update(new_items)
+
+    with _memo_lock:
+        for k in keys:
+            _memo[k] = found[k]
+            _memo.move_to_end(k)
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return [found[k] for k in keys]
+
+
+def summarize(text, cache=None):
     """
     Summarize text using the summarizer pipeline
     truncation applies to end of input text
     exceeding input length was viewed only in specific sample of 'news-gpt-long' dataset
 
+    The summarizer is loaded on first use (see src.model_registry), and summaries are
+    memoized (see summarize_many)
     """
-    # print(f"device summarizer is on = {next(summarizer.model.parameters()).device}")
-    summarized = summarizer(text, max_length=130, min_length=30, do_sample=False, truncation=True)
-    summary_text = summarized[0]['summary_text']
-    return summary_text
+    return summarize_many([text], cache=cache)[0]
 
 
 
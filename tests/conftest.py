@@ -0,0 +1,101 @@
+"""
+Fixtures shared by the tests: a tiny randomly initialized GPT-2 with a byte-level BPE tokenizer trained
+on the test texts, and a blank spaCy pipeline with a sentencizer in place of en_core_web_sm, so that the
+tests run without downloading models.
+"""
+
+import os
+import sys
+import pytest
+import spacy
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.PrepareSentenceContext import PrepareSentenceContext  # noqa: E402
+
+TEXTS = [
+    "The cat sat on the mat. It was happy there. Then it left the room! Why did it go? Nobody knows. The end.",
+    "<h1> A title </h1>\n\nFirst line of the text. A second sentence follows here. A third one. "
+    "The fourth sentence is a little longer than the others. Fifth line.",
+    "A single sentence only.",
+    "He said \"no.\" (Really.) 'Yes' they said... Numbers like 123 follow. And 45 more are here.",
+    "Another document starts here. \n\n A new paragraph starts here. Short. This is the end of it all.",
+    "Language models assign probabilities to text. Detectors compare these probabilities with a null model. "
+    "Sentences that are too likely are suspicious. Higher criticism combines many weak signals into one test.",
+]
+
+
+def blank_spacy(sentence_segmenter='parser'):
+    nlp = spacy.blank('en')
+    nlp.add_pipe('sentencizer')
+    return nlp
+
+
+@pytest.fixture(autouse=True)
+def no_spacy_model(monkeypatch):
+    monkeypatch.setattr(PrepareSentenceContext, 'load_spacy', staticmethod(blank_spacy))
+
+
+@pytest.fixture(scope='session')
+def tokenizer(tmp_path_factory):
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import GPT2TokenizerFast
+
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(TEXTS * 5, vocab_size=400, min_frequency=1, show_progress=False)
+    path = str(tmp_path_factory.mktemp('tokenizer') / 'tokenizer.json')
+    bpe.save(path)
+    tok = GPT2TokenizerFast(tokenizer_file=path)
+    tok.name_or_path = 'tiny-bpe'
+    return tok
+
+
+def make_model(tokenizer, n_positions=128):
+    from transformers import GPT2Config, GPT2LMHeadModel
+
+    torch.manual_seed(0)
+    config = GPT2Config(vocab_size=len(tokenizer), n_positions=n_positions, n_embd=32, n_layer=2, n_head=2,
+                        bos_token_id=0, eos_token_id=0)
+    return GPT2LMHeadModel(config).eval()
+
+
+class CountingTokenizer(object):
+    """
+    Tokenizer wrapper counting the calls to the tokenizer
+    """
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.tokenizer(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.tokenizer, name)
+
+
+@pytest.fixture(scope='session')
+def model(tokenizer):
+    return make_model(tokenizer)
+
+
+@pytest.fixture
+def evaluator(model, tokenizer):
+    from src.PerplexityEvaluator import PerplexityEvaluator
+    return PerplexityEvaluator(model, tokenizer)
+
+
+@pytest.fixture
+def fake_registry(monkeypatch):
+    """
+    The model registry with its factories, settings and instances restored after the test, so that a
+    test can register fake models under the names of real ones
+    """
+    from src.model_registry import registry
+
+    monkeypatch.setattr(registry, '_factories', dict(registry._factories))
+    monkeypatch.setattr(registry, '_configs', {name: dict(c) for name, c in registry._configs.items()})
+    monkeypatch.setattr(registry, '_instances', {})
+    return registry
@@ -0,0 +1,113 @@
+import numpy as np
+import pytest
+from src.DetectLM import DetectLM
+
+
+def survival(length, x):
+    return np.exp(-np.asarray(x) / length)
+
+
+def reference_pvalue(detector, response, length):
+    """
+    Per-sentence min/max length policy
+    """
+    if length < detector.min_len:
+        return np.nan, "ignored (below minimal length)"
+    if length > detector.max_len:
+        if detector.length_limit_policy == 'ignore':
+            return np.nan, "ignored (above maximum limit)"
+        comment = (f"truncated to {detector.max_len} tokens" if detector.length_limit_policy == 'truncate'
+                   else "exceeding length limit; resorted to max-available length")
+        return survival(detector.max_len, response), comment
+    return survival(length, response), "OK"
+
+
+@pytest.mark.parametrize('policy', ['truncate', 'ignore', 'max_available'])
+def test_responses_equal_per_sentence_policy(policy):
+    detector = DetectLM(None, survival, min_len=3, max_len=10, length_limit_policy=policy)
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(1, 15, size=40)
+    responses = rng.uniform(0, 20, size=40)
+    res = detector.test_responses(responses, lengths)
+    expected = [reference_pvalue(detector, r, l) for r, l in zip(responses, lengths)]
+    np.testing.assert_allclose(res['pvalue'], [p for p, _ in expected], rtol=1e-12)
+    assert list(res['comment']) == [c for _, c in expected]
+    assert res['mask'] is not None and not res['mask'][np.isnan(res['pvalue'])].any()
+
+
+@pytest.mark.parametrize('policy', ['previous-sentence', 'document'])
+@pytest.mark.parametrize('ignore_first_sentence', [False, True])
+def test_detect_many_equals_call(evaluator, policy, ignore_first_sentence):
+    from src.PrepareSentenceContext import PrepareSentenceContext
+    from conftest import TEXTS
+
+    parser = PrepareSentenceContext(context_policy=policy)
+    detector = DetectLM(evaluator, survival, min_len=2, max_len=8, ignore_first_sentence=ignore_first_sentence)
+    documents = [parser(text) for text in TEXTS]
+    many = detector.detect_many(documents, return_sentences=True, docs_per_batch=4)
+    for k, doc in enumerate(documents):
+        single = detector(doc['text'], doc['context'], document=doc.get('document'), spans=doc.get('spans'),
+                          lengths=doc['length'], token_ends=doc['token_ends'], token_ids=doc['token_ids'])
+        row = many['documents'].iloc[k]
+        sentences = many['sentences'].iloc[many['offsets'][k]:many['offsets'][k + 1]]
+        # responses come from differently padded batches, so they agree up to float32 rounding
+        np.testing.assert_allclose([row['HC'], row['fisher']], [single['HC'], single['fisher']],
+                                   rtol=1e-5, equal_nan=True)
+        np.testing.assert_allclose(sentences['response'], single['sentences']['response'], rtol=1e-5)
+        np.testing.assert_allclose(sentences['pvalue'], single['sentences']['pvalue'], rtol=1e-4, equal_nan=True)
+        assert list(sentences['comment']) == list(single['sentences']['comment'])
+
+
+def test_token_ids_are_truncated_and_not_tokenized_again(model, tokenizer):
+    from src.PerplexityEvaluator import PerplexityEvaluator
+    from src.PrepareSentenceContext import PrepareSentenceContext
+    from conftest import TEXTS, CountingTokenizer
+
+    parser = PrepareSentenceContext(length_unit='bpe', tokenizer=tokenizer)
+    counting = CountingTokenizer(tokenizer)
+    detector = DetectLM(PerplexityEvaluator(model, counting), survival, min_len=2, max_len=6)
+    documents = [parser(text) for text in TEXTS]
+    many = detector.detect_many(documents, return_sentences=True, docs_per_batch=4)
+    single = [detector(doc['text'], doc['context'], lengths=doc['length'], token_ends=doc['token_ends'],
+                       token_ids=doc['token_ids'])['sentences'] for doc in documents]
+    assert counting.calls == 0
+
+    truncated = [ids[:6] for doc in documents for ids in doc['token_ids']]
+    assert max(len(ids) for doc in documents for ids in doc['token_ids']) > 6
+    expected = PerplexityEvaluator(model, tokenizer).log_perplexity_batch([''] * len(truncated),
+                                                                          text_ids=truncated)
+    np.testing.assert_allclose(many['sentences']['response'], expected, rtol=1e-5)
+    np.testing.assert_allclose(np.concatenate([df['response'] for df in single]), expected, rtol=1e-5)
+
+
+@pytest.mark.parametrize('length_unit', ['spacy', 'bpe'])
+def test_lengths_in_the_unit_of_the_parser(tokenizer, length_unit):
+    from src.PrepareSentenceContext import PrepareSentenceContext
+    from conftest import TEXTS
+
+    parser = PrepareSentenceContext(length_unit=length_unit, tokenizer=tokenizer)
+    detector = DetectLM(None, survival, max_len=6, parser=parser)
+    chunks = parser(TEXTS[5])
+    truncated, lengths, text_ids = detector.prepare_sentences(chunks['text'])
+    assert list(lengths) == chunks['length'] == [detector._get_length(sent) for sent in chunks['text']]
+    assert truncated == detector.prepare_sentences(chunks['text'], lengths=chunks['length'],
+                                                   token_ends=chunks['token_ends'])[0]
+    if length_unit == 'bpe':
+        assert text_ids == [ids[:6] for ids in chunks['token_ids']]
+    else:
+        assert text_ids is None
+
+
+def test_detect_many_with_scheduler(evaluator):
+    from src.PrepareSentenceContext import PrepareSentenceContext
+    from src.SentenceScheduler import SentenceScheduler
+    from conftest import TEXTS
+
+    parser = PrepareSentenceContext(context_policy='previous-sentence')
+    documents = [parser(text) for text in TEXTS]
+    scheduler = SentenceScheduler(evaluator, max_tokens=128)
+    scheduled = DetectLM(scheduler, survival, min_len=2, max_len=8).detect_many(documents, return_sentences=True)
+    plain = DetectLM(evaluator, survival, min_len=2, max_len=8).detect_many(documents, return_sentences=True)
+    np.testing.assert_allclose(scheduled['sentences']['response'], plain['sentences']['response'], rtol=1e-5)
+    assert list(scheduled['sentences']['comment']) == list(plain['sentences']['comment'])
+    assert scheduler.stats['pairs'] == len(plain['sentences']) and scheduler.stats['batches'] > 1
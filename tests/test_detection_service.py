@@ -0,0 +1,88 @@
+import asyncio
+import json
+import numpy as np
+from src.DetectLM import DetectLM
+from src.DetectionService import DetectionService
+from src.PrepareSentenceContext import PrepareSentenceContext
+from conftest import TEXTS, CountingTokenizer
+
+
+def survival(length, x):
+    return np.exp(-np.asarray(x) / length)
+
+
+async def request(port, method, path, payload=None):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = json.dumps(payload).encode('utf-8') if payload is not None else b''
+    writer.write(f"{method} {path} HTTP/1.1\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n"
+                 .encode('latin-1') + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, data = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(data)
+
+
+def make_service(evaluator, **kwargs):
+    detector = DetectLM(evaluator, survival, min_len=4, max_len=50)
+    return DetectionService(detector, PrepareSentenceContext(context_policy='previous-sentence'), **kwargs)
+
+
+def test_detect_health_and_overload(evaluator):
+    service = make_service(evaluator, max_batch_size=8, max_wait_ms=5)
+    overloaded = make_service(evaluator, max_in_flight=0)
+
+    async def scenario():
+        server = await service.start(port=0)
+        port = server.sockets[0].getsockname()[1]
+        busy_server = await overloaded.start(port=0)
+        busy_port = busy_server.sockets[0].getsockname()[1]
+        try:
+            results = await asyncio.gather(*[request(port, 'POST', '/detect', dict(text=text, id=k))
+                                             for k, text in enumerate(TEXTS)])
+            health = await request(port, 'GET', '/health')
+            bad = await request(port, 'POST', '/detect', dict(txt='no text'))
+            refused = await request(busy_port, 'POST', '/detect', dict(text=TEXTS[0]))
+        finally:
+            server.close()
+            busy_server.close()
+        return results, health, bad, refused
+
+    results, health, bad, refused = asyncio.run(scenario())
+    parser = PrepareSentenceContext(context_policy='previous-sentence')
+    for k, (status, out) in enumerate(results):
+        assert status == 200 and out['id'] == k
+        expected = service.detector(parser(TEXTS[k])['text'], parser(TEXTS[k])['context'])
+        np.testing.assert_allclose([s['response'] for s in out['sentences']],
+                                   expected['sentences']['response'], rtol=1e-5)
+        for s in out['sentences']:
+            assert (s['mask'] is None) == (s['pvalue'] is None)
+    assert any(s['mask'] is None for _, out in results for s in out['sentences'])  # short sentences
+    assert health[0] == 200 and health[1]['status'] == 'ok' and health[1]['context_policy'] == 'previous-sentence'
+    assert bad[0] == 400
+    assert refused[0] == 503
+
+
+def test_detect_scores_the_parsed_token_ids(model, tokenizer):
+    from src.PerplexityEvaluator import PerplexityEvaluator
+
+    counting = CountingTokenizer(tokenizer)
+    detector = DetectLM(PerplexityEvaluator(model, counting), survival, min_len=2, max_len=6)
+    parser = PrepareSentenceContext(length_unit='bpe', tokenizer=tokenizer)
+    service = DetectionService(detector, parser)
+
+    async def scenario():
+        server = await service.start(port=0)
+        try:
+            return await service.detect(TEXTS[5])
+        finally:
+            server.close()
+
+    out = asyncio.run(scenario())
+    assert counting.calls == 0
+    chunks = parser(TEXTS[5])
+    expected = detector(chunks['text'], chunks['context'], lengths=chunks['length'],
+                        token_ends=chunks['token_ends'], token_ids=chunks['token_ids'])
+    np.testing.assert_allclose([s['response'] for s in out['sentences']],
+                               expected['sentences']['response'], rtol=1e-5)
+    assert [s['length'] for s in out['sentences']] == chunks['length']
@@ -0,0 +1,36 @@
+import numpy as np
+from src.fit_survival_function import (empirical_survival, fit_survival_func, grouped_survival_on_grid,
+                                       fit_per_length_survival_function)
+
+
+def _null_data(n=3000, seed=0):
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(3, 20, size=n)
+    xx = np.round(rng.gamma(4, 1, size=n) + 0.1 * lengths, 2)  # rounded, so there are ties
+    return lengths, xx
+
+
+def test_empirical_survival_equals_matrix():
+    _, xx = _null_data()
+    sxx = np.sort(xx)
+    assert np.array_equal(empirical_survival(sxx), np.mean(np.expand_dims(sxx, 1) >= sxx, 0))
+
+
+def test_grouped_survival_equals_per_length_fits():
+    lengths, xx = _null_data()
+    ll = np.arange(lengths.min(), lengths.max() + 3)  # the last lengths have no samples
+    xx0 = np.linspace(xx.min() - 1, xx.max() + 1, 301)
+    for log_space in [True, False]:
+        ll_valid, zz = grouped_survival_on_grid(lengths, xx, ll, xx0, log_space=log_space)
+        assert list(ll_valid) == sorted(set(lengths))
+        expected = [fit_survival_func(xx[lengths == l], log_space=log_space)(xx0) for l in ll_valid]
+        np.testing.assert_allclose(zz, expected, rtol=1e-10, atol=1e-12)
+
+
+def test_pvalue_table_close_to_spline():
+    from src.PValueTable import PValueTable
+    lengths, xx = _null_data()
+    func = fit_per_length_survival_function(lengths, xx, G=201)
+    table = PValueTable.from_survival_function(func, G=2001)
+    assert table.error_report(n=20000)['max_abs_error'] < 1e-3
+    assert np.isnan(table.pvalues(np.array([5, 6]), np.array([np.nan, 4.0]))[0])
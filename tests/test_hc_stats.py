@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+from multitest import MultiTest
+from src.hc_stats import hc_fisher, hc_fisher_many
+
+
+@pytest.mark.parametrize('stbl', [True, False])
+def test_hc_fisher_equals_multitest(stbl):
+    pvals = np.random.default_rng(0).uniform(size=30) ** 2
+    mt = MultiTest(pvals, stbl=stbl)
+    np.testing.assert_allclose(hc_fisher(pvals, gamma=0.4, stbl=stbl), mt.hc(gamma=0.4) + mt.fisher())
+
+
+@pytest.mark.parametrize('stbl', [True, False])
+def test_many_equals_single(stbl):
+    rng = np.random.default_rng(1)
+    docs = [rng.uniform(size=n) ** 2 for n in rng.integers(1, 40, size=50)]
+    docs[3][[0, 5 % len(docs[3])]] = np.nan  # untested sentences
+    docs += [np.array([np.nan, np.nan]), np.array([]), np.array([0.1, 1.2, 0.5]), np.array([1.3])]
+    offsets = np.concatenate([[0], np.cumsum([len(d) for d in docs])])
+    many = hc_fisher_many(np.concatenate(docs), offsets, gamma=0.4, stbl=stbl, docs_per_chunk=16)
+    for k, d in enumerate(docs):
+        d = d[~np.isnan(d)]
+        expected = hc_fisher(d, gamma=0.4, stbl=stbl) if len(d) else [np.nan] * 4
+        np.testing.assert_allclose([stat[k] for stat in many], expected, rtol=1e-12, equal_nan=True)
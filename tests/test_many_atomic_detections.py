@@ -0,0 +1,83 @@
+import os
+import types
+import pandas as pd
+import pytest
+import torch
+from src.PrepareSentenceContext import PrepareSentenceContext
+from many_atomic_detections import iterate_over_texts, iterate_over_texts_parallel, process_text, main_colab
+from conftest import TEXTS
+
+DATASET = [dict(id=f"doc{i}", text=text) for i, text in enumerate(TEXTS)]
+
+
+@pytest.fixture
+def responses_dir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('Responses')
+    return tmp_path / 'Responses'
+
+
+@pytest.fixture
+def parser():
+    return PrepareSentenceContext(context_policy='previous-sentence')
+
+
+def test_writer_matches_to_csv(responses_dir, evaluator, parser):
+    iterate_over_texts(DATASET, evaluator, parser, output_file='out.csv')
+    records = [dict(process_text(d['text'], evaluator, parser), name=d['id']) for d in DATASET]
+    expected = pd.concat([pd.DataFrame(dict(num=r['chunk_ids'], length=r['lengths'], response=r['responses'],
+                                            context_length=r['context_lengths'], name=r['name']))
+                          for r in records], ignore_index=True)
+    df = pd.read_csv(responses_dir / 'out.csv', index_col=0)
+    pd.testing.assert_frame_equal(df, expected, check_dtype=False, rtol=1e-5)
+
+
+def test_resumed_equals_uninterrupted(responses_dir, evaluator, parser):
+    iterate_over_texts(DATASET, evaluator, parser, output_file='full.csv')
+    iterate_over_texts(DATASET[:3], evaluator, parser, output_file='resumed.csv')
+    with open(responses_dir / 'resumed.csv', 'a') as f:  # a document interrupted before its checkpoint
+        f.write("17,1,5,3.2,0,doc3\n18,2,")
+    iterate_over_texts(DATASET, evaluator, parser, output_file='resumed.csv', resume=True)
+    assert (responses_dir / 'resumed.csv').read_bytes() == (responses_dir / 'full.csv').read_bytes()
+
+
+@pytest.mark.parametrize('policy', ['previous-sentence', 'document'])
+def test_scheduled_groups_equal_per_document(responses_dir, evaluator, policy):
+    from src.SentenceScheduler import SentenceScheduler
+    parser = PrepareSentenceContext(context_policy=policy)
+    scheduler = SentenceScheduler(evaluator, max_tokens=256)
+    iterate_over_texts(DATASET, evaluator, parser, output_file='single.csv')
+    iterate_over_texts(DATASET, scheduler, parser, output_file='scheduled.csv', docs_per_batch=4)
+    pd.testing.assert_frame_equal(pd.read_csv(responses_dir / 'scheduled.csv', index_col=0),
+                                  pd.read_csv(responses_dir / 'single.csv', index_col=0), rtol=1e-5)
+    assert scheduler.stats['pairs'] == (0 if policy == 'document' else
+                                        sum(len(parser(d['text'])['text']) for d in DATASET))
+
+
+def test_parallel_equals_sequential(responses_dir, evaluator, parser):
+    iterate_over_texts(DATASET, evaluator, parser, output_file='sequential.csv')
+    iterate_over_texts_parallel(DATASET, evaluator, parser, output_file='parallel.csv', num_workers=2)
+    assert (responses_dir / 'parallel.csv').read_bytes() == (responses_dir / 'sequential.csv').read_bytes()
+    assert sorted(os.listdir(responses_dir)) == ['parallel.csv', 'sequential.csv', 'sequential.csv.ckpt']
+
+
+def test_parallel_refuses_accelerators(responses_dir, parser):
+    detector = types.SimpleNamespace(model=types.SimpleNamespace(device=torch.device('cuda')))
+    with pytest.raises(ValueError, match='CPU'):
+        iterate_over_texts_parallel(DATASET, detector, parser, output_file='parallel.csv', num_workers=2)
+
+
+def test_main_colab(responses_dir, tmp_path, model, tokenizer):
+    model_dir = str(tmp_path / 'tiny-gpt2')
+    model.save_pretrained(model_dir)
+    tokenizer.save_pretrained(model_dir)
+    texts_dir = tmp_path / 'texts'
+    texts_dir.mkdir()
+    for d in DATASET[:3]:
+        (texts_dir / f"{d['id']}.txt").write_text(d['text'])
+    os.mkdir(responses_dir / 'results')
+
+    main_colab(str(texts_dir) + '/', 'results', model_dir, context=True, human=False, shuffle=False,
+               describe_datasets=False)
+    df = pd.read_csv(responses_dir / 'results' / 'tiny-gpt2_previous_sentence_files_machine.csv', index_col=0)
+    assert df['name'].nunique() == 3 and not df['response'].isna().any()
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+import pytest
+from src.model_registry import ModelRegistry
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_loads_no_model():
+    code = ("import src.PrepareSentenceContext\n"
+            "from src.model_registry import registry\n"
+            "assert {'summarizer', 'question_generator'} <= set(registry._factories)\n"
+            "assert registry._instances == {}, registry._instances\n")
+    subprocess.run([sys.executable, '-c', code], check=True, cwd=ROOT)
+
+
+def test_models_are_created_once_and_again_after_configure():
+    calls = []
+
+    def factory(**config):
+        calls.append(config)
+        return object()
+
+    registry = ModelRegistry()
+    registry.register('fake', factory, model='small', device=-1)
+    assert not registry.is_loaded('fake') and calls == []
+    first = registry.get('fake')
+    assert registry.get('fake') is first and calls == [dict(model='small', device=-1)]
+
+    registry.configure('fake', model='large')
+    assert not registry.is_loaded('fake')
+    second = registry.get('fake')
+    assert second is not first and calls[-1] == dict(model='large', device=-1)
+    assert registry.get_config('fake') == dict(model='large', device=-1)
+
+    registry.register('fake', factory, model='small')  # registering again keeps configured settings
+    assert registry.get_config('fake')['model'] == 'large'
+
+
+def test_unregistered_model():
+    with pytest.raises(KeyError, match="missing"):
+        ModelRegistry().get('missing')
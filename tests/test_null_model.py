@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from src.NullModel import NullModel, NullModelMismatch
+from test_fit_survival_function import _null_data
+
+
+def test_save_load_round_trip(tmp_path):
+    lengths, xx = _null_data()
+    null_model = NullModel.fit(lengths, xx, model_name='tiny', context_policy=None, min_length=3, max_length=20,
+                               G=51, table_points=201, length_unit='bpe')
+    path = str(tmp_path / 'null.model')
+    null_model.save(path)
+    loaded = NullModel.load(path, model_name='tiny', context_policy=None, length_unit='bpe')
+
+    assert loaded.metadata['num_null_samples'] == len(xx)
+    probe_lengths, probe_responses = lengths[:500], xx[:500] + 0.3
+    np.testing.assert_array_equal(loaded.pvalues(probe_lengths, probe_responses),
+                                  null_model.pvalues(probe_lengths, probe_responses))
+    for settings in [dict(model_name='gpt2'), dict(context_policy='previous-sentence'), dict(length_unit='spacy')]:
+        with pytest.raises(NullModelMismatch):
+            NullModel.load(path, **settings)
@@ -0,0 +1,130 @@
+import re
+import numpy as np
+import pytest
+from src.PerplexityEvaluator import PerplexityEvaluator
+from conftest import TEXTS
+
+SENTENCES = ["The cat sat on the mat.", "It was happy there.", "Then it left the room!", "Short.",
+             "Higher criticism combines many weak signals into one test."]
+CONTEXTS = [None, "The cat sat on the mat.", "", "A new paragraph starts here. Short.", TEXTS[5]]
+
+
+def test_batch_equals_single(evaluator):
+    single = np.array([evaluator.log_perplexity(s, c) for s, c in zip(SENTENCES, CONTEXTS)])
+    for batch_size in [1, 2, 16]:
+        batched = evaluator.log_perplexity_batch(SENTENCES, CONTEXTS, batch_size=batch_size)
+        np.testing.assert_allclose(batched, single, rtol=1e-5, atol=1e-5)
+
+
+def test_batch_without_contexts(evaluator):
+    np.testing.assert_allclose(evaluator.log_perplexity_batch(SENTENCES),
+                               [evaluator.log_perplexity(s) for s in SENTENCES], rtol=1e-5, atol=1e-5)
+    assert len(evaluator.log_perplexity_batch([], [])) == 0
+
+
+def test_scheduler_equals_batch(evaluator):
+    from src.SentenceScheduler import SentenceScheduler
+    documents = [dict(text=SENTENCES[:3], context=CONTEXTS[:3]), dict(text=[], context=[]),
+                 dict(text=SENTENCES[3:], context=CONTEXTS[3:])]
+    scheduler = SentenceScheduler(evaluator, max_tokens=64, max_batch_size=2)
+    responses = scheduler(documents)
+    assert [len(r) for r in responses] == [3, 0, 2]
+    np.testing.assert_allclose(np.concatenate(responses), evaluator.log_perplexity_batch(SENTENCES, CONTEXTS),
+                               rtol=1e-5, atol=1e-5)
+    assert scheduler.stats['pairs'] == len(SENTENCES)
+
+
+def test_scheduler_budgets_fitted_pairs(model, tokenizer):
+    from src.SentenceScheduler import SentenceScheduler
+    budgeted = PerplexityEvaluator(model, tokenizer, context_budget=4)
+    contexts = [TEXTS[5]] * len(SENTENCES)
+    pairs = budgeted.encode_pairs(SENTENCES, contexts)
+    fitted = [budgeted._fit_pair(ids, lbl)[:2] for ids, lbl in pairs]
+    scheduler = SentenceScheduler(budgeted, max_tokens=4 * max(len(ids) for ids, _ in fitted))
+    responses, comments = scheduler.log_perplexity_batch(SENTENCES, contexts, return_comments=True)
+    np.testing.assert_allclose(responses, budgeted.log_perplexity_batch(SENTENCES, contexts), rtol=1e-5, atol=1e-5)
+    assert comments == budgeted.budget_comments(pairs)
+    # raw pairs hold the whole context and would not fit four to a batch
+    assert scheduler.stats['tokens'] == sum(len(ids) for ids, _ in fitted) < sum(len(ids) for ids, _ in pairs)
+    assert scheduler.stats['batches'] == 2
+
+
+def test_reuse_prefix_equals_plain(evaluator, model, tokenizer):
+    reusing = PerplexityEvaluator(model, tokenizer, reuse_prefix=True)
+    context = TEXTS[5]
+    # the second batch shares only part of the first context, so the cached prefix is cropped
+    for ctx in [context, context[:60], context]:
+        contexts = [ctx] * len(SENTENCES)
+        np.testing.assert_allclose(reusing.log_perplexity_batch(SENTENCES, contexts),
+                                   evaluator.log_perplexity_batch(SENTENCES, contexts), rtol=1e-5, atol=1e-5)
+    assert len(reusing._prefix_ids) > 0
+
+
+def test_document_equals_pairs(evaluator, tokenizer):
+    document = TEXTS[0]
+    spans = [(m.start(), m.end()) for m in re.finditer(r"[^.!?]+[.!?]", document)]
+    enc = tokenizer(document, return_offsets_mapping=True)
+    ids = list(enc['input_ids'])
+    # score every sentence as a pair whose context is the document tokens preceding it
+    pairs = []
+    for start, end in spans:
+        own = [start <= e - 1 < end for _, e in enc['offset_mapping']]
+        last = max(t for t, o in enumerate(own) if o)
+        pairs.append((ids[:last + 1], [i if o else evaluator.ignore_index for i, o in zip(ids, own)][:last + 1]))
+    np.testing.assert_allclose(evaluator.log_perplexity_document(document, spans),
+                               evaluator.log_perplexity_pairs(pairs), rtol=1e-5, atol=1e-5)
+
+    sentence = SENTENCES[4]
+    np.testing.assert_allclose(evaluator.log_perplexity_document(sentence, [(0, len(sentence))]),
+                               [evaluator.log_perplexity(sentence)], rtol=1e-5, atol=1e-5)
+
+
+def test_context_budget_equals_truncated_context(evaluator, model, tokenizer):
+    budgeted = PerplexityEvaluator(model, tokenizer, context_budget=5)
+    pairs = evaluator.encode_pairs(SENTENCES, CONTEXTS)
+    truncated = []
+    for ids, lbl in pairs:
+        context_len = sum(label == evaluator.ignore_index for label in lbl)
+        cut = max(context_len - 5, 0)
+        truncated.append((ids[cut:], lbl[cut:]))
+    responses, comments = budgeted.log_perplexity_batch(SENTENCES, CONTEXTS, return_comments=True)
+    np.testing.assert_allclose(responses, evaluator.log_perplexity_pairs(truncated), rtol=1e-5, atol=1e-5)
+    assert comments[0] is None and comments[4] == "context truncated to 5 tokens"
+
+
+def test_sliding_window_equals_per_token_windows(tokenizer):
+    import torch
+    from conftest import make_model
+    model = make_model(tokenizer, n_positions=16)
+    windowed = PerplexityEvaluator(model, tokenizer, sliding_window=True, window_stride=6)
+    ids = tokenizer(TEXTS[5])['input_ids']
+    assert len(ids) > 40
+
+    # token t is predicted by the first window (starting at a multiple of the stride) that reaches it
+    expected = []
+    for t in range(1, len(ids)):
+        begin = max(0, -(-(t - 15) // 6) * 6)
+        with torch.inference_mode():
+            logits = model(input_ids=torch.tensor([ids[begin:t + 1]])).logits[0, -2]
+        expected.append(float(-torch.log_softmax(logits, dim=-1)[ids[t]]))
+    np.testing.assert_allclose(windowed.token_losses(ids, stride=6)[1:], expected, rtol=1e-4, atol=1e-5)
+
+    response, comments = windowed.log_perplexity_batch([TEXTS[5]], return_comments=True)
+    np.testing.assert_allclose(response, [np.mean(expected)], rtol=1e-5)
+    assert comments == ["scored in sliding windows of 16 tokens with stride 6"]
+
+
+def test_linear_layers_equal_conv1d(evaluator, model, tokenizer):
+    import copy
+    from src.PerplexityEvaluator import _conv1d_to_linear
+    converted = PerplexityEvaluator(_conv1d_to_linear(copy.deepcopy(model)), tokenizer)
+    np.testing.assert_allclose(converted.log_perplexity_batch(SENTENCES, CONTEXTS),
+                               evaluator.log_perplexity_batch(SENTENCES, CONTEXTS), rtol=1e-5, atol=1e-5)
+
+
+@pytest.mark.parametrize('precision', ['bf16', 'int8'])
+def test_reduced_precision_close_to_fp32(evaluator, model, tokenizer, precision):
+    import copy
+    reduced = PerplexityEvaluator(copy.deepcopy(model), tokenizer, precision=precision)
+    np.testing.assert_allclose(reduced.log_perplexity_batch(SENTENCES, CONTEXTS),
+                               evaluator.log_perplexity_batch(SENTENCES, CONTEXTS), rtol=0.02)
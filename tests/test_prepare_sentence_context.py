@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from src.ParsedCorpus import ParsedCorpus
+from src.PrepareSentenceContext import PrepareSentenceContext
+from many_atomic_detections import process_text
+from conftest import TEXTS, CountingTokenizer
+
+DATASET = [dict(id=f"doc{i}", text=text) for i, text in enumerate(TEXTS)]
+
+
+@pytest.mark.parametrize('policy', [None, 'previous-sentence', 'previous-3-sentences'])
+def test_regex_engine(policy):
+    parser = PrepareSentenceContext(engine='regex', context_policy=policy)
+    chunks = parser(TEXTS[0])
+    assert chunks['text'][:5] == ["The cat sat on the mat.", "It was happy there.", "Then it left the room!",
+                                  "Why did it go?", "Nobody knows."]
+    assert chunks['length'] == [len(t.split()) for t in chunks['text']]
+    if policy == 'previous-sentence':
+        assert chunks['context'] == [None] + chunks['text'][:-1]
+    assert list(parser.parse_many(TEXTS)) == [parser(text) for text in TEXTS]
+
+
+def test_regex_engine_corpus(tokenizer):
+    parser = PrepareSentenceContext(engine='regex')
+    corpus = ParsedCorpus.build(DATASET, tokenizer, parser=parser)
+    assert corpus.sentences_of(0)['text'] == parser(TEXTS[0])['text']
+    assert corpus.document_text(1) == parser.preprocess(TEXTS[1])
+
+
+@pytest.mark.parametrize('policy', ['no-context', 'previous-sentence', 'previous-3-sentences'])
+@pytest.mark.parametrize('context', [None, "A fixed context."])
+@pytest.mark.parametrize('length_unit', ['spacy', 'bpe'])
+def test_corpus_equals_per_policy(evaluator, tokenizer, policy, context, length_unit):
+    parser = PrepareSentenceContext(context_policy=policy, context=context, length_unit=length_unit,
+                                    tokenizer=tokenizer)
+    corpus = ParsedCorpus.build(DATASET, tokenizer, parser=parser)
+    for (name, record), d in zip(corpus.responses(evaluator, parser), DATASET):
+        expected = process_text(d['text'], evaluator, parser)
+        assert name == d['id']
+        assert record['lengths'] == expected['lengths']
+        assert record['context_lengths'] == expected['context_lengths']
+        np.testing.assert_allclose(record['responses'], expected['responses'], rtol=1e-5, atol=1e-5)
+
+
+def test_corpus_with_scheduler(evaluator, tokenizer):
+    from src.SentenceScheduler import SentenceScheduler
+    parser = PrepareSentenceContext(context_policy='previous-3-sentences')
+    corpus = ParsedCorpus.build(DATASET, tokenizer, parser=parser)
+    scheduler = SentenceScheduler(evaluator, max_tokens=256)
+    for (_, scheduled), (_, plain) in zip(corpus.responses(scheduler, parser), corpus.responses(evaluator, parser)):
+        np.testing.assert_allclose(scheduled['responses'], plain['responses'], rtol=1e-5, atol=1e-5)
+    assert scheduler.stats['pairs'] == sum(len(corpus.sentences_of(k)['text']) for k in range(len(corpus)))
+
+
+@pytest.mark.parametrize('policy', [None, 'previous-sentence', 'previous-3-sentences', 'document'])
+def test_parse_many_equals_single(policy):
+    parser = PrepareSentenceContext(context_policy=policy)
+    assert list(parser.parse_many(TEXTS, batch_size=4)) == [parser(text) for text in TEXTS]
+
+
+class FakeQuestionGenerator(object):
+    """
+    Stands in for the text2text-generation pipeline; questions depend on the generation settings, like
+    those of the real model, whose default beam search differs from greedy decoding
+    """
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts, num_beams=4, **kwargs):
+        self.calls.append(texts)
+        question = lambda text: {"generated_text": f"({num_beams} beams) Why {text}?"}
+        if isinstance(texts, str):
+            return [question(texts)]
+        return [[question(text)] for text in texts]
+
+
+@pytest.mark.parametrize('context', [None, "A fixed context."])
+def test_batched_questions_equal_per_sentence(fake_registry, context):
+    from src.QuestionGenerator import gen_question
+    generator = FakeQuestionGenerator()
+    fake_registry.register('question_generator', lambda **config: generator)
+    parser = PrepareSentenceContext(context_policy='QA', context=context, question_options=dict(batch_size=4))
+
+    records = list(parser.parse_many(TEXTS, batch_size=4))
+    assert len(generator.calls) == 2  # one call per batch of documents
+    for record in records:
+        questions = [gen_question(sent) for sent in record['text']]
+        assert record['context'] == [(context + ' ' + q) if context else q for q in questions]
+    assert records == [parser(text) for text in TEXTS]
+
+
+def test_bpe_lengths_and_ids(tokenizer):
+    parser = PrepareSentenceContext(length_unit='bpe', tokenizer=tokenizer)
+    chunks = parser(TEXTS[3])
+    assert chunks['token_ids'] == tokenizer(chunks['text'])['input_ids']
+    assert chunks['length'] == [len(ids) for ids in chunks['token_ids']]
+    assert [t[:ends[-1]] for t, ends in zip(chunks['text'], chunks['token_ends'])] == chunks['text']
+    assert PrepareSentenceContext()(TEXTS[3])['token_ids'] is None
+
+
+def test_bpe_ids_are_scored_without_tokenizing_again(evaluator, model, tokenizer):
+    from src.PerplexityEvaluator import PerplexityEvaluator
+    parser = PrepareSentenceContext(length_unit='bpe', tokenizer=tokenizer)
+    counting = CountingTokenizer(tokenizer)
+    scorer = PerplexityEvaluator(model, counting)
+    record = process_text(TEXTS[5], scorer, parser)
+    assert counting.calls == 0
+    np.testing.assert_allclose(record['responses'], process_text(TEXTS[5], evaluator, parser)['responses'])
+    np.testing.assert_allclose(record['responses'], evaluator.log_perplexity_batch(parser(TEXTS[5])['text']),
+                               rtol=1e-5, atol=1e-5)
@@ -0,0 +1,24 @@
+import numpy as np
+from src.ResponseCache import ResponseCache, CachedPerplexityEvaluator
+from test_perplexity_evaluator import SENTENCES, CONTEXTS
+
+
+def test_eviction_keeps_recent_entries(tmp_path):
+    cache = ResponseCache(str(tmp_path / 'cache.db'), max_entries=10)
+    for batch in range(5):
+        cache.put_many({f"key{batch}-{i}": float(i) for i in range(4)})
+        assert len(cache) <= 10
+        assert cache._count >= len(cache)
+    assert set(cache.get_many([f"key4-{i}" for i in range(4)])) == {f"key4-{i}" for i in range(4)}
+    assert cache.get_many(["key0-0"]) == {}
+
+    cache.put_many({"key4-0": 1.0})  # replacing an entry never undercounts
+    assert cache._count >= len(cache)
+
+
+def test_cached_equals_uncached(tmp_path, evaluator):
+    cached = CachedPerplexityEvaluator(evaluator, ResponseCache(str(tmp_path / 'cache.db')))
+    expected = evaluator.log_perplexity_batch(SENTENCES, CONTEXTS)
+    np.testing.assert_allclose(cached.log_perplexity_batch(SENTENCES, CONTEXTS), expected, rtol=1e-6)
+    np.testing.assert_allclose(cached.log_perplexity_batch(SENTENCES, CONTEXTS), expected, rtol=1e-6)
+    assert cached.cache.stats['hits'] == len(SENTENCES)
@@ -0,0 +1,34 @@
+import numpy as np
+from src.PerplexityEvaluator import PerplexityEvaluator
+from src.PrepareSentenceContext import PrepareSentenceContext
+from src.ResponseCache import ResponseCache, CachedPerplexityEvaluator
+from src.SentencePipeline import SentencePipeline
+from conftest import TEXTS
+
+DATASET = [dict(id=i, text=text) for i, text in enumerate(TEXTS * 3)]
+
+
+def test_pipeline_with_cache_equals_sequential(tmp_path, evaluator, model, tokenizer):
+    parser = PrepareSentenceContext(context_policy='previous-sentence', context=TEXTS[5])
+    cache = ResponseCache(str(tmp_path / 'cache.db'))
+    cached = CachedPerplexityEvaluator(PerplexityEvaluator(model, tokenizer, reuse_prefix=True), cache)
+
+    for _ in range(2):  # the second run is served from the cache
+        pipeline = SentencePipeline(parser, cached, context_workers=2, scoring_workers=2, queue_size=2)
+        results = list(pipeline(DATASET))
+        assert [d['id'] for d, _, _ in results] == [d['id'] for d in DATASET]
+        for d, chunks, responses in results:
+            expected = parser(d['text'])
+            assert chunks['text'] == expected['text']
+            np.testing.assert_allclose(responses, evaluator.log_perplexity_batch(expected['text'],
+                                                                                 expected['context']),
+                                       rtol=1e-5, atol=1e-5)
+    assert cache.hits > 0
+    assert len(cache) > 0
+
+
+def test_pipeline_regex_engine(evaluator):
+    parser = PrepareSentenceContext(engine='regex', context_policy='previous-sentence')
+    for d, chunks, responses in SentencePipeline(parser, evaluator)(DATASET[:6]):
+        assert chunks == parser(d['text'])
+        assert len(responses) == len(chunks['text'])
@@ -0,0 +1,54 @@
+from collections import OrderedDict
+import pytest
+from src import summarizer
+from src.summarizer import SummaryCache, summarize, summarize_many
+from src.PrepareSentenceContext import PrepareSentenceContext
+from conftest import TEXTS
+
+
+class FakeSummarizer(object):
+    """
+    Stands in for the summarization pipeline and records the texts it summarizes
+    """
+    def __init__(self):
+        self.texts = []
+
+    def __call__(self, texts, **kwargs):
+        self.texts.extend(texts)
+        return [{"summary_text": f"Summary of {text[:20]}."} for text in texts]
+
+
+@pytest.fixture
+def fake_summarizer(fake_registry, monkeypatch):
+    monkeypatch.setattr(summarizer, '_memo', OrderedDict())
+    fake = FakeSummarizer()
+    fake_registry.register('summarizer', lambda **config: fake)
+    return fake
+
+
+def test_memo(fake_summarizer):
+    summaries = summarize_many([TEXTS[0], TEXTS[1], TEXTS[0]])
+    assert summaries[0] == summaries[2] != summaries[1]
+    assert fake_summarizer.texts == [TEXTS[0], TEXTS[1]]
+    assert summarize(TEXTS[1]) == summaries[1]
+    assert len(fake_summarizer.texts) == 2
+
+
+def test_persistent_cache(fake_summarizer, tmp_path, monkeypatch):
+    path = str(tmp_path / "summaries.db")
+    summaries = summarize_many(TEXTS[:3], cache=SummaryCache(path))
+    monkeypatch.setattr(summarizer, '_memo', OrderedDict())  # as in a new process
+    assert summarize_many(TEXTS[:4], cache=SummaryCache(path)) == summaries + [f"Summary of {TEXTS[3][:20]}."]
+    assert fake_summarizer.texts == TEXTS[:4]
+
+
+def test_one_call_per_document_across_policies(fake_summarizer, tmp_path):
+    cache = SummaryCache(str(tmp_path / "summaries.db"))
+    records = {}
+    for policy in ['summary', 'summary-and-previous-sentence']:
+        parser = PrepareSentenceContext(context_policy=policy, summary_cache=cache)
+        records[policy] = list(parser.parse_many(TEXTS + TEXTS[:2], batch_size=4))
+    documents = [PrepareSentenceContext.preprocess(text) for text in TEXTS]
+    assert sorted(fake_summarizer.texts) == sorted(documents)
+    for record, document in zip(records['summary'], documents):
+        assert set(record['context']) == {f"Summary of {document[:20]}."}
@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+from text_detect import read_all_csv_files
+
+
+def test_read_all_csv_files(tmp_path):
+    for k in range(3):
+        pd.DataFrame(dict(num=[1, 2], length=[5, 7], response=[3.5, 4.25], context_length=[0, 5],
+                          name=[f"doc{k}"] * 2)).to_csv(tmp_path / f"responses_{k}.csv")
+    df = read_all_csv_files(str(tmp_path / "responses_*.csv"))
+    assert list(df.columns) == ['num', 'length', 'response']
+    assert len(df) == 6 and df['response'].sum() == 3 * 7.75
+
+
+def test_read_all_csv_files_without_matches(tmp_path):
+    pattern = str(tmp_path / "missing_*.csv")
+    with pytest.raises(FileNotFoundError, match="missing_"):
+        read_all_csv_files(pattern)
+
+
+def test_read_all_csv_files_parquet(tmp_path):
+    pd.DataFrame(dict(num=[1, 2], length=[5, 7], logloss=[3.5, 4.25],
+                      name=["doc", "doc"])).to_parquet(tmp_path / "responses.parquet")
+    df = read_all_csv_files(str(tmp_path / "*.parquet"))
+    assert list(df.columns) == ['num', 'length', 'logloss']
+    assert df['length'].dtype == 'int16' and df['logloss'].dtype == 'float32'
@@ -6,43 +6,74 @@ import numpy as np
 import argparse
 from src.DetectLM import DetectLM
 from src.PerplexityEvaluator import PerplexityEvaluator
+from src.SentenceScheduler import SentenceScheduler
 from src.PrepareSentenceContext import PrepareSentenceContext
-from src.fit_survival_function import fit_per_length_survival_function
+from src.NullModel import NullModel
 from glob import glob
 import pathlib
 import yaml
 from pathlib import Path
 import re
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 
 
-def read_all_csv_files(pattern):
-    df = pd.DataFrame()
-    print(pattern)
-    for f in glob(pattern):
-        df = pd.concat([df, pd.read_csv(f)])
-    return df
+NULL_DATA_DTYPES = {'num': np.int16, 'length': np.int16, 'response': np.float32, 'logloss': np.float32}
+
 
+def _read_null_data_file(path):
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        columns = [c for c in pq.read_schema(path).names if c in NULL_DATA_DTYPES]
+        df = pd.read_parquet(path, columns=columns)
+        return df.astype({c: NULL_DATA_DTYPES[c] for c in columns})
+    return pd.read_csv(path, usecols=lambda c: c in NULL_DATA_DTYPES, dtype=NULL_DATA_DTYPES)
 
-def get_survival_function(df, G=101):
+
+def read_all_csv_files(pattern, max_workers=8):
     """
-    One survival function for every sentence length in tokens
+    Read the null data of all response files matching :pattern: (csv or parquet)
 
-    Args:
-    :df:  data frame with columns 'response' and 'length'
+    Only the columns num, length and response (or logloss) are read, with compact dtypes. Files are
+    read in parallel threads and concatenated once. Raises FileNotFoundError if no file matches.
+    """
+    print(pattern)
+    files = sorted(glob(pattern))
+    if not files:
+        raise FileNotFoundError(f"No null data files match {pattern}")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = list(executor.map(_read_null_data_file, files))
+    return pd.concat(dfs, ignore_index=True)
 
-    Return:
-        bivariate function (length, responce) -> (0,1)
 
+def fit_null_model(params, context, lm_name, context_policy, length_unit='spacy'):
+    """
+    Fit the survival function of the null data files in the configuration
     """
-    assert not df.empty
-    value_name = "response" if "response" in df.columns else "logloss"
+    if context:
+        null_data_file = params['context-null-data-file']
+    else:
+        null_data_file = params['no-context-null-data-file']
+
+    logging.info(f"Using null data from {null_data_file} and fitting survival function")
 
-    df1 = df[~df[value_name].isna()]
-    ll = df1['length']
-    xx1 = df1[value_name]
-    return fit_per_length_survival_function(ll, xx1, log_space=True, G=G)
+    df_null = read_all_csv_files(null_data_file)
+
+    if params['ignore-first-sentence']:
+        df_null = df_null[df_null.num > 1]
+        logging.info(f"Found {len(df_null)} records as null data")
+    value_name = "response" if "response" in df_null.columns else "logloss"
+    return NullModel.fit(df_null['length'].values, df_null[value_name].values,
+                         model_name=lm_name, context_policy=context_policy,
+                         min_length=params['min-tokens-per-sentence'],
+                         max_length=params['max-tokens-per-sentence'],
+                         G=params['number-of-interpolation-points'],
+                         ignore_first_sentence=params['ignore-first-sentence'],
+                         table_points=params.get('pvalue-table-points', 2001),
+                         length_unit=length_unit,
+                         null_data_file=null_data_file)
 
 
 def mark_edits_remove_tags(chunks, tag="edit"):
@@ -75,35 +106,34 @@ def mark_edits_remove_tags(chunks, tag="edit"):
 #         except yaml.YAMLError as exc:
 #             print(exc)
 
-def process_text(input_file, conf="conf.yml", context=False, dashboard=False):
-    with open(conf, "r") as stream:
-        try:
-            params = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            print(exc)
-
-
-    print("context = ", context)
-
-    if context:
-        null_data_file = params['context-null-data-file']
-    else:
-        null_data_file = params['no-context-null-data-file']
+def load_detector(params, context=False):
+    """
+    Load the language model, the null model and the sentence parser described by the configuration
 
+    :param params:  configuration (see conf.yml)
+    :param context:  use the previous sentence as context
+    :return:  (DetectLM, PrepareSentenceContext)
+    """
     lm_name = params['language-model-name']
-
-    logging.info(f"Using null data from {null_data_file} and fitting survival function")
-    logging.info(f"Please verify that the null data was obtained with the same context policy used in inference.")
-
-    df_null = read_all_csv_files(null_data_file)
-
     max_tokens_per_sentence = params['max-tokens-per-sentence']
     min_tokens_per_sentence = params['min-tokens-per-sentence']
+    length_unit = params.get('length-unit', 'spacy')  # unit of the 'length' column of the null data
 
-    if params['ignore-first-sentence']:
-        df_null = df_null[df_null.num > 1]
-        logging.info(f"Found {len(df_null)} records as null data")
-    pval_functions = get_survival_function(df_null, G=params['number-of-interpolation-points'])
+    if context:
+        context_policy = 'previous_sentence'
+    else:
+        context_policy = None
+
+    null_model_file = params.get('context-null-model-file' if context else 'no-context-null-model-file')
+    if null_model_file and os.path.exists(null_model_file):
+        pval_functions = NullModel.load(null_model_file, model_name=lm_name, context_policy=context_policy,
+                                        length_unit=length_unit)
+        pval_functions.check(min_length=min_tokens_per_sentence, max_length=max_tokens_per_sentence,
+                             ignore_first_sentence=params['ignore-first-sentence'])
+    else:
+        pval_functions = fit_null_model(params, context, lm_name, context_policy, length_unit=length_unit)
+        if null_model_file:
+            pval_functions.save(null_model_file)
 
     logging.info(f"Loading model and detection function...")
 
@@ -119,12 +149,14 @@ def process_text(input_file, conf="conf.yml", context=False, dashboard=False):
         device = 'cpu'
     model.to(device)
 
-    if context:
-        context_policy = 'previous_sentence'
-    else:
-        context_policy = None
-
-    sentence_detector = PerplexityEvaluator(model, tokenizer)
+    sentence_detector = PerplexityEvaluator(model, tokenizer, precision=params.get('precision', 'fp32'),
+                                            context_budget=params.get('context-budget'),
+                                            sliding_window=params.get('sliding-window', False),
+                                            window_stride=params.get('window-stride'))
+    if params.get('max-batch-tokens'):  # batch the sentences of a micro-batch or of many documents by length
+        sentence_detector = SentenceScheduler(sentence_detector, max_tokens=params['max-batch-tokens'])
+    parser = PrepareSentenceContext(engine='spacy', context_policy=context_policy, length_unit=length_unit,
+                                    tokenizer=tokenizer)
     logging.debug("Initializing detector...")
     detector = DetectLM(sentence_detector, pval_functions,
                         min_len=min_tokens_per_sentence,
@@ -132,24 +164,39 @@ def process_text(input_file, conf="conf.yml", context=False, dashboard=False):
                         length_limit_policy='truncate',
                         HC_type=params['hc-type'],
                         ignore_first_sentence=
-                        True if context_policy == 'previous_sentence' else False
+                        True if context_policy == 'previous_sentence' else False,
+                        parser=parser
                         )
+    return detector, parser
+
+
+def process_text(input_file, conf="conf.yml", context=False, dashboard=False):
+    with open(conf, "r") as stream:
+        try:
+            params = yaml.safe_load(stream)
+        except yaml.YAMLError as exc:
+            print(exc)
+
+
+    print("context = ", context)
+
+    detector, parser = load_detector(params, context)
 
     logging.info(f"Parsing document {input_file}...")
 
     if pathlib.Path(input_file).suffix == '.txt':
-        engine = 'spacy'
         with open(input_file, 'rt') as f:
             text = f.read()
     else:
         logging.error("Unknown file extension")
         return
 
-    parser = PrepareSentenceContext(engine=engine, context_policy=context_policy)
     chunks = parser(text)
 
     logging.info("Testing parsed document")
-    res = detector(chunks['text'], chunks['context'], dashboard=dashboard)
+    res = detector(chunks['text'], chunks['context'], dashboard=dashboard,
+                   document=chunks.get('document'), spans=chunks.get('spans'),
+                   lengths=chunks['length'], token_ends=chunks['token_ends'], token_ids=chunks['token_ids'])
 
     df = res['sentences']
     df['tag'] = chunks['tag']